@@ -0,0 +1,155 @@
+import torch
+from torch import inf
+
+# Autocast data type of each training precision
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def to_float(outputs):
+    '''Cast the (dict or list of) model outputs to float32 so that the losses are computed in full precision.'''
+    if isinstance(outputs, dict):
+        return {k: to_float(v) for k, v in outputs.items()}
+    elif isinstance(outputs, (list, tuple)):
+        return type(outputs)(to_float(v) for v in outputs)
+    elif torch.is_tensor(outputs) and outputs.is_floating_point():
+        return outputs.float()
+    return outputs
+
+def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
+    if isinstance(parameters, torch.Tensor):
+        parameters = [parameters]
+    parameters = [p for p in parameters if p.grad is not None]
+    norm_type = float(norm_type)
+    if len(parameters) == 0:
+        return torch.tensor(0.)
+    device = parameters[0].grad.device
+    if norm_type == inf:
+        total_norm = max(p.grad.detach().abs().max().to(device) for p in parameters)
+    else:
+        total_norm = torch.norm(torch.stack([torch.norm(p.grad.detach(), norm_type).to(device) for p in parameters]), norm_type)
+    return total_norm
+
+class NativeScalerWithGradNormCount:
+    """
+    Autocast context and optimizer step for a training precision
+    ('fp32', 'bf16' or 'fp16').
+
+    'fp32' runs without autocast and backpropagates and steps as usual,
+    with no overflow checks. With 'fp16' the loss is scaled by a
+    GradScaler, which skips the steps with inf/NaN gradients and lowers the
+    scale. 'bf16' has the exponent range of float32, so its loss is not
+    scaled, but steps with inf/NaN gradients are still skipped.
+
+    In 'fp16' and 'bf16' the numbers of non-finite losses and of overflowed
+    steps are counted on the device, so that counting does not wait on the
+    GPU. They are only read by log_metrics (at the logging interval), by
+    num_nonfinite_losses and num_overflows, and when saving the state dict.
+    """
+    state_dict_key = "amp_scaler"
+
+    def __init__(self, precision='fp32', device='cuda'):
+        if precision not in PRECISIONS:
+            raise ValueError('Unknown precision %s (choose from %s).' % (precision, list(PRECISIONS)))
+        self.precision = precision
+        self.device_type = torch.device(device).type
+        self._scaler = torch.amp.GradScaler(self.device_type, enabled=(precision=='fp16'))
+        # Non-finite losses and overflowed steps since the last log_metrics
+        self._counts = None
+        self._num_losses = 0
+        self._num_steps = 0
+        # Totals read at previous calls to log_metrics
+        self._num_nonfinite_losses = 0
+        self._num_overflows = 0
+
+    def autocast(self):
+        '''Context in which the forward passes run at the training precision.'''
+        return torch.autocast(self.device_type, dtype=PRECISIONS[self.precision],
+                              enabled=(self.precision!='fp32'))
+
+    def __call__(self, loss, optimizer, clip_grad=None,
+                 parameters=None, create_graph=False, update_grad=True):
+        if parameters is None:
+            parameters = [p for group in optimizer.param_groups for p in group['params']]
+        if self.precision=='fp32':
+            loss.backward(create_graph=create_graph)
+            if not update_grad:
+                return None
+            norm = None
+            if clip_grad is not None:
+                norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad)
+            optimizer.step()
+            return norm
+
+        if self._counts is None:
+            self._counts = torch.zeros(2, device=loss.device)
+        self._counts[0] += ~torch.isfinite(loss.detach())
+        self._num_losses += 1
+        self._scaler.scale(loss).backward(create_graph=create_graph)
+        if not update_grad:
+            return None
+
+        parameters = list(parameters)
+        self._scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
+        if clip_grad is not None:
+            norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad)
+        else:
+            norm = get_grad_norm_(parameters)
+        # The norm is not finite if and only if a gradient overflowed
+        overflow = ~torch.isfinite(norm)
+        self._counts[1] += overflow.to(self._counts.device)
+        self._num_steps += 1
+        if self._scaler.is_enabled():
+            # The GradScaler skips the step and lowers the scale after an overflow
+            self._scaler.step(optimizer)
+            self._scaler.update()
+        elif not overflow.item():
+            # (deciding to skip the step waits on the device, as GradScaler.step does)
+            optimizer.step()
+        return norm
+
+    def log_metrics(self, losses_cp, prefix='train'):
+        '''
+        Append the fractions of the losses that were non-finite and of the
+        steps that overflowed since the last call to `losses_cp` (as
+        `prefix`_nonfinite_loss and `prefix`_overflow). Nothing is logged
+        in fp32.
+        '''
+        if self._counts is None:
+            return losses_cp
+        num_nonfinite, num_overflows = self._counts.tolist()
+        losses_cp[prefix+'_nonfinite_loss'].append(num_nonfinite/max(self._num_losses, 1))
+        losses_cp[prefix+'_overflow'].append(num_overflows/max(self._num_steps, 1))
+        self._num_nonfinite_losses += int(num_nonfinite)
+        self._num_overflows += int(num_overflows)
+        self._counts.zero_()
+        self._num_losses = 0
+        self._num_steps = 0
+        return losses_cp
+
+    @property
+    def num_nonfinite_losses(self):
+        '''Total number of non-finite losses.'''
+        pending = 0 if self._counts is None else int(self._counts[0])
+        return self._num_nonfinite_losses + pending
+
+    @property
+    def num_overflows(self):
+        '''Total number of overflowed (and skipped) steps.'''
+        pending = 0 if self._counts is None else int(self._counts[1])
+        return self._num_overflows + pending
+
+    def state_dict(self):
+        return {'precision': self.precision,
+                'scaler': self._scaler.state_dict(),
+                'nonfinite losses': self.num_nonfinite_losses,
+                'overflows': self.num_overflows}
+
+    def load_state_dict(self, state_dict):
+        if 'scaler' not in state_dict:
+            # Older checkpoints saved the GradScaler state only
+            state_dict = {'scaler': state_dict}
+        if self._scaler.is_enabled() and len(state_dict['scaler'])>0:
+            self._scaler.load_state_dict(state_dict['scaler'])
+        self._num_nonfinite_losses = state_dict.get('nonfinite losses', 0)
+        self._num_overflows = state_dict.get('overflows', 0)
+        if self._counts is not None:
+            self._counts.zero_()
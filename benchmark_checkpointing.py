@@ -0,0 +1,195 @@
+import os
+# Directory of benchmark script
+cur_dir = os.path.dirname(__file__)
+import sys
+
+import argparse
+import configparser
+import ctypes
+import multiprocessing
+import time
+from collections import defaultdict
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Compare the peak memory of a training step with and without activation checkpointing.')
+
+    # Optional arguments
+    parser.add_argument("-f", "--family",
+                        help="Model family: the self-supervised StarNet (run_iter) or the MAE (mae_iter).",
+                        type=str, choices=['starnet', 'mae'], default='starnet')
+    parser.add_argument("-c", "--config",
+                        help="Model configuration (default: starnet_ss_1.ini or starnet_mae_91.ini).",
+                        type=str, default=None)
+    parser.add_argument("-bs", "--batch_sizes",
+                        help="Batch sizes (of each domain) to measure (default: 8 16 32 for StarNet, "
+                        "4 64 256 for the MAE, which trains with batches of 64).",
+                        type=int, nargs='+', default=None)
+    parser.add_argument("-ni", "--num_iters",
+                        help="Number of training steps to run for each measurement.",
+                        type=int, default=2)
+    parser.add_argument("-dv", "--device",
+                        help="Device to run on.",
+                        type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def fix_mmap_threshold(size=1<<20):
+    '''
+    Allocate the blocks larger than `size` bytes with their own mmap (glibc).
+    By default glibc raises this threshold as blocks are freed and then serves
+    the activations from the heap, where freeing them neither lowers the
+    resident memory nor updates its recorded peak.
+    '''
+    M_MMAP_THRESHOLD = -3
+    ctypes.CDLL(None).mallopt(M_MMAP_THRESHOLD, size)
+
+def reset_peak_rss():
+    '''Reset the peak resident memory of this process to the current one (Linux).'''
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+def peak_rss_mb():
+    '''Peak resident memory (MB) of this process since the last reset.'''
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])/1e3
+
+def build_step(args, config, batch_size, device):
+    '''Build the model and batches and return a function that runs one training step.'''
+    if args.family=='starnet':
+        sys.path.append(os.path.join(cur_dir,'utils'))
+        from network import StarNet
+        from training_utils import run_iter
+        from benchmark_fused_step import create_batch
+        multimodal_keys = eval(config['DATA']['multimodal_keys'])
+        unimodal_keys = eval(config['DATA']['unimodal_keys'])
+        spectrum_size = int(config['ARCHITECTURE']['spectrum_size'])
+        chunk_size = int(config['TRAINING']['chunk_size'])
+        weights = (torch.tensor(eval(config['TRAINING']['source_mm_weights'])).to(device),
+                   torch.tensor(eval(config['TRAINING']['source_um_weights'])).to(device),
+                   float(config['TRAINING']['source_feature_weight']),
+                   float(config['TRAINING']['target_feature_weight']),
+                   torch.tensor(eval(config['TRAINING']['source_task_weights'])).to(device),
+                   torch.tensor(eval(config['TRAINING']['target_task_weights'])).to(device),
+                   torch.nn.L1Loss())
+        # Grids of 11 values for the multimodal labels
+        mutlimodal_vals = [torch.linspace(-1, 1, 11).to(device) for k in multimodal_keys]
+        model = StarNet(config['ARCHITECTURE'], multimodal_keys, unimodal_keys,
+                        mutlimodal_vals, device).to(device)
+        model = torch.nn.parallel.DataParallel(model, device_ids=list(range(torch.cuda.device_count())), dim=0)
+        optimizer = torch.optim.AdamW(model.module.all_parameters(), lr=1e-4)
+        lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda i: 1.)
+        src_batch = create_batch(model.module, batch_size, spectrum_size, chunk_size, device)
+        tgt_batch = create_batch(model.module, batch_size, spectrum_size, chunk_size, device)
+        def step():
+            losses_cp = defaultdict(list)
+            run_iter(model, src_batch, tgt_batch, optimizer, lr_scheduler, *weights,
+                     losses_cp, mode='train')
+            return losses_cp['train_loss'][0]
+    else:
+        sys.path.append(os.path.join(cur_dir,'mae_utils'))
+        from mae_network import build_mae
+        from training_utils import mae_iter
+        multimodal_keys = eval(config['DATA']['multimodal_keys'])
+        spectrum_size = int(config['MAE ARCHITECTURE']['spectrum_size'])
+        mask_ratio = float(config['TRAINING']['mask_ratio'])
+        # Grids of 11 values for the multimodal labels
+        mutlimodal_vals = [torch.linspace(-1, 1, 11).to(device) for k in multimodal_keys]
+        model = build_mae(config, device, 'benchmark', mutlimodal_vals)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+        lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda i: 1.)
+        src_batch = {'spectrum': (0.9 + 0.16*torch.randn(batch_size, spectrum_size)).to(device)}
+        tgt_batch = {'spectrum': (0.9 + 0.16*torch.randn(batch_size, spectrum_size)).to(device)}
+        def step():
+            losses_cp = defaultdict(list)
+            mae_iter(model, optimizer, lr_scheduler, src_batch, tgt_batch, mask_ratio, 1.,
+                     losses_cp, 0, 1, 'train', device)
+            return losses_cp['train_loss'][0]
+    return step
+
+def measure_step(args, config, batch_size, device, conn=None):
+    '''
+    Return the peak memory (MB) used by the training steps on top of the
+    model, batches, gradients and optimizer states (i.e. the activations),
+    the mean time (ms) of a step and the loss of the last step (which
+    depends on the gradients of the earlier steps). The first step is not
+    measured.
+    '''
+    if device.type=='cpu':
+        fix_mmap_threshold()
+    # Same weights and batches with and without checkpointing
+    torch.manual_seed(0)
+    step = build_step(args, config, batch_size, device)
+    # The first step also allocates the gradients and optimizer states
+    losses = [step()]
+    if device.type=='cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        start_mem = torch.cuda.memory_allocated(device)/1e6
+    else:
+        reset_peak_rss()
+        start_mem = peak_rss_mb()
+    start_time = time.time()
+    losses += [step() for i in range(args.num_iters)]
+    if device.type=='cuda':
+        torch.cuda.synchronize(device)
+        peak_mem = torch.cuda.max_memory_allocated(device)/1e6
+    else:
+        peak_mem = peak_rss_mb()
+    results = (peak_mem-start_mem, (time.time()-start_time)/args.num_iters*1e3, losses[-1])
+    if conn is not None:
+        conn.send(results)
+        conn.close()
+    return results
+
+def measure_in_subprocess(args, config, batch_size, device):
+    '''
+    Run measure_step in a fresh (forked) process, so that the peak resident
+    memory on the CPU is not that of an earlier measurement.
+    '''
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe()
+    proc = ctx.Process(target=measure_step, args=(args, config, batch_size, device, child_conn))
+    proc.start()
+    # (so that recv raises an EOFError if the measurement fails)
+    child_conn.close()
+    results = parent_conn.recv()
+    proc.join()
+    return results
+
+if __name__=="__main__":
+    args = parseArguments()
+    device = torch.device(args.device)
+
+    config_file = args.config
+    if config_file is None:
+        config_file = os.path.join(cur_dir, 'configs', 'starnet_ss_1.ini' if args.family=='starnet'
+                                   else 'starnet_mae_91.ini')
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    arch_section = 'ARCHITECTURE' if args.family=='starnet' else 'MAE ARCHITECTURE'
+    if args.batch_sizes is None:
+        args.batch_sizes = [8, 16, 32] if args.family=='starnet' else [4, 64, 256]
+
+    results = {}
+    for batch_size in args.batch_sizes:
+        for checkpointing in [False, True]:
+            config[arch_section]['checkpoint_activations'] = str(checkpointing)
+            if device.type=='cuda':
+                results[(batch_size, checkpointing)] = measure_step(args, config, batch_size, device)
+            else:
+                results[(batch_size, checkpointing)] = measure_in_subprocess(args, config, batch_size, device)
+
+    print('\n%-14s %8s %16s %14s %14s' % ('Checkpointing', 'Batch', 'Peak memory (MB)', 'Time (ms)', 'Loss diff'))
+    for batch_size in args.batch_sizes:
+        for checkpointing in [False, True]:
+            peak_mem, step_time, loss = results[(batch_size, checkpointing)]
+            print('%-14s %8i %16.1f %14.1f %14.2e' % ('on' if checkpointing else 'off', batch_size,
+                                                       peak_mem, step_time,
+                                                       abs(loss - results[(batch_size, False)][2])))
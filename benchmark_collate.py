@@ -0,0 +1,114 @@
+import os
+# Directory of benchmark script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'data_utils'))
+from collate import RingCollate
+
+import argparse
+import time
+import numpy as np
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Compare the default collate with the '
+                                     'preallocated ring-buffer collate.')
+
+    # Optional arguments
+    parser.add_argument("-bs", "--batch_sizes",
+                        help="Batch sizes to time.",
+                        type=int, nargs='+', default=[64, 512])
+    parser.add_argument("-np", "--num_pixels",
+                        help="Number of pixels in each spectrum.",
+                        type=int, default=800)
+    parser.add_argument("-cs", "--chunk_size",
+                        help="Number of pixels in each spectrum chunk (0 for no chunks).",
+                        type=int, default=0)
+    parser.add_argument("-nw", "--num_workers",
+                        help="Numbers of DataLoader workers to time (0 times the collate functions alone, "
+                        "where RingCollate itself falls back to default_collate).",
+                        type=int, nargs='+', default=[0, 4])
+    parser.add_argument("-ni", "--num_iters",
+                        help="Number of batches to time for each configuration.",
+                        type=int, default=200)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def create_samples(batch_size, num_pixels, chunk_size=0, num_mm_labels=4, num_um_labels=1, num_tasks=6):
+    '''Sample dicts with the same layout as those returned by the SpectraDatasets.'''
+    samples = []
+    for i in range(batch_size):
+        sample = {'spectrum': torch.randn(num_pixels),
+                  'multimodal labels': torch.randn(num_mm_labels),
+                  'unimodal labels': torch.randn(num_um_labels)}
+        if chunk_size>0:
+            sample['spectrum chunk'] = torch.randn(chunk_size)
+            sample['task labels full'] = torch.randn(num_tasks)
+            sample['task labels chunk'] = torch.randn(num_tasks)
+            sample['spectrum index'] = 0
+            sample['chunk index'] = np.random.randint(num_pixels-chunk_size)
+        samples.append(sample)
+    return samples
+
+class SampleDataset(torch.utils.data.Dataset):
+
+    """In-memory dataset of sample dicts, so that only the batch assembly is timed."""
+
+    def __init__(self, samples):
+        self.samples = samples
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        return self.samples[idx]
+
+def time_collate(collate_fn, samples, num_iters):
+    '''Return the number of batches per second assembled by `collate_fn`.'''
+    # Warm up (this also allocates the ring buffers)
+    for i in range(5):
+        collate_fn(samples)
+    start_time = time.time()
+    for i in range(num_iters):
+        collate_fn(samples)
+    return num_iters / (time.time() - start_time)
+
+def time_loader(collate_fn, samples, num_iters, num_workers):
+    '''Return the number of batches per second returned by a DataLoader using `collate_fn`.'''
+    # Repeat the samples so that each epoch has `num_iters` batches
+    dataset = SampleDataset(samples*num_iters)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=len(samples),
+                                             num_workers=num_workers, 
+                                             collate_fn=collate_fn,
+                                             pin_memory=torch.cuda.is_available(),
+                                             persistent_workers=True)
+    # Warm up (starts the workers)
+    for i, batch in enumerate(dataloader):
+        if i==5:
+            break
+    start_time = time.time()
+    for batch in dataloader:
+        pass
+    return num_iters / (time.time() - start_time)
+
+if __name__=="__main__":
+    args = parseArguments()
+
+    print('%-20s %8s %8s %12s' % ('Collate', 'Workers', 'Batch', 'Batches/s'))
+    for num_workers in args.num_workers:
+        for batch_size in args.batch_sizes:
+            samples = create_samples(batch_size, args.num_pixels, args.chunk_size)
+            for name, collate_fn in [('default', torch.utils.data.default_collate),
+                                     ('ring buffers', RingCollate(num_slots=8))]:
+                if num_workers==0:
+                    # Time the ring itself rather than its fallback
+                    if isinstance(collate_fn, RingCollate):
+                        collate_fn = collate_fn.collate
+                    rate = time_collate(collate_fn, samples, args.num_iters)
+                else:
+                    rate = time_loader(collate_fn, samples, args.num_iters, num_workers)
+                print('%-20s %8i %8i %12.1f' % (name, num_workers, batch_size, rate))
@@ -0,0 +1,148 @@
+import os
+# Directory of benchmark script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'utils'))
+sys.path.append(os.path.join(cur_dir,'data_utils'))
+from data_loader import SpectraDataset
+from samplers import block_shuffle_sampler
+from memmap_store import convert_h5_to_memmap
+
+import argparse
+import tempfile
+import time
+import numpy as np
+import h5py
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser()
+
+    # Optional arguments
+    parser.add_argument("-df", "--data_file",
+                        help="HDF5 file to benchmark. A synthetic grid is created if not provided.",
+                        type=str, default=None)
+    parser.add_argument("-wf", "--wave_grid_file",
+                        help="Wavelength grid that matches the spectra.",
+                        type=str, default=os.path.join(cur_dir, 'data/gaia_wavegrid.npy'))
+    parser.add_argument("-n", "--num_spectra",
+                        help="Number of spectra in the synthetic grid.",
+                        type=int, default=20000)
+    parser.add_argument("-bs", "--batch_size",
+                        help="Batch size used by the DataLoader.",
+                        type=int, default=64)
+    parser.add_argument("-nb", "--num_batches",
+                        help="Number of batches to time for each configuration.",
+                        type=int, default=100)
+    parser.add_argument("-nw", "--num_workers",
+                        help="List of DataLoader worker counts to time.",
+                        type=int, nargs='+', default=[0, 3])
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def create_synthetic_grid(data_file, num_spectra, num_pixels,
+                          label_keys=['teff', 'feh', 'logg', 'alpha']):
+    '''Write a file with the same layout as gaia_grid.h5 filled with random data.'''
+    with h5py.File(data_file, "w") as f:
+        for dataset, n in zip(['train', 'val'], [num_spectra, num_spectra//10]):
+            f.create_dataset('spectra %s' % dataset,
+                             data=np.random.normal(1, 0.1, (n, num_pixels)).astype(np.float32))
+            f.create_dataset('continua %s' % dataset,
+                             data=np.ones((n, num_pixels), dtype=np.float32))
+            for k in label_keys:
+                f.create_dataset('%s %s' % (k, dataset),
+                                 data=np.random.choice(np.linspace(-1, 1, 11), n).astype(np.float32))
+
+class PerSampleSpectraDataset(SpectraDataset):
+    '''Mimics the previous behaviour of reading one sample at a time.'''
+    # The DataLoader only uses __getitems__ when it is set
+    __getitems__ = None
+    
+    def __getitem__(self, idx):
+        return SpectraDataset.__getitems__(self, [idx])[0]
+
+class ReopeningSpectraDataset(PerSampleSpectraDataset):
+    '''Mimics the previous behaviour of reopening the file for every sample.'''
+    def __getitem__(self, idx):
+        self.h5.close()
+        return super().__getitem__(idx)
+
+def time_loader(dataset, batch_size, num_batches, num_workers, block_shuffle=False):
+    '''Return the number of samples per second loaded by a DataLoader.'''
+    if block_shuffle:
+        sampler = block_shuffle_sampler(dataset)
+    else:
+        sampler = None
+    dataloader = torch.utils.data.DataLoader(dataset,
+                                             batch_size=batch_size,
+                                             shuffle=(sampler is None),
+                                             sampler=sampler,
+                                             num_workers=num_workers)
+    num_samples = 0
+    for i, batch in enumerate(dataloader):
+        if i==0:
+            # Do not include worker start-up
+            start_time = time.time()
+            continue
+        if getattr(dataset, 'batch_augment', False):
+            batch = dataset.augment_batch(batch)
+        num_samples += len(batch['spectrum'])
+        if i==num_batches:
+            break
+    return num_samples / (time.time() - start_time)
+
+def run_benchmarks(wave_grid_file, configurations,
+                   batch_size, num_batches, num_workers):
+
+    dataset_kwargs = dict(dataset='train',
+                          wave_grid_file=wave_grid_file,
+                          multimodal_keys=['teff', 'feh', 'logg', 'alpha'],
+                          unimodal_keys=[],
+                          continuum_normalize=True,
+                          divide_by_median=False,
+                          chunk_size=250,
+                          tasks=['wavelength', 'slope', 'bias', 'sine amp', 'sine period', 'sine phi'],
+                          task_means=[8580, 0, 0.0, 0, 0.5, 0],
+                          task_stds=[70, 5e-05, 0.1, 0.2, 2, 2],
+                          random_chunk=True,
+                          overlap=0.9,
+                          channel_indices=[0])
+
+    print('%-30s %8s %12s' % ('Configuration', 'Workers', 'Samples/s'))
+    for name, (dataset_class, data_file, extra_kwargs, block_shuffle) in configurations.items():
+        dataset = dataset_class(data_file, **dataset_kwargs, **extra_kwargs)
+        for nw in num_workers:
+            rate = time_loader(dataset, batch_size, num_batches, nw, block_shuffle)
+            print('%-30s %8i %12.1f' % (name, nw, rate))
+
+if __name__=="__main__":
+    args = parseArguments()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_file = args.data_file
+        if data_file is None:
+            print('Creating a synthetic grid of %i spectra...' % args.num_spectra)
+            data_file = os.path.join(tmp_dir, 'synthetic_grid.h5')
+            create_synthetic_grid(data_file, args.num_spectra,
+                                  len(np.load(args.wave_grid_file)))
+
+        # Copy of the data in the memmap layout
+        memmap_dir = os.path.join(tmp_dir, 'memmap_grid')
+        convert_h5_to_memmap(data_file, memmap_dir, verbose=False)
+
+        # Dataset class, data file, extra dataset arguments and whether to use the block-shuffled sampler
+        configurations = {'reopen per sample': (ReopeningSpectraDataset, data_file, {}, False),
+                          'persistent handles': (PerSampleSpectraDataset, data_file, {}, False),
+                          'batched range reads': (SpectraDataset, data_file, {}, False),
+                          'batched + block shuffle': (SpectraDataset, data_file, {}, True),
+                          'preloaded shared memory': (SpectraDataset, data_file, {'preload': True}, False),
+                          'memmap directory': (SpectraDataset, memmap_dir, {}, False),
+                          'memmap + batch augmentation': (SpectraDataset, memmap_dir, 
+                                                          {'batch_augment': True}, False)}
+
+        run_benchmarks(args.wave_grid_file, configurations,
+                       args.batch_size, args.num_batches, args.num_workers)
@@ -0,0 +1,113 @@
+import os
+# Directory of benchmark script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'utils'))
+from network import StarNet
+from training_utils import run_iter
+
+import argparse
+import configparser
+import copy
+import time
+import numpy as np
+from collections import defaultdict
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Compare the separate and fused forward passes of run_iter.')
+
+    # Optional arguments
+    parser.add_argument("-c", "--config",
+                        help="Model configuration.",
+                        type=str, default=os.path.join(cur_dir, 'configs/starnet_ss_1.ini'))
+    parser.add_argument("-bs", "--batch_sizes",
+                        help="Batch sizes (of each domain) to time.",
+                        type=int, nargs='+', default=[16, 64])
+    parser.add_argument("-ni", "--num_iters",
+                        help="Number of training steps to time.",
+                        type=int, default=10)
+    parser.add_argument("-dv", "--device",
+                        help="Device to run on.",
+                        type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def create_batch(model, batch_size, spectrum_size, chunk_size, device):
+    '''Random batch with the same layout as the SpectraDataset batches.'''
+    chunk_indx = torch.randint(0, spectrum_size-chunk_size+1, (batch_size,))
+    spectra = 0.9 + 0.16*torch.randn(batch_size, spectrum_size)
+    return {'spectrum': spectra.to(device),
+            'spectrum chunk': torch.stack([s[i:i+chunk_size] for s, i in zip(spectra, chunk_indx)]).to(device),
+            'multimodal labels': torch.stack([vals[torch.randint(len(vals), (batch_size,))]
+                                              for vals in model.mutlimodal_vals], dim=1).to(device),
+            'unimodal labels': torch.randn(batch_size, model.num_um_labels, device=device),
+            'task labels full': (model.task_means.cpu() + model.task_stds.cpu()*torch.randn(batch_size, len(model.tasks))).to(device),
+            'task labels chunk': (model.task_means.cpu() + model.task_stds.cpu()*torch.randn(batch_size, len(model.tasks))).to(device),
+            'spectrum index': torch.zeros(batch_size, dtype=torch.long, device=device),
+            'chunk index': chunk_indx.to(device)}
+
+def time_steps(model, src_batch, tgt_batch, weights, num_iters, fused):
+    '''Return the mean time (s) of a training step along with the losses of the first step.'''
+    optimizer = torch.optim.AdamW(model.module.all_parameters(), lr=1e-4)
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda i: 1.)
+    device = src_batch['spectrum'].device
+    for i in range(num_iters+1):
+        if i==1:
+            # Do not include the first step
+            if device.type=='cuda':
+                torch.cuda.synchronize(device)
+            start_time = time.time()
+        losses_cp = defaultdict(list)
+        model, optimizer, lr_scheduler, losses_cp = run_iter(model, src_batch, tgt_batch,
+                                                             optimizer, lr_scheduler, *weights,
+                                                             losses_cp, mode='train', fused=fused)
+        if i==0:
+            first_losses = losses_cp
+    if device.type=='cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start_time)/num_iters, first_losses
+
+if __name__=="__main__":
+    args = parseArguments()
+    device = torch.device(args.device)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    multimodal_keys = eval(config['DATA']['multimodal_keys'])
+    unimodal_keys = eval(config['DATA']['unimodal_keys'])
+    spectrum_size = int(config['ARCHITECTURE']['spectrum_size'])
+    chunk_size = int(config['TRAINING']['chunk_size'])
+    weights = (torch.tensor(eval(config['TRAINING']['source_mm_weights'])).to(device),
+               torch.tensor(eval(config['TRAINING']['source_um_weights'])).to(device),
+               float(config['TRAINING']['source_feature_weight']),
+               float(config['TRAINING']['target_feature_weight']),
+               torch.tensor(eval(config['TRAINING']['source_task_weights'])).to(device),
+               torch.tensor(eval(config['TRAINING']['target_task_weights'])).to(device),
+               torch.nn.L1Loss())
+
+    # Grids of 11 values for the multimodal labels
+    mutlimodal_vals = [torch.linspace(-1, 1, 11).to(device) for k in multimodal_keys]
+    model = StarNet(config['ARCHITECTURE'], multimodal_keys, unimodal_keys,
+                    mutlimodal_vals, device).to(device)
+    model = torch.nn.parallel.DataParallel(model, device_ids=list(range(torch.cuda.device_count())), dim=0)
+
+    print('%-10s %8s %14s %18s' % ('Step', 'Batch', 'Time (ms)', 'Max loss diff'))
+    for batch_size in args.batch_sizes:
+        src_batch = create_batch(model.module, batch_size, spectrum_size, chunk_size, device)
+        tgt_batch = create_batch(model.module, batch_size, spectrum_size, chunk_size, device)
+        results = {}
+        for fused in [False, True]:
+            # Start each mode from the same weights
+            results[fused] = time_steps(copy.deepcopy(model), src_batch, tgt_batch,
+                                        weights, args.num_iters, fused)
+        # Compare the losses of the first step
+        loss_diff = max(np.max(np.abs(np.array(results[True][1][k]) - np.array(results[False][1][k])))
+                        for k in results[False][1].keys())
+        for fused in [False, True]:
+            print('%-10s %8i %14.1f %18.2e' % ('fused' if fused else 'separate', batch_size,
+                                               results[fused][0]*1e3, loss_diff))
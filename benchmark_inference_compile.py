@@ -0,0 +1,95 @@
+import os
+# Directory of benchmark script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'utils'))
+from network import StarNet, StarNetInference, build_inference_model
+
+import argparse
+import configparser
+import time
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Compare the eager and compiled StarNet inference.')
+
+    # Optional arguments
+    parser.add_argument("-c", "--config",
+                        help="Model configuration.",
+                        type=str, default=os.path.join(cur_dir, 'configs/starnet_ss_1.ini'))
+    parser.add_argument("-b", "--backends",
+                        help="Compiled backends to compare with eager mode (trace and/or compile).",
+                        type=str, nargs='+', default=['trace'])
+    parser.add_argument("-bs", "--batch_sizes",
+                        help="Batch sizes to time.",
+                        type=int, nargs='+', default=[1, 64, 2048])
+    parser.add_argument("-ni", "--num_iters",
+                        help="Number of forward passes to time.",
+                        type=int, default=3)
+    parser.add_argument("-nt", "--num_threads",
+                        help="Number of CPU threads.",
+                        type=int, default=None)
+    parser.add_argument("-cd", "--cache_dir",
+                        help="Directory of the compiled artefacts.",
+                        type=str, default=os.path.join(cur_dir, 'models/inference_cache'))
+    parser.add_argument("-tol", "--tolerance",
+                        help="Largest difference allowed between the eager and compiled labels.",
+                        type=float, default=1e-4)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def time_forward(model, x, pixel_indx, num_iters):
+    '''Return the throughput (spectra/s) of the forward pass along with its output.'''
+    with torch.no_grad():
+        # Warm up
+        out = model(x, pixel_indx)
+        start_time = time.time()
+        for i in range(num_iters):
+            model(x, pixel_indx)
+    return num_iters*len(x)/(time.time() - start_time), out
+
+if __name__=="__main__":
+    args = parseArguments()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device('cpu')
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    multimodal_keys = eval(config['DATA']['multimodal_keys'])
+    unimodal_keys = eval(config['DATA']['unimodal_keys'])
+    spectrum_size = int(config['ARCHITECTURE']['spectrum_size'])
+
+    mutlimodal_vals = [torch.linspace(-1, 1, 11) for k in multimodal_keys]
+    model = StarNet(config['ARCHITECTURE'], multimodal_keys, unimodal_keys,
+                    mutlimodal_vals, device)
+    model.eval_mode()
+
+    models = {'eager': StarNetInference(model)}
+    for backend in args.backends:
+        start_time = time.time()
+        models[backend] = build_inference_model(model, spectrum_size, device,
+                                                backend=backend, cache_dir=args.cache_dir)
+        # The first call compiles the torch.compile model
+        with torch.no_grad():
+            models[backend](torch.ones(1, spectrum_size), torch.zeros(1, dtype=torch.long))
+        print('Built the %s model in %0.1fs.' % (backend, time.time() - start_time))
+
+    print('%-10s %8s %16s %10s %14s' % ('Model', 'Batch', 'Spectra/s', 'Speedup', 'Max diff'))
+    for batch_size in args.batch_sizes:
+        x = 0.9 + 0.16*torch.randn(batch_size, spectrum_size)
+        pixel_indx = torch.zeros(batch_size, dtype=torch.long)
+        eager_throughput, eager_out = time_forward(models['eager'], x, pixel_indx, args.num_iters)
+        print('%-10s %8i %16.1f %10.2f %14.2e' % ('eager', batch_size, eager_throughput, 1., 0.))
+        for backend in args.backends:
+            throughput, out = time_forward(models[backend], x, pixel_indx, args.num_iters)
+            # Check that the compiled model predicts the same labels
+            diff = torch.max(torch.abs(out - eager_out)/torch.clamp(torch.abs(eager_out), min=1.)).item()
+            if diff>args.tolerance:
+                raise ValueError('The %s labels differ by %0.2e (tolerance %0.2e).' % (backend, diff, args.tolerance))
+            print('%-10s %8i %16.1f %10.2f %14.2e' % (backend, batch_size, throughput,
+                                                      throughput/eager_throughput, diff))
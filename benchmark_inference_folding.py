@@ -0,0 +1,104 @@
+import os
+# Directory of benchmark script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'utils'))
+from network import StarNet, optimize_for_inference
+
+import argparse
+import configparser
+import time
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Compare the original and folded StarNet at inference.')
+
+    # Optional arguments
+    parser.add_argument("-c", "--config",
+                        help="Model configuration.",
+                        type=str, default=os.path.join(cur_dir, 'configs/starnet_ss_1.ini'))
+    parser.add_argument("-bs", "--batch_sizes",
+                        help="Batch sizes to time.",
+                        type=int, nargs='+', default=[1, 64])
+    parser.add_argument("-ni", "--num_iters",
+                        help="Number of forward passes to time.",
+                        type=int, default=20)
+    parser.add_argument("-nt", "--num_threads",
+                        help="Number of CPU threads.",
+                        type=int, default=None)
+    parser.add_argument("-tol", "--tolerance",
+                        help="Largest relative difference allowed between the outputs.",
+                        type=float, default=1e-4)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def randomize_statistics(model):
+    '''Give the folded parameters non-trivial values, as in a trained model.'''
+    with torch.no_grad():
+        for mod in model.modules():
+            if isinstance(mod, torch.nn.BatchNorm1d):
+                mod.running_mean.normal_(0, 0.5)
+                mod.running_var.uniform_(0.5, 2.)
+                mod.weight.normal_(1, 0.2)
+                mod.bias.normal_(0, 0.2)
+            elif isinstance(mod, torch.nn.LayerNorm) and mod.elementwise_affine:
+                mod.weight.normal_(1, 0.2)
+                mod.bias.normal_(0, 0.2)
+            elif hasattr(mod, 'gamma'):
+                mod.gamma.normal_(0, 0.1)
+
+def compare_outputs(outputs, folded_outputs):
+    '''Return the largest difference between the outputs relative to their scale.'''
+    diffs = []
+    for key in outputs.keys():
+        out = outputs[key] if isinstance(outputs[key], list) else [outputs[key]]
+        folded_out = folded_outputs[key] if isinstance(folded_outputs[key], list) else [folded_outputs[key]]
+        for a, b in zip(out, folded_out):
+            diffs.append((torch.max(torch.abs(a - b))/torch.max(torch.abs(a))).item())
+    return max(diffs)
+
+def time_forward(model, x, pixel_indx, num_iters):
+    '''Return the mean time (ms) of a forward pass.'''
+    with torch.no_grad():
+        model(x, pixel_indx, norm_in=True, denorm_out=True)
+        start_time = time.time()
+        for i in range(num_iters):
+            model(x, pixel_indx, norm_in=True, denorm_out=True)
+    return (time.time() - start_time)/num_iters*1e3
+
+if __name__=="__main__":
+    args = parseArguments()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    multimodal_keys = eval(config['DATA']['multimodal_keys'])
+    unimodal_keys = eval(config['DATA']['unimodal_keys'])
+    spectrum_size = int(config['ARCHITECTURE']['spectrum_size'])
+
+    mutlimodal_vals = [torch.linspace(-1, 1, 11) for k in multimodal_keys]
+    model = StarNet(config['ARCHITECTURE'], multimodal_keys, unimodal_keys,
+                    mutlimodal_vals, 'cpu')
+    randomize_statistics(model)
+    model.eval_mode()
+    folded_model = optimize_for_inference(model)
+
+    print('%-8s %14s %14s %10s %14s' % ('Batch', 'Original (ms)', 'Folded (ms)', 'Speedup', 'Max rel diff'))
+    for batch_size in args.batch_sizes:
+        # Full spectra
+        x = 0.9 + 0.16*torch.randn(batch_size, spectrum_size)
+        pixel_indx = torch.zeros(batch_size, dtype=torch.long)
+        with torch.no_grad():
+            diff = compare_outputs(model(x, pixel_indx, norm_in=True, denorm_out=True),
+                                   folded_model(x, pixel_indx, norm_in=True, denorm_out=True))
+        if diff>args.tolerance:
+            raise ValueError('The folded outputs differ by %0.2e (tolerance %0.2e).' % (diff, args.tolerance))
+        orig_time = time_forward(model, x, pixel_indx, args.num_iters)
+        folded_time = time_forward(folded_model, x, pixel_indx, args.num_iters)
+        print('%-8i %14.2f %14.2f %10.2f %14.2e' % (batch_size, orig_time, folded_time,
+                                                    orig_time/folded_time, diff))
@@ -0,0 +1,102 @@
+import os
+# Directory of benchmark script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'data_utils'))
+from label_grid import LabelGrid
+
+import argparse
+import time
+import numpy as np
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Compare the label to class conversions.')
+
+    # Optional arguments
+    parser.add_argument("-nl", "--num_labels",
+                        help="Number of multimodal labels.",
+                        type=int, default=4)
+    parser.add_argument("-nv", "--num_vals",
+                        help="Number of values in each grid.",
+                        type=int, default=40)
+    parser.add_argument("-bs", "--batch_sizes",
+                        help="Batch sizes to time.",
+                        type=int, nargs='+', default=[64, 1024])
+    parser.add_argument("-ni", "--num_iters",
+                        help="Number of conversions to time.",
+                        type=int, default=20)
+    parser.add_argument("-dv", "--device",
+                        help="Device to run on.",
+                        type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def loop_to_class(mutlimodal_vals, labels):
+    '''The previous conversion, which loops over the samples of each label.'''
+    classes = []
+    for i, vals in enumerate(mutlimodal_vals):
+        classes.append(torch.cat([torch.where(vals==labels[j,i])[0] for j in range(len(labels))]))
+    return classes
+
+def grid_to_class(label_grid, labels):
+    return list(label_grid.to_class(labels).unbind(1))
+
+def loop_take_mode(mutlimodal_vals, classes):
+    '''The previous take_mode conversion back to labels.'''
+    labels = []
+    for cla, c_vals in zip(classes, mutlimodal_vals):
+        class_indices = torch.argmax(torch.exp(cla), dim=(1), keepdim=True)
+        labels.append(torch.cat([c_vals[i] for i in class_indices]))
+    return torch.stack(labels).T
+
+def gather_take_mode(mutlimodal_vals, classes):
+    return torch.stack([c_vals[torch.argmax(torch.exp(cla), dim=1)]
+                        for cla, c_vals in zip(classes, mutlimodal_vals)]).T
+
+def time_fn(fn, num_iters, device, *args):
+    '''Return the mean time (ms) of a call along with its output.'''
+    out = fn(*args)
+    if device.type=='cuda':
+        torch.cuda.synchronize(device)
+    start_time = time.time()
+    for i in range(num_iters):
+        fn(*args)
+    if device.type=='cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start_time)/num_iters*1e3, out
+
+if __name__=="__main__":
+    args = parseArguments()
+    device = torch.device(args.device)
+
+    # Unsorted float64 grids, as loaded from the .npy files
+    mutlimodal_vals = [torch.from_numpy(np.random.permutation(np.round(np.linspace(-2.5, 0.5, args.num_vals)+i, 3))).to(device)
+                       for i in range(args.num_labels)]
+    label_grid = LabelGrid(mutlimodal_vals)
+
+    print('%-12s %8s %14s %14s %8s' % ('Conversion', 'Batch', 'Loop (ms)', 'Vector (ms)', 'Match'))
+    for batch_size in args.batch_sizes:
+        # Labels drawn from the grids
+        true_classes = torch.stack([torch.randint(len(vals), (batch_size,), device=device)
+                                    for vals in mutlimodal_vals], dim=1)
+        labels = torch.stack([vals[c] for vals, c in zip(mutlimodal_vals, true_classes.T)], dim=1)
+
+        # Labels to classes (the loop needs labels that equal the float64
+        # grid values exactly, the grid also matches the float32 labels)
+        loop_time, loop_out = time_fn(loop_to_class, args.num_iters, device, mutlimodal_vals, labels)
+        grid_time, grid_out = time_fn(grid_to_class, args.num_iters, device, label_grid, labels.float())
+        match = all(torch.equal(a, b) for a, b in zip(loop_out, grid_out))
+        print('%-12s %8i %14.3f %14.3f %8s' % ('to class', batch_size, loop_time, grid_time, match))
+
+        # Log-probabilities back to labels
+        classes = [torch.log_softmax(torch.randn(batch_size, len(vals), device=device), dim=1)
+                   for vals in mutlimodal_vals]
+        loop_time, loop_out = time_fn(loop_take_mode, args.num_iters, device, mutlimodal_vals, classes)
+        grid_time, grid_out = time_fn(gather_take_mode, args.num_iters, device, mutlimodal_vals, classes)
+        print('%-12s %8i %14.3f %14.3f %8s' % ('take mode', batch_size, loop_time, grid_time,
+                                              torch.equal(loop_out, grid_out)))
@@ -0,0 +1,76 @@
+import os
+# Directory of benchmark script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'utils'))
+import network
+from network import StarNet
+
+import argparse
+import configparser
+import contextlib
+import io
+import time
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Compare the model construction times.')
+
+    # Optional arguments
+    parser.add_argument("-c", "--config",
+                        help="Model configuration.",
+                        type=str, default=os.path.join(cur_dir, 'configs/starnet_ss_1.ini'))
+    parser.add_argument("-s", "--spectrum_sizes",
+                        help="Number of pixels in the full spectra.",
+                        type=int, nargs='+', default=[800, 43480])
+    parser.add_argument("-nb", "--num_builds",
+                        help="Number of models to build.",
+                        type=int, default=5)
+    parser.add_argument("-dv", "--device",
+                        help="Device to run on.",
+                        type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def forward_out_size(in_size, mod, device):
+    '''The previous size computation, which runs a forward pass on the device.'''
+    f = mod.forward(torch.autograd.Variable(torch.Tensor(1, *in_size)).to(device))
+    return f.size()[1:]
+
+def time_builds(architecture_config, multimodal_keys, unimodal_keys,
+                mutlimodal_vals, device, num_builds):
+    '''Return the mean time (s) to build a model along with its feature map shape.'''
+    start_time = time.time()
+    for i in range(num_builds):
+        # Hide the printed feature map shape
+        with contextlib.redirect_stdout(io.StringIO()):
+            model = StarNet(architecture_config, multimodal_keys, unimodal_keys,
+                            mutlimodal_vals, device)
+        if device.type=='cuda':
+            torch.cuda.synchronize(device)
+    return (time.time() - start_time)/num_builds, model.label_classifier.fc.in_features
+
+if __name__=="__main__":
+    args = parseArguments()
+    device = torch.device(args.device)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    multimodal_keys = eval(config['DATA']['multimodal_keys'])
+    unimodal_keys = eval(config['DATA']['unimodal_keys'])
+    mutlimodal_vals = [torch.linspace(-1, 1, 11).to(device) for k in multimodal_keys]
+
+    analytic_out_size = network.compute_out_size
+    print('%-10s %10s %14s %14s' % ('Sizes', 'Spectrum', 'Build (ms)', 'Features'))
+    for spectrum_size in args.spectrum_sizes:
+        config['ARCHITECTURE']['spectrum_size'] = str(spectrum_size)
+        for name, out_size_fn in [('forward', forward_out_size), ('analytic', analytic_out_size)]:
+            network.compute_out_size = out_size_fn
+            build_time, in_features = time_builds(config['ARCHITECTURE'], multimodal_keys,
+                                                  unimodal_keys, mutlimodal_vals,
+                                                  device, args.num_builds)
+            print('%-10s %10i %14.1f %14i' % (name, spectrum_size, build_time*1e3, in_features))
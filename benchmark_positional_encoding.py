@@ -0,0 +1,88 @@
+import os
+# Directory of benchmark script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'utils'))
+from network import PositionalEncoding
+
+import argparse
+import time
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Compare the positional encoding implementations.')
+
+    # Optional arguments
+    parser.add_argument("-d", "--d_model",
+                        help="Encoder dimension.",
+                        type=int, default=16)
+    parser.add_argument("-s", "--spectrum_sizes",
+                        help="Number of pixels in the full spectra.",
+                        type=int, nargs='+', default=[800, 43480])
+    parser.add_argument("-cs", "--chunk_size",
+                        help="Number of pixels in each spectrum chunk.",
+                        type=int, default=250)
+    parser.add_argument("-bs", "--batch_size",
+                        help="Batch size.",
+                        type=int, default=64)
+    parser.add_argument("-ni", "--num_iters",
+                        help="Number of forward passes to time.",
+                        type=int, default=50)
+    parser.add_argument("-dv", "--device",
+                        help="Device to run on.",
+                        type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+class ConcatPositionalEncoding(PositionalEncoding):
+    '''The previous implementation, which slices the table once for each sample.'''
+    def forward(self, x, start_indx):
+        x = x + torch.concat([self.pe[i:i+x.size()[1]].unsqueeze(0) for i in start_indx])
+        return self.dropout(x)
+
+def time_encoding(pos_encoder, x, start_indx, num_iters):
+    '''Return the mean time (ms) of a forward pass and the peak memory (MB) on GPUs.'''
+    device = x.device
+    with torch.no_grad():
+        # Warm up
+        for i in range(3):
+            pos_encoder(x, start_indx)
+        if device.type=='cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base_memory = torch.cuda.memory_allocated(device)
+        start_time = time.time()
+        for i in range(num_iters):
+            pos_encoder(x, start_indx)
+        if device.type=='cuda':
+            torch.cuda.synchronize(device)
+            peak_memory = (torch.cuda.max_memory_allocated(device) - base_memory)/1e6
+        else:
+            peak_memory = float('nan')
+    return (time.time() - start_time)/num_iters*1e3, peak_memory
+
+if __name__=="__main__":
+    args = parseArguments()
+    device = torch.device(args.device)
+
+    print('%-14s %10s %8s %12s %12s %14s' % ('Encoding', 'Spectrum', 'Length',
+                                              'Time (ms)', 'Table (MB)', 'Peak (MB)'))
+    for spectrum_size in args.spectrum_sizes:
+        encoders = [('concat', ConcatPositionalEncoding(args.d_model, spectrum_size, dropout=0)),
+                    ('gather', PositionalEncoding(args.d_model, spectrum_size, dropout=0)),
+                    ('on the fly', PositionalEncoding(args.d_model, spectrum_size, dropout=0,
+                                                      precompute=False))]
+        # Time the chunks and the full spectra
+        for length in sorted(set([min(args.chunk_size, spectrum_size), spectrum_size])):
+            x = torch.randn(args.batch_size, length, args.d_model, device=device)
+            start_indx = torch.randint(0, spectrum_size-length+1, (args.batch_size,), device=device)
+            for name, pos_encoder in encoders:
+                pos_encoder.to(device)
+                table_size = 0. if pos_encoder.pe is None else pos_encoder.pe.numel()*pos_encoder.pe.element_size()/1e6
+                run_time, peak_memory = time_encoding(pos_encoder, x, start_indx, args.num_iters)
+                print('%-14s %10i %8i %12.3f %12.2f %14.2f' % (name, spectrum_size, length,
+                                                             run_time, table_size, peak_memory))
@@ -13,6 +13,19 @@ import torch.nn as nn
 
 from convnextv2 import FCMAE1D, ConvNeXtV2, load_sparse_to_nonsparse
 
+class ConvNeXtV2Inference(nn.Module):
+    '''
+    Label prediction with the ConvNeXtV2 encoder, for export. Maps spectra
+    [batch, num_pixels] to the [batch, num_labels] denormalized labels.
+    '''
+    def __init__(self, model, norm_in=True):
+        super().__init__()
+        self.model = model
+        self.norm_in = norm_in
+
+    def forward(self, spectra):
+        return self.model(spectra, norm_in=self.norm_in, denorm_out=True)['predicted labels']
+
 def build_mae(config, device, model_name):
     
     # Display model configuration
@@ -80,7 +93,8 @@ def build_encoder(config, device, model_name):
         
     return model
 
-def load_model_state(model, model_filename, optimizer=None, lr_scheduler=None, sparse_to_nonsparse=False):
+def load_model_state(model, model_filename, optimizer=None, lr_scheduler=None, sparse_to_nonsparse=False,
+                     loss_scaler=None):
     
     if sparse_to_nonsparse:
         print('\nLoading pretrained MAE weights to finetune...')
@@ -105,6 +119,8 @@ def load_model_state(model, model_filename, optimizer=None, lr_scheduler=None, s
                 optimizer.load_state_dict(checkpoint['optimizer'])
             if lr_scheduler is not None:
                 lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+            if (loss_scaler is not None) and ('loss_scaler' in checkpoint):
+                loss_scaler.load_state_dict(checkpoint['loss_scaler'])
         except ValueError:
             pass
         
@@ -4,6 +4,13 @@ import torch.nn.functional as F
 
 import argparse
 import numpy as np
+from contextlib import nullcontext
+
+import os
+import sys
+cur_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(cur_dir, '..', 'amp_utils'))
+from mixed_precision import NativeScalerWithGradNormCount, to_float
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
@@ -30,6 +37,10 @@ def parseArguments():
     parser.add_argument("-dd", "--data_dir", 
                         help="Data directory if different from StarNet_SS/data/", 
                         type=str, default=None)
+    # Int8 model written by quantize_model.py (for the test scripts)
+    parser.add_argument("-q", "--quantized", 
+                        help="Evaluate the int8 checkpoint instead of the float model.", 
+                        type=str, default='False')
     
     # Parse arguments
     args = parser.parse_args()
@@ -89,9 +100,13 @@ def latent_distance(latent1, latent2):
     # Compute mean absolute error
     return torch.mean(torch.abs(latent1_norm-latent2_norm))   
         
-def mae_iter(model, optimizer, lr_scheduler, #loss_scaler, 
+def mae_iter(model, optimizer, lr_scheduler,
                src_batch, tgt_batch, mask_ratio, target_loss_weight,
-               losses_cp, cur_iter, total_batch_iters, mode):
+               losses_cp, cur_iter, total_batch_iters, mode, loss_scaler=None):
+    '''
+    With a `loss_scaler` (NativeScalerWithGradNormCount) the training forward
+    passes run at its precision and it takes the optimizer step.
+    '''
 
     if mode=='train':
         model.train(True)
@@ -111,14 +126,16 @@ def mae_iter(model, optimizer, lr_scheduler, #loss_scaler,
     '''
     
     # Compute predictions and losses
-    #with torch.cuda.amp.autocast():
     #loss, _, _, latent = model(torch.concatenate((src_batch['spectrum'],
     #                                                  tgt_batch['spectrum']), dim=0), 
     #                                   mask_ratio=mask_ratio, norm_in=True)
-    src_loss, _, _, src_latent = model(src_batch['spectrum'], 
-                                       mask_ratio=mask_ratio, norm_in=True)
-    tgt_loss, _, _, tgt_latent = model(tgt_batch['spectrum'], 
-                                       mask_ratio=mask_ratio, norm_in=True)
+    # (validation runs in float32)
+    with loss_scaler.autocast() if (loss_scaler is not None and mode=='train') else nullcontext():
+        src_loss, _, _, src_latent = model(src_batch['spectrum'], 
+                                           mask_ratio=mask_ratio, norm_in=True)
+        tgt_loss, _, _, tgt_latent = model(tgt_batch['spectrum'], 
+                                           mask_ratio=mask_ratio, norm_in=True)
+    src_loss, src_latent, tgt_loss, tgt_latent = to_float([src_loss, src_latent, tgt_loss, tgt_latent])
 
     # Compute total loss
     loss = src_loss + target_loss_weight*tgt_loss
@@ -126,9 +143,12 @@ def mae_iter(model, optimizer, lr_scheduler, #loss_scaler,
     if mode=='train':
 
         # Backpropagate and update weights
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 2.0)
-        optimizer.step()
+        if loss_scaler is not None:
+            loss_scaler(loss, optimizer, clip_grad=2.0, parameters=model.parameters())
+        else:
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 2.0)
+            optimizer.step()
     
         # Adjust learning rate
         lr_scheduler.step()
@@ -150,7 +170,11 @@ def mae_iter(model, optimizer, lr_scheduler, #loss_scaler,
     return model, optimizer, lr_scheduler, losses_cp
 
 def linear_probe_iter(model, optimizer, lr_scheduler, src_batch,
-                      losses_cp, cur_iter):
+                      losses_cp, cur_iter, loss_scaler=None):
+    '''
+    With a `loss_scaler` (NativeScalerWithGradNormCount) the forward pass
+    runs at its precision and it takes the optimizer step.
+    '''
 
     model.train(True)
 
@@ -158,9 +182,11 @@ def linear_probe_iter(model, optimizer, lr_scheduler, src_batch,
     optimizer.zero_grad()
     
     # Compute predictions
-    model_outputs = model(src_batch['spectrum'], 
-                          norm_in=True, denorm_out=False, 
-                          return_feats=False)
+    with loss_scaler.autocast() if loss_scaler is not None else nullcontext():
+        model_outputs = model(src_batch['spectrum'], 
+                              norm_in=True, denorm_out=False, 
+                              return_feats=False)
+    model_outputs = to_float(model_outputs)
 
     
     # Evaluate loss on predictions vs normalized target labels
@@ -168,8 +194,11 @@ def linear_probe_iter(model, optimizer, lr_scheduler, src_batch,
                                     model.normalize_labels(src_batch['stellar labels']))
 
     # Backpropagate and update weights
-    total_loss.backward()
-    optimizer.step()
+    if loss_scaler is not None:
+        loss_scaler(total_loss, optimizer, parameters=model.parameters())
+    else:
+        total_loss.backward()
+        optimizer.step()
     
     # Adjust learning rate
     lr_scheduler.step()
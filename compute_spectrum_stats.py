@@ -0,0 +1,58 @@
+import os
+# Directory of script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'data_utils'))
+from spectrum_stats import compute_spectrum_stats
+
+import argparse
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Precompute the per-spectrum median, per-channel '
+                                     'standard deviation and snr of a data file. These are used by '
+                                     'the SpectraDataset when use_stats is set in the config. '
+                                     'An interrupted run can be resumed by running the same command.')
+
+    # Positional mandatory arguments
+    parser.add_argument("data_file", help="HDF5 file or memmap directory.", type=str)
+
+    # Optional arguments
+    parser.add_argument("-d", "--datasets",
+                        help="Dataset splits to process.",
+                        type=str, nargs='+', default=['train', 'val'])
+    parser.add_argument("-cn", "--continuum_normalize",
+                        help="Whether the spectra are divided by their continua.",
+                        type=str2bool, default=True)
+    parser.add_argument("-dm", "--divide_by_median",
+                        help="Whether the spectra are divided by their medians.",
+                        type=str2bool, default=True)
+    parser.add_argument("-mt", "--median_thresh",
+                        help="Only pixels above this value are used in the median.",
+                        type=float, default=0.)
+    parser.add_argument("-ci", "--channel_indices",
+                        help="Index of the first pixel in each channel.",
+                        type=int, nargs='+', default=[0])
+    parser.add_argument("-nw", "--num_workers",
+                        help="Number of processes. Uses all of the cores by default.",
+                        type=int, default=None)
+    parser.add_argument("-bs", "--block_size",
+                        help="Number of spectra processed at a time by each worker.",
+                        type=int, default=2048)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+if __name__=="__main__":
+    args = parseArguments()
+
+    stats_file = compute_spectrum_stats(args.data_file, args.datasets,
+                                        args.continuum_normalize, args.divide_by_median,
+                                        args.median_thresh, args.channel_indices,
+                                        args.num_workers, args.block_size)
+    print('Finished writing %s' % stats_file)
@@ -0,0 +1,38 @@
+import os
+# Directory of conversion script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'data_utils'))
+from memmap_store import convert_h5_to_memmap
+
+import argparse
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Convert an HDF5 data file into a directory '
+                                     'of flat binary columns that can be read with np.memmap. '
+                                     'The directory can then be used in place of the HDF5 file '
+                                     'in the config files.')
+
+    # Positional mandatory arguments
+    parser.add_argument("data_file", help="HDF5 file to convert.", type=str)
+    parser.add_argument("out_dir", help="Directory to write the columns to.", type=str)
+
+    # Optional arguments
+    parser.add_argument("-k", "--keys",
+                        help="Datasets to convert (e.g. 'spectra train' 'APOGEE teff train'). All datasets are converted by default.",
+                        type=str, nargs='+', default=None)
+    parser.add_argument("-bs", "--block_size",
+                        help="Number of rows copied at a time.",
+                        type=int, default=4096)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+if __name__=="__main__":
+    args = parseArguments()
+
+    convert_h5_to_memmap(args.data_file, args.out_dir, args.keys, args.block_size)
+    print('Finished writing %s' % args.out_dir)
@@ -0,0 +1,311 @@
+import numpy as np
+import torch
+
+def apply_slope(spectrum, slope_mean, slope_std):
+    # Create random slope value
+    slope = np.random.normal(slope_mean, slope_std)
+    # Add to the spectrum
+    spectrum += np.arange(len(spectrum))*slope
+    return spectrum, slope
+
+def apply_bias(spectrum, bias_mean, bias_std):
+    # Create random bias value
+    bias = np.random.normal(bias_mean, bias_std)
+    # Add to the spectrum
+    spectrum += bias
+    return spectrum, bias
+
+def apply_sine(spectrum, amp, period, phi):
+    # Add sine wave to the spectrum
+    spectrum += amp*np.sin(np.linspace(0,2*np.pi*period, len(spectrum)) + phi)
+    return spectrum
+
+def add_noise(x, noise_factor=0.07):
+
+    if type(noise_factor) == float or type(noise_factor) == int or type(noise_factor) == np.float64:
+        noise_factor = noise_factor*np.median(x)
+        noise = noise_factor * np.random.normal(loc=0.0, scale=1.0, size=x.shape)
+        x += noise
+    else:
+        raise ValueError('Noise parameter must be a float or integer')
+    return x
+
+def calc_snr(spectrum):
+    # Calculate snr
+    n = len(spectrum)
+    
+    if n>10:
+        signal = np.median(spectrum)
+        noise  = 0.6052697 * np.median(np.abs(2.0 * spectrum[2:n-2] - spectrum[0:n-4] - spectrum[4:n]))
+    else:
+        signal = 1
+        noise = 1
+    return signal/(noise+1e-3)
+
+def dropout_chunks(spectrum, max_chunks=10, max_chunk_size=200):
+    # Number of zero chunks to insert
+    num_chunks = np.random.randint(0, max_chunks)
+    for i in range(num_chunks):
+        # Number of consecutive zeros
+        chunk_size = np.random.randint(0, max_chunk_size)
+        
+        # Starting location of chunk
+        chunk_start_indx = np.random.randint(0, len(spectrum)-chunk_size)
+        
+        # Set flux values to zero
+        spectrum[chunk_start_indx:chunk_start_indx+chunk_size] = 0.
+    
+    return spectrum
+
+def batch_median(x, mask=None):
+    '''
+    Median along the last dimension of a [B, L] tensor, only including the
+    values where `mask` is True. Matches np.median (the two middle values
+    are averaged for an even number of values).
+    '''
+    if mask is None:
+        mask = torch.ones_like(x, dtype=torch.bool)
+    n = mask.sum(dim=1, keepdim=True)
+    # Push the excluded values to the end of each row
+    x = torch.sort(x.masked_fill(~mask, float('inf')), dim=1).values
+    lower = torch.gather(x, 1, ((n-1)//2).clamp(min=0))
+    upper = torch.gather(x, 1, (n//2).clamp(max=x.shape[1]-1))
+    return (0.5*(lower+upper)).squeeze(1)
+
+def batch_snr(spectra, thresh=0.1):
+    '''Batched version of calc_snr(spectrum[spectrum>thresh]).'''
+    num_pixels = spectra.shape[1]
+    mask = spectra>thresh
+    n = mask.sum(dim=1, keepdim=True)
+
+    # Move the selected pixels to the front of each row (keeping their order)
+    order = torch.argsort((~mask).to(torch.uint8), dim=1, stable=True)
+    x = torch.gather(spectra, 1, order)
+    pos = torch.arange(num_pixels, device=spectra.device).unsqueeze(0)
+
+    signal = batch_median(x, pos<n)
+    diff = torch.abs(2.0 * x[:,2:num_pixels-2] - x[:,0:num_pixels-4] - x[:,4:num_pixels])
+    noise = 0.6052697 * batch_median(diff, pos[:,:num_pixels-4]<(n-4))
+
+    # Too few pixels to estimate the snr
+    few_pixels = n.squeeze(1)<=10
+    signal = torch.where(few_pixels, torch.ones_like(signal), signal)
+    noise = torch.where(few_pixels, torch.ones_like(noise), noise)
+    return signal/(noise+1e-3)
+
+def batch_dropout_mask(batch_size, num_pixels, max_chunks=10, max_chunk_size=200,
+                       device='cpu', generator=None):
+    '''Batched version of the chunks zeroed by dropout_chunks.'''
+    # Number of zero chunks in each spectrum along with their sizes and starting locations
+    num_chunks = torch.randint(0, max_chunks, (batch_size, 1), device=device, generator=generator)
+    chunk_sizes = torch.randint(0, max_chunk_size, (batch_size, max_chunks),
+                                device=device, generator=generator)
+    chunk_starts = (torch.rand((batch_size, max_chunks), device=device, generator=generator) *
+                    (num_pixels-chunk_sizes)).long()
+    active = (torch.arange(max_chunks, device=device).unsqueeze(0)<num_chunks).float()
+
+    # Mark the start and end of each chunk and fill in between with a cumulative sum
+    markers = torch.zeros((batch_size, num_pixels+1), device=device)
+    markers.scatter_add_(1, chunk_starts, active)
+    markers.scatter_add_(1, chunk_starts+chunk_sizes, -active)
+    return torch.cumsum(markers, dim=1)[:,:num_pixels]>0.5
+
+class SpectrumAugmenter:
+
+    """
+    Per-sample augmentations of a full spectrum: noise and the slope, bias
+    and sine augmentations drawn from the distributions in `augs`,
+    `aug_means` and `aug_stds` (without returning their values).
+    Returns the augmented spectrum as a float32 tensor.
+    """
+
+    def __init__(self, add_noise=False, max_noise_factor=0.1, 
+                 augs=None, aug_means=None, aug_stds=None):
+        self.add_noise = add_noise
+        self.max_noise_factor = max_noise_factor
+        self.augs = augs
+        self.aug_means = aug_means
+        self.aug_stds = aug_stds
+
+    def __call__(self, spectrum):
+
+        if self.add_noise:
+            # Determine noise factor
+            noise_factor = np.random.uniform(0.0001, self.max_noise_factor)
+            spectrum = add_noise(spectrum, noise_factor=noise_factor)
+                    
+        # Perform augmentations according to distributions
+        if self.augs is not None:
+            sine_aug = False
+            for t, tm, ts in zip(self.augs, self.aug_means, self.aug_stds):
+                if t.lower()=='slope':
+                    spectrum, slope = apply_slope(spectrum, tm, ts)
+                if t.lower()=='bias':
+                    spectrum, bias = apply_bias(spectrum, tm, ts)
+                if t.lower()=='sine amp':
+                    sine_amp = np.abs(np.random.normal(tm, ts))
+                    sine_aug = True
+                if t.lower()=='sine period':
+                    sine_period = np.abs(np.random.normal(tm, ts))
+                    sine_aug = True
+                if t.lower()=='sine phi':
+                    sine_phi = np.random.normal(tm, ts)
+                    sine_aug = True
+
+            if sine_aug:
+                spectrum = apply_sine(spectrum, sine_amp, sine_period, sine_phi)
+            
+        return torch.from_numpy(spectrum.astype(np.float32))
+
+class TaskAugmenter:
+
+    """
+    Per-sample self-supervised augmentations (noise, slope, bias, sine and
+    chunk dropout) of a spectrum or spectrum chunk. Returns the augmented
+    spectrum along with the task labels, in the same order as `tasks`.
+    """
+
+    def __init__(self, tasks, task_means, task_stds, add_noise=False, 
+                 max_noise_factor=0.1, apply_dropout=False):
+        self.tasks = tasks
+        self.task_means = task_means
+        self.task_stds = task_stds
+        self.add_noise = add_noise
+        self.max_noise_factor = max_noise_factor
+        self.apply_dropout = apply_dropout
+
+    def __call__(self, spectrum, centre_wave):
+
+        if self.add_noise:
+            # Determine noise factor
+            noise_factor = np.random.uniform(0.0001, self.max_noise_factor)
+            spectrum = add_noise(spectrum, noise_factor=noise_factor)
+                    
+        # Perform augmentations according to tasks
+        sine_aug = False
+        task_labels = []
+        for t, tm, ts in zip(self.tasks, self.task_means, self.task_stds):
+            if t.lower()=='wavelength':
+                task_labels.append(centre_wave) 
+            if t.lower()=='slope':
+                spectrum, slope = apply_slope(spectrum, tm, ts)
+                task_labels.append(slope)
+            if t.lower()=='bias':
+                spectrum, bias = apply_bias(spectrum, tm, ts)
+                task_labels.append(bias)
+            if t.lower()=='snr':
+                snr = calc_snr(spectrum[spectrum>0.1])
+                task_labels.append(snr)
+            if t.lower()=='sine amp':
+                sine_amp = np.abs(np.random.normal(tm, ts))
+                task_labels.append(sine_amp)
+                sine_aug = True
+            if t.lower()=='sine period':
+                sine_period = np.abs(np.random.normal(tm, ts))
+                task_labels.append(sine_period)
+                sine_aug = True
+            if t.lower()=='sine phi':
+                sine_phi = np.random.normal(tm, ts)
+                task_labels.append(sine_phi)
+                sine_aug = True
+            
+        if sine_aug:
+            spectrum = apply_sine(spectrum, sine_amp, sine_period, sine_phi)
+                
+        if self.apply_dropout:
+            # Dropout random chunks of the spectrum
+            spectrum = dropout_chunks(spectrum, 
+                                      max_chunks=10, 
+                                      max_chunk_size=200)
+            
+        task_labels = torch.from_numpy(np.array(task_labels).astype(np.float32))
+        spectrum = torch.from_numpy(spectrum.astype(np.float32))
+            
+        return spectrum, task_labels
+
+class BatchAugmenter:
+
+    """
+    Applies the self-supervised augmentations (noise, slope, bias, sine and
+    chunk dropout) to a whole [batch, pixel] tensor at once, on whichever
+    device the tensor is on.
+
+    This is the batched version of TaskAugmenter. All of the random
+    parameters of a batch are drawn together and applied with broadcast
+    operations. The task labels are returned in the same order as `tasks`.
+    """
+
+    def __init__(self, tasks, task_means, task_stds, add_noise=False, max_noise_factor=0.1,
+                 apply_dropout=False, max_chunks=10, max_chunk_size=200, generator=None):
+
+        self.tasks = [t.lower() for t in tasks]
+        self.task_means = torch.tensor(np.asarray(task_means, dtype=np.float32))
+        self.task_stds = torch.tensor(np.asarray(task_stds, dtype=np.float32))
+        self.add_noise = add_noise
+        self.max_noise_factor = max_noise_factor
+        self.apply_dropout = apply_dropout
+        self.max_chunks = max_chunks
+        self.max_chunk_size = max_chunk_size
+        self.generator = generator
+
+    def __call__(self, spectra, centre_wave):
+
+        batch_size, num_pixels = spectra.shape
+        device = spectra.device
+        spectra = spectra.clone()
+
+        if self.add_noise:
+            # Determine noise factors
+            noise_factor = (0.0001 + (self.max_noise_factor-0.0001) *
+                            torch.rand((batch_size, 1), device=device, generator=self.generator))
+            noise_factor = noise_factor*batch_median(spectra).unsqueeze(1)
+            spectra += noise_factor * torch.randn(spectra.shape, device=device, generator=self.generator)
+
+        # Draw all of the task parameters at once
+        params = (self.task_means.to(device) + self.task_stds.to(device) *
+                  torch.randn((batch_size, len(self.tasks)), device=device, generator=self.generator))
+        pixel_indx = torch.arange(num_pixels, device=device, dtype=spectra.dtype).unsqueeze(0)
+
+        # Perform augmentations according to tasks
+        sine_aug = False
+        task_labels = []
+        for i, t in enumerate(self.tasks):
+            if t=='wavelength':
+                task_labels.append(centre_wave.to(device, spectra.dtype))
+            if t=='slope':
+                spectra += pixel_indx*params[:,i:i+1]
+                task_labels.append(params[:,i])
+            if t=='bias':
+                spectra += params[:,i:i+1]
+                task_labels.append(params[:,i])
+            if t=='snr':
+                task_labels.append(batch_snr(spectra))
+            if t=='sine amp':
+                sine_amp = torch.abs(params[:,i:i+1])
+                task_labels.append(sine_amp[:,0])
+                sine_aug = True
+            if t=='sine period':
+                sine_period = torch.abs(params[:,i:i+1])
+                task_labels.append(sine_period[:,0])
+                sine_aug = True
+            if t=='sine phi':
+                sine_phi = params[:,i:i+1]
+                task_labels.append(sine_phi[:,0])
+                sine_aug = True
+
+        if sine_aug:
+            phase = torch.linspace(0, 1, num_pixels, device=device).unsqueeze(0)
+            spectra += sine_amp*torch.sin(2*np.pi*sine_period*phase + sine_phi)
+
+        if self.apply_dropout:
+            # Dropout random chunks of the spectra
+            drop = batch_dropout_mask(batch_size, num_pixels, self.max_chunks,
+                                      self.max_chunk_size, device, self.generator)
+            spectra = spectra.masked_fill(drop, 0.)
+
+        if len(task_labels)>0:
+            task_labels = torch.stack(task_labels, dim=1)
+        else:
+            task_labels = torch.zeros((batch_size, 0), device=device)
+
+        return spectra, task_labels
@@ -0,0 +1,94 @@
+import numpy as np
+import torch
+
+class BatchChunkSampler:
+
+    """
+    Selects a random chunk from each spectrum of a [batch, pixel] tensor.
+
+    This is the batched version of ChunkedLayout.select_random_chunk. The
+    channel of each spectrum is chosen among the channels that have a
+    standard deviation above `std_min`, and the starting index is chosen from
+    the same overlapping grid of starting indices. The channel validity is
+    computed once per batch, the channels and starting indices of the whole
+    batch are drawn together and the chunks are extracted with a single gather.
+    """
+
+    def __init__(self, wave_grid, channel_indices, chunk_size, overlap=0.5,
+                 random_chunk=True, std_min=0.01, generator=None):
+
+        num_pixels = len(wave_grid)
+        self.channel_starts = list(channel_indices)
+        self.channel_ends = self.channel_starts[1:] + [num_pixels]
+        self.chunk_size = chunk_size
+        self.random_chunk = random_chunk
+        self.std_min = std_min
+        self.generator = generator
+
+        # Starting indices (relative to the channel) of the chunks that are
+        # entirely within each channel, padded into a [channel, start] table
+        starting_indices = [np.arange(0, end_i-start_i-chunk_size,
+                                      chunk_size*(1-overlap)).astype(int)
+                            for start_i, end_i in zip(self.channel_starts, self.channel_ends)]
+        # (Chunks that fill a whole channel can only start at its first pixel)
+        starting_indices = [s if len(s)>0 else np.zeros(1, dtype=int) for s in starting_indices]
+        max_starts = max(len(s) for s in starting_indices)
+        start_table = np.zeros((len(starting_indices), max_starts), dtype=np.int64)
+        centre_table = np.zeros((len(starting_indices), max_starts), dtype=np.float32)
+        for c, s in enumerate(starting_indices):
+            start_table[c,:len(s)] = s + self.channel_starts[c]
+            # Centre of the wavelength range of each chunk
+            centre_table[c,:len(s)] = [np.median(wave_grid[i:i+chunk_size])
+                                       for i in s + self.channel_starts[c]]
+
+        self.num_starts = torch.tensor([len(s) for s in starting_indices])
+        self.start_table = torch.from_numpy(start_table)
+        self.centre_table = torch.from_numpy(centre_table)
+        self.wave_grid = torch.from_numpy(np.asarray(wave_grid, dtype=np.float32))
+        self.channel_ids = torch.from_numpy(np.concatenate([np.full(end_i-start_i, c) for c, (start_i, end_i) in
+                                                            enumerate(zip(self.channel_starts, self.channel_ends))]))
+
+    def channel_validity(self, spectra):
+        '''[batch, channel] mask of the channels with a standard deviation above std_min.'''
+        return torch.stack([torch.std(spectra[:,start_i:end_i], dim=1, unbiased=False)>self.std_min
+                            for start_i, end_i in zip(self.channel_starts, self.channel_ends)], dim=1)
+
+    def __call__(self, spectra, valid=None):
+        '''
+        Returns the [batch, chunk_size] chunks, the index of the first pixel of
+        each chunk, the centre wavelength of each chunk and the mean wavelength
+        of the valid channels of each spectrum.
+        The [batch, channel] validity mask is computed if not provided.
+        '''
+        batch_size = spectra.shape[0]
+        device = spectra.device
+
+        if valid is None:
+            valid = self.channel_validity(spectra)
+        valid = valid.to(device)
+        # Fall back on all channels for spectra without any valid channels
+        valid = valid | ~valid.any(dim=1, keepdim=True)
+
+        # Select one valid channel per spectrum
+        # (the index tables are small and kept on the cpu)
+        channel_num = torch.multinomial(valid.float().cpu(), 1, generator=self.generator).squeeze(1)
+        if self.random_chunk:
+            # Select random chunk from this channel
+            start_num = (torch.rand(batch_size, generator=self.generator) *
+                         self.num_starts[channel_num]).long()
+        else:
+            start_num = torch.zeros(batch_size, dtype=torch.long)
+        chunk_indx = self.start_table[channel_num, start_num]
+        centre_wave = self.centre_table[channel_num, start_num]
+
+        # Gather the chunks
+        chunk_indx = chunk_indx.to(device)
+        pixel_indx = chunk_indx.unsqueeze(1) + torch.arange(self.chunk_size, device=device).unsqueeze(0)
+        spectrum_chunk = torch.gather(spectra, 1, pixel_indx)
+
+        # Mean wavelength of the valid channels
+        pixel_valid = torch.gather(valid, 1, self.channel_ids.to(device).unsqueeze(0).expand(batch_size, -1))
+        wave_grid = self.wave_grid.to(device)
+        centre_wave_full = (pixel_valid*wave_grid).sum(dim=1) / pixel_valid.sum(dim=1)
+
+        return spectrum_chunk, chunk_indx, centre_wave.to(device), centre_wave_full
@@ -0,0 +1,112 @@
+import os
+import numpy as np
+import h5py
+
+def contiguous_runs(indices, max_gap=0):
+    '''
+    Group sorted, unique indices into [start, stop) ranges. Ranges that are
+    separated by at most `max_gap` unused rows are merged into one.
+    '''
+    breaks = np.where(np.diff(indices) > max_gap+1)[0] + 1
+    starts = indices[np.concatenate(([0], breaks))]
+    stops = indices[np.concatenate((breaks-1, [len(indices)-1]))] + 1
+    return list(zip(starts, stops))
+
+class H5FileManager:
+
+    """
+    Keeps a single read-only h5py handle open to `data_file` for the life of
+    each process that uses it (i.e. once per DataLoader worker).
+
+    The file keys, dataset shapes and lengths are read once when the manager
+    is created and are carried over to the workers, while the file and dataset
+    handles themselves are opened lazily in whichever process first needs them.
+    A handle inherited from a parent process through a fork is never reused.
+    """
+
+    # Random reads of single rows go through chunk decompression
+    fast_random_access = False
+
+    def __init__(self, data_file):
+
+        self.data_file = data_file
+
+        # Collect the file metadata with a short-lived handle so that
+        # the parent process does not keep the file open
+        with h5py.File(self.data_file, "r") as f:
+            self.keys = set(f.keys())
+            self.shapes = {k: f[k].shape for k in self.keys
+                           if isinstance(f[k], h5py.Dataset)}
+            self.chunks = {k: f[k].chunks for k in self.shapes.keys()}
+
+        self._pid = None
+        self._file = None
+        self._datasets = {}
+
+    def __getstate__(self):
+        # Open handles can not be sent to spawned workers
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_file'] = None
+        state['_datasets'] = {}
+        return state
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def shape(self, key):
+        return self.shapes[key]
+
+    def length(self, key):
+        return self.shapes[key][0]
+
+    @property
+    def file(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # Either the file has not been opened yet or we are in a forked
+            # worker holding the parent's handle, which is not safe to share
+            self._file = h5py.File(self.data_file, "r")
+            self._datasets = {}
+            self._pid = pid
+        return self._file
+
+    def dataset(self, key):
+        '''Return the (cached) h5py.Dataset object for `key`.'''
+        f = self.file
+        if key not in self._datasets:
+            self._datasets[key] = f[key]
+        return self._datasets[key]
+
+    def chunk_rows(self, key):
+        '''Number of rows stored in each HDF5 chunk of `key` (1 if contiguous).'''
+        if self.chunks[key] is None:
+            return 1
+        return self.chunks[key][0]
+
+    def read_rows(self, key, indices, max_gap=32):
+        '''
+        Read the rows at `indices` from dataset `key`.
+        
+        The indices are sorted and grouped into contiguous hyperslabs so that
+        each group is read with a single slice. The rows are returned in the
+        order they were requested.
+        '''
+        unique_indices, inverse = np.unique(np.asarray(indices), return_inverse=True)
+        dset = self.dataset(key)
+        
+        rows = np.empty((len(unique_indices),)+dset.shape[1:], dtype=dset.dtype)
+        i = 0
+        for start, stop in contiguous_runs(unique_indices, max_gap):
+            # Rows of this slice that were actually requested
+            j = np.searchsorted(unique_indices, stop)
+            rows[i:j] = dset[start:stop][unique_indices[i:j]-start]
+            i = j
+        return rows[inverse]
+
+    def close(self):
+        if (self._file is not None) and (self._pid==os.getpid()):
+            self._file.close()
+        self._pid = None
+        self._file = None
+        self._datasets = {}
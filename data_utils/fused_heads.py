@@ -0,0 +1,37 @@
+import torch
+
+def fuse_head_states(weights, biases):
+    '''Fused Linear layer state dict of the (weight, bias) of each separate head.'''
+    return {'fc.weight': torch.cat(weights), 'fc.bias': torch.cat(biases)}
+
+def convert_optimizer_state(head, optimizer, state):
+    '''
+    Convert the state dict of an optimizer whose parameter groups held the
+    parameters of separate heads (in place of the parameters of the fused
+    `head` module) into a state dict for `optimizer`. The states of every
+    other parameter are kept, and the fused parameters start with fresh
+    states.
+    '''
+    head_params = set(id(p) for p in head.parameters())
+    new_state = optimizer.state_dict()
+    param_states = {}
+    for group, new_group, old_group in zip(optimizer.param_groups, new_state['param_groups'],
+                                            state['param_groups']):
+        # Position and number of the fused parameters in this group
+        head_indx = [i for i, p in enumerate(group['params']) if id(p) in head_params]
+        start = head_indx[0] if len(head_indx)>0 else len(group['params'])
+        # Number of separate head parameters that they replaced
+        num_old = len(old_group['params']) - (len(group['params']) - len(head_indx))
+        for i, param_id in enumerate(new_group['params']):
+            if i<start:
+                old_id = old_group['params'][i]
+            elif i>=start+len(head_indx):
+                old_id = old_group['params'][i - len(head_indx) + num_old]
+            else:
+                continue
+            if old_id in state['state']:
+                param_states[param_id] = state['state'][old_id]
+        # Keep the hyperparameters of the old group
+        new_group.update({k: v for k, v in old_group.items() if k!='params'})
+    new_state['state'] = param_states
+    return new_state
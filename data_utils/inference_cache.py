@@ -0,0 +1,35 @@
+import os
+import json
+import hashlib
+import torch
+
+def inference_cache_key(model, options, tensors=[]):
+    '''Hash of the model weights, any other `tensors` it depends on and the build options.'''
+    key = hashlib.sha1(json.dumps(options, sort_keys=True).encode())
+    for name, t in model.state_dict().items():
+        key.update(name.encode())
+        key.update(t.detach().cpu().contiguous().numpy().tobytes())
+    for t in tensors:
+        key.update(t.detach().cpu().contiguous().numpy().tobytes())
+    return key.hexdigest()[:16]
+
+def trace_inference_model(inference_model, example_inputs, name, cache_dir=None, cache_key=None):
+    '''
+    Trace and freeze `inference_model` with TorchScript. With a `cache_dir`,
+    the traced module is saved there as <name>_<cache_key>.pt and loaded by
+    later builds with the same key.
+    '''
+    device = example_inputs[0].device
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, '%s_%s.pt' % (name, cache_key))
+        if os.path.exists(cache_file):
+            return torch.jit.load(cache_file, map_location=device)
+
+    with torch.no_grad():
+        traced_model = torch.jit.trace(inference_model.eval(), tuple(example_inputs))
+    traced_model = torch.jit.freeze(traced_model)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.jit.save(traced_model, cache_file)
+    return traced_model
@@ -0,0 +1,67 @@
+import torch
+
+class LabelGrid:
+
+    """
+    Maps the multimodal labels of a whole batch onto the indices of their
+    grid values without looping over the samples.
+
+    The grids of the K labels are sorted and padded with +inf into a single
+    [K, M] table so that a batch of labels [B, K] is located with one
+    torch.searchsorted call. Each label is then matched to the nearest of
+    its two neighbouring grid values, using the tolerances of torch.isclose
+    so that float32 labels match float64 grids.
+    """
+
+    def __init__(self, vals, rtol=1e-5, atol=1e-8):
+        self.vals = list(vals)
+        self.rtol = rtol
+        self.atol = atol
+        self.num_vals = [len(v) for v in self.vals]
+
+        if len(self.vals)>0:
+            max_vals = max(self.num_vals)
+            dtype = self.vals[0].dtype
+            for v in self.vals[1:]:
+                dtype = torch.promote_types(dtype, v.dtype)
+            if not dtype.is_floating_point:
+                dtype = torch.get_default_dtype()
+            sorted_vals = torch.full((len(self.vals), max_vals), float('inf'), dtype=dtype)
+            sort_indices = torch.zeros((len(self.vals), max_vals), dtype=torch.long)
+            for i, v in enumerate(self.vals):
+                s, indx = torch.sort(v.detach().cpu().to(dtype))
+                sorted_vals[i,:len(v)] = s
+                sort_indices[i,:len(v)] = indx
+            self._tables = {torch.device('cpu'): (sorted_vals, sort_indices)}
+
+    def tables(self, device):
+        '''Return the sorted grids and their original indices on `device`.'''
+        device = torch.device(device)
+        if device not in self._tables:
+            sorted_vals, sort_indices = self._tables[torch.device('cpu')]
+            self._tables[device] = (sorted_vals.to(device), sort_indices.to(device))
+        return self._tables[device]
+
+    def to_class(self, labels):
+        '''Return the [B, K] grid indices of the labels [B, K].'''
+        sorted_vals, sort_indices = self.tables(labels.device)
+        num_vals = torch.tensor(self.num_vals, device=labels.device).unsqueeze(1)
+
+        # Position of each label in its sorted grid
+        labels = labels.T.to(sorted_vals.dtype).contiguous()
+        upper = torch.searchsorted(sorted_vals, labels)
+        upper = torch.minimum(upper, num_vals-1)
+        lower = torch.clamp(upper-1, min=0)
+
+        # Choose the closest of the two neighbouring grid values
+        upper_diff = torch.abs(torch.gather(sorted_vals, 1, upper) - labels)
+        lower_diff = torch.abs(torch.gather(sorted_vals, 1, lower) - labels)
+        nearest = torch.where(lower_diff<upper_diff, lower, upper)
+        nearest_vals = torch.gather(sorted_vals, 1, nearest)
+
+        if not torch.all(torch.isclose(labels, nearest_vals, rtol=self.rtol, atol=self.atol)):
+            raise ValueError('Some of the multimodal labels are not on the grid of class values.')
+
+        # Back to the indices of the unsorted grids
+        return torch.gather(sort_indices, 1, nearest).T
+
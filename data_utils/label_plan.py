@@ -0,0 +1,50 @@
+import numpy as np
+import torch
+
+class LabelPlan:
+
+    """
+    Where to find each column of a [batch, label] label array.
+
+    The plan is compiled once, when the dataset is created, from a list of
+    candidate dataset names for each label (e.g. the survey-prefixed key
+    followed by its 'mg' -> 'alpha' fallback). The first candidate that exists
+    in the store is used and labels without any match are filled with NaN.
+
+    For stores with cheap random access (preloaded or memory-mapped), the
+    resolved columns are stacked into a single [num_samples, label] matrix in
+    shared memory so that the labels of a batch are gathered with one take.
+    """
+
+    def __init__(self, store, candidate_keys):
+
+        self.data_keys = []
+        for candidates in candidate_keys:
+            self.data_keys.append(next((k for k in candidates if k in store), None))
+        self.num_labels = len(self.data_keys)
+
+        self.matrix = None
+        resolved_keys = [k for k in self.data_keys if k is not None]
+        if getattr(store, 'fast_random_access', False) and (len(resolved_keys)>0):
+            self.matrix = self.stack_columns(store)
+
+    def stack_columns(self, store):
+        '''Stack the resolved columns (or NaN) into one shared [num_samples, label] tensor.'''
+        num_samples = store.length(next(k for k in self.data_keys if k is not None))
+        matrix = torch.full((num_samples, self.num_labels), np.nan, dtype=torch.float32)
+        matrix_np = matrix.numpy()
+        for i, k in enumerate(self.data_keys):
+            if k is not None:
+                matrix_np[:,i] = store.read_rows(k, np.arange(num_samples))
+        return matrix.share_memory_()
+
+    def load(self, store, indices):
+        '''Load a [batch, label] array of labels, with NaN for missing labels.'''
+        if self.matrix is not None:
+            return self.matrix.numpy()[np.asarray(indices)]
+
+        labels = np.full((len(indices), self.num_labels), np.nan, dtype=np.float32)
+        for i, k in enumerate(self.data_keys):
+            if k is not None:
+                labels[:,i] = store.read_rows(k, indices)
+        return labels
@@ -0,0 +1,80 @@
+import math
+from itertools import chain
+import torch
+from torch import nn
+
+def conv_out_length(length, kernel_size, stride=1, padding=0, dilation=1, ceil_mode=False):
+    '''Length of the output of a 1D convolution or pooling layer.'''
+    length = (length + 2*padding - dilation*(kernel_size-1) - 1)/stride + 1
+    return math.ceil(length) if ceil_mode else math.floor(length)
+
+def first(value):
+    '''First entry of the 1-tuples that 1D layers store their settings in.'''
+    return value[0] if isinstance(value, (tuple, list)) else value
+
+def propagate_size(in_size, mod):
+    '''
+    Compute the (channels, length) output size of Module `mod` from the
+    layer settings without running the layers. Modules with a
+    `shape_layers` method are propagated through the submodules that it
+    returns (in the order of their forward pass). Raises NotImplementedError
+    for layers that are not supported.
+    '''
+    channels, length = in_size
+    if isinstance(mod, (nn.Sequential, nn.ModuleList)):
+        for layer in mod:
+            channels, length = propagate_size((channels, length), layer)
+    elif isinstance(mod, nn.Conv1d):
+        if mod.padding=='same':
+            padding = None
+        elif mod.padding=='valid':
+            padding = 0
+        else:
+            padding = first(mod.padding)
+        if padding is not None:
+            length = conv_out_length(length, first(mod.kernel_size), first(mod.stride),
+                                     padding, first(mod.dilation))
+        channels = mod.out_channels
+    elif isinstance(mod, nn.MaxPool1d):
+        length = conv_out_length(length, first(mod.kernel_size), first(mod.stride or mod.kernel_size),
+                                 first(mod.padding), first(mod.dilation), mod.ceil_mode)
+    elif isinstance(mod, nn.AvgPool1d):
+        length = conv_out_length(length, first(mod.kernel_size), first(mod.stride or mod.kernel_size),
+                                 first(mod.padding), 1, mod.ceil_mode)
+    elif isinstance(mod, (nn.AdaptiveAvgPool1d, nn.AdaptiveMaxPool1d)):
+        if first(mod.output_size) is not None:
+            length = first(mod.output_size)
+    elif hasattr(mod, 'shape_layers'):
+        for layer in mod.shape_layers():
+            channels, length = propagate_size((channels, length), layer)
+    elif isinstance(mod, (nn.ReLU, nn.GELU, nn.Softplus, nn.Dropout, nn.Identity,
+                          nn.GroupNorm, nn.BatchNorm1d)):
+        # Layers that do not change the size
+        pass
+    else:
+        raise NotImplementedError('No size propagation for %s' % type(mod).__name__)
+    return channels, length
+
+def trace_out_size(in_size, mod):
+    '''
+    Compute output size of Module `mod` by running it on the meta device,
+    which only propagates the shapes.
+    '''
+    state = {name: torch.empty_like(t, device='meta') 
+             for name, t in chain(mod.named_parameters(), mod.named_buffers())}
+    with torch.no_grad():
+        f = torch.func.functional_call(mod, state, (torch.empty(1, *in_size, device='meta'),))
+    return f.size()[1:]
+
+def compute_out_size(in_size, mod, device=None):
+    '''
+    Compute output size of Module `mod` given an input with size `in_size`.
+    
+    The size is propagated through the layer settings, falling back to a
+    trace on the meta device for unsupported layers, so no real compute is
+    done on `device`.
+    '''
+    try:
+        return torch.Size(propagate_size(in_size, mod))
+    except NotImplementedError:
+        return trace_out_size(in_size, mod)
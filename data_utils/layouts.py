@@ -0,0 +1,191 @@
+import numpy as np
+import torch
+
+from chunks import BatchChunkSampler
+
+class FullSpectrumLayout:
+
+    """
+    Samples made of the full (optionally augmented) spectrum followed by the
+    label arrays, e.g. {'spectrum', 'multimodal labels', 'unimodal labels'}
+    or {'spectrum', 'labels'}.
+    """
+
+    # The augmentations are applied to each sample by the workers
+    batch_augment = False
+
+    def __init__(self, augmenter=None):
+        self.augmenter = augmenter
+
+    def setup(self, num_pixels):
+        pass
+
+    def __call__(self, spectrum, labels, channel_valid=None):
+        if self.augmenter is not None:
+            spectrum = self.augmenter(spectrum)
+        else:
+            spectrum = torch.from_numpy(spectrum.astype(np.float32))
+        return {'spectrum':spectrum, **labels}
+
+class ChunkedLayout:
+
+    """
+    Samples for the self-supervised (SS) training: the full spectrum and a
+    random chunk from one of its channels, each augmented by a TaskAugmenter
+    with their task labels.
+
+    In `inference_mode` only the full spectrum is returned, without
+    augmentations. If a `batch_augmenter` is given, the chunk selection and
+    the augmentations are left to augment_batch, which is applied to whole
+    collated batches (on any device).
+    """
+
+    def __init__(self, wave_grid, channel_indices, chunk_size=None, overlap=0.5,
+                 random_chunk=False, std_min=0.01, augmenter=None,
+                 inference_mode=False, batch_augmenter=None):
+        self.wave_grid = wave_grid
+        self.channel_indices = channel_indices
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.random_chunk = random_chunk
+        self.std_min = std_min
+        self.augmenter = augmenter
+        self.inference_mode = inference_mode
+        self.batch_augmenter = batch_augmenter
+        self.batch_augment = batch_augmenter is not None
+
+    def setup(self, num_pixels):
+        '''Determine the chunks to choose from once the number of pixels is known.'''
+        self.num_pixels = num_pixels
+        if self.chunk_size is None:
+            self.chunk_size = num_pixels
+
+        # Determine starting pixel indices to choose chunks from
+        self.starting_indices = self.determine_starting_indices()
+
+        if self.batch_augment:
+            # The chunk selection is applied to whole batches by augment_batch
+            self.chunk_sampler = BatchChunkSampler(self.wave_grid, self.channel_indices, self.chunk_size,
+                                                   overlap=self.overlap, random_chunk=self.random_chunk,
+                                                   std_min=self.std_min)
+
+    def determine_starting_indices(self):
+
+        channel_starts = self.channel_indices
+        channel_ends = channel_starts[1:] + [self.num_pixels]
+
+        # Only grab chunks that are entirely within a single channel
+        starting_indices = []
+        for start_i, end_i in zip(channel_starts, channel_ends):
+            starting_indices.append(np.arange(0,
+                                              end_i-start_i-self.chunk_size,
+                                              self.chunk_size*(1-self.overlap)).astype(int))
+        return starting_indices
+
+    def select_random_chunk(self, spectrum, wave_grid, starting_indices, pixel_indx):
+
+        # Select one channel
+        if len(spectrum)>1:
+            channel_num = np.random.randint(len(spectrum))
+        else:
+            channel_num = 0
+        wave_grid = wave_grid[channel_num]
+        starting_indices = starting_indices[channel_num]
+        spectrum = np.copy(spectrum[channel_num])
+        pixel_indx = pixel_indx[channel_num]
+
+        if self.random_chunk:
+            # Select random chunk from this channel
+            start_indx = np.random.choice(starting_indices)
+        else:
+            start_indx = 0
+        pixel_indx += start_indx
+
+        # Select chunk of the spectrum
+        spectrum = spectrum[start_indx:start_indx+self.chunk_size]
+        wave_grid = wave_grid[start_indx:start_indx+self.chunk_size]
+
+        # Determine centre of the wavelength range
+        centre_wave = np.median(wave_grid)
+
+        return spectrum, centre_wave, pixel_indx
+
+    def augment_batch(self, batch):
+        '''
+        Select the chunks and apply the augmentations to a collated batch (on any device)
+        and add the task labels. Only used when the layout has a batch_augmenter.
+        '''
+        # Select random chunks from the un-augmented spectra
+        (spectrum_chunk, batch['chunk index'],
+         centre_wave_chunk, centre_wave_full) = self.chunk_sampler(batch['spectrum'],
+                                                                   batch.pop('channel valid', None))
+
+        batch['spectrum'], batch['task labels full'] = self.batch_augmenter(batch['spectrum'],
+                                                                            centre_wave_full)
+        batch['spectrum chunk'], batch['task labels chunk'] = self.batch_augmenter(spectrum_chunk,
+                                                                                   centre_wave_chunk)
+        return batch
+
+    def __call__(self, spectrum, labels, channel_valid=None):
+
+        if self.inference_mode:
+            # Return full spectrum and target labels without applying augmentations
+            return {'spectrum':torch.from_numpy(spectrum.astype(np.float32)),
+                    **labels,
+                    'spectrum index': 0}
+
+        elif self.batch_augment:
+            # Leave the chunk selection and augmentations to augment_batch
+            sample = {'spectrum':torch.from_numpy(spectrum.astype(np.float32)),
+                      **labels,
+                      'spectrum index': 0}
+            if channel_valid is not None:
+                sample['channel valid'] = torch.from_numpy(channel_valid)
+            return sample
+
+        else:
+            # Select a random chunk and apply augmentations
+
+            # Index of leftmost pixel in each channel
+            pixel_indx = self.channel_indices
+
+            # Split spectrum into channels
+            wave_grid = []
+            spectrum_ = []
+            for i in range(len(pixel_indx)):
+                if i==(len(pixel_indx)-1):
+                    wave_grid.append(self.wave_grid[pixel_indx[i]:])
+                    spectrum_.append(spectrum[pixel_indx[i]:])
+                else:
+                    wave_grid.append(self.wave_grid[pixel_indx[i]:pixel_indx[i+1]])
+                    spectrum_.append(spectrum[pixel_indx[i]:pixel_indx[i+1]])
+            spectrum = spectrum_
+
+            # Remove channels without info
+            if channel_valid is None:
+                channel_valid = [np.std(spec)>self.std_min for spec in spectrum]
+            wave_grid = [wave_grid[i] for i in range(len(spectrum)) if channel_valid[i]]
+            starting_indices = [self.starting_indices[i] for i in range(len(spectrum)) if channel_valid[i]]
+            pixel_indx = [pixel_indx[i] for i in range(len(spectrum)) if channel_valid[i]]
+            spectrum = [spectrum[i] for i in range(len(spectrum)) if channel_valid[i]]
+
+            # Select random chunk in the spectrum
+            spectrum_chunk, centre_wave, chunk_indx = self.select_random_chunk(spectrum,
+                                                                            wave_grid,
+                                                                            starting_indices,
+                                                                            pixel_indx)
+
+            # Apply augmentations and create array of task labels
+            spectrum_chunk, task_labels_chunk = self.augmenter(spectrum_chunk, centre_wave)
+
+            # Apply augmentations to entire spectrum as well
+            spectrum, task_labels_full = self.augmenter(np.concatenate(spectrum),
+                                                        np.mean(wave_grid))
+
+            return {'spectrum':spectrum,
+                    'spectrum chunk':spectrum_chunk,
+                    **labels,
+                    'task labels full':task_labels_full,
+                    'task labels chunk':task_labels_chunk,
+                    'spectrum index': 0,
+                    'chunk index':chunk_indx}
@@ -0,0 +1,146 @@
+import os
+import json
+import numpy as np
+import h5py
+
+from file_handles import contiguous_runs, H5FileManager
+
+# Name of the file describing the columns of a memmap directory
+METADATA_FILE = 'metadata.json'
+
+def column_filename(key):
+    '''File name used for the column `key` (e.g. "APOGEE teff train" -> "APOGEE_teff_train.bin").'''
+    return key.replace(' ', '_').replace('/', '_') + '.bin'
+
+def convert_h5_to_memmap(data_file, out_dir, keys=None, block_size=4096, verbose=True):
+    '''
+    Write each dataset in the HDF5 file `data_file` to its own flat binary
+    file in `out_dir`, along with a metadata file that stores the dtype and
+    shape of each column.
+
+    If `keys` is None every dataset in the file is converted.
+    The arrays are copied `block_size` rows at a time so that the conversion
+    does not need to hold a whole array in memory.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+
+    metadata = {}
+    with h5py.File(data_file, "r") as f:
+        if keys is None:
+            keys = [k for k in f.keys() if isinstance(f[k], h5py.Dataset)]
+        for k in keys:
+            dset = f[k]
+            filename = column_filename(k)
+            if verbose:
+                print('Writing %s %s to %s' % (k, dset.shape, filename))
+            column = np.memmap(os.path.join(out_dir, filename), dtype=dset.dtype,
+                               mode='w+', shape=dset.shape)
+            for start in range(0, dset.shape[0], block_size):
+                stop = min(start+block_size, dset.shape[0])
+                column[start:stop] = dset[start:stop]
+            column.flush()
+            del column
+
+            metadata[k] = {'file': filename,
+                           'dtype': dset.dtype.str,
+                           'shape': list(dset.shape)}
+
+    with open(os.path.join(out_dir, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+class MemmapStore:
+
+    """
+    Reads a directory written by convert_h5_to_memmap, with one flat binary
+    file per column, through np.memmap.
+
+    The reads go through the OS page cache rather than h5py, so they do not
+    need any decompression and are not serialised by the h5py global lock.
+    The store has the same read interface as H5FileManager, except that the
+    maps are read-only: a contiguous range of rows is returned as a view of
+    the map without any copy, so callers must not modify the rows in place.
+    As with the HDF5 handles, the maps are opened lazily in each process.
+    """
+
+    # Random reads of single rows are cheap
+    fast_random_access = True
+
+    def __init__(self, data_dir):
+
+        self.data_file = data_dir
+
+        with open(os.path.join(data_dir, METADATA_FILE)) as f:
+            self.metadata = json.load(f)
+        self.keys = set(self.metadata.keys())
+        self.shapes = {k: tuple(v['shape']) for k, v in self.metadata.items()}
+        # The columns are not chunked
+        self.chunks = {k: None for k in self.keys}
+
+        self._pid = None
+        self._arrays = {}
+
+    def __getstate__(self):
+        # Let each worker map the files itself rather than pickling the arrays
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_arrays'] = {}
+        return state
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def shape(self, key):
+        return self.shapes[key]
+
+    def length(self, key):
+        return self.shapes[key][0]
+
+    def dataset(self, key):
+        '''Return the (cached) np.memmap for `key`.'''
+        pid = os.getpid()
+        if self._pid != pid:
+            self._arrays = {}
+            self._pid = pid
+        if key not in self._arrays:
+            self._arrays[key] = np.memmap(os.path.join(self.data_file, self.metadata[key]['file']),
+                                          dtype=np.dtype(self.metadata[key]['dtype']),
+                                          mode='r', shape=self.shapes[key])
+        return self._arrays[key]
+
+    def chunk_rows(self, key):
+        return 1
+
+    def read_rows(self, key, indices, max_gap=32):
+        '''
+        Read the rows at `indices` from column `key`.
+
+        If `indices` is an ascending run of consecutive rows, a read-only view
+        of the map is returned without copying. Otherwise runs of nearby
+        indices are gathered from contiguous slices of the map (so that the
+        pages are touched in order) into a new array, with the rows in the
+        order they were requested.
+        '''
+        indices = np.asarray(indices)
+        column = self.dataset(key)
+        if len(indices)>0 and np.array_equal(indices, np.arange(indices[0], indices[0]+len(indices))):
+            return column[indices[0]:indices[0]+len(indices)]
+
+        unique_indices, inverse = np.unique(indices, return_inverse=True)
+
+        rows = np.empty((len(unique_indices),)+column.shape[1:], dtype=column.dtype)
+        i = 0
+        for start, stop in contiguous_runs(unique_indices, max_gap):
+            j = np.searchsorted(unique_indices, stop)
+            rows[i:j] = column[start:stop][unique_indices[i:j]-start]
+            i = j
+        return rows[inverse]
+
+    def close(self):
+        self._pid = None
+        self._arrays = {}
+
+def open_data_file(data_file):
+    '''Open a memmap directory with a MemmapStore or an HDF5 file with an H5FileManager.'''
+    if os.path.isdir(data_file):
+        return MemmapStore(data_file)
+    return H5FileManager(data_file)
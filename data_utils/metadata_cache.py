@@ -0,0 +1,136 @@
+import os
+import json
+import tempfile
+import numpy as np
+import h5py
+
+from memmap_store import open_data_file
+from spectrum_stats import file_fingerprint
+
+def streaming_mean_std(dset, block_size=4096):
+    '''
+    Mean and standard deviation of all of the values of an array, read
+    `block_size` rows at a time and combined with Welford's (Chan's) method.
+    '''
+    count = 0
+    mean = 0.
+    m2 = 0.
+    for start in range(0, dset.shape[0], block_size):
+        block = np.asarray(dset[start:start+block_size], dtype=np.float64)
+        block_count = block.size
+        block_mean = np.mean(block)
+        block_m2 = np.sum((block-block_mean)**2)
+
+        delta = block_mean - mean
+        total = count + block_count
+        mean += delta*block_count/total
+        m2 += block_m2 + delta**2*count*block_count/total
+        count = total
+    return mean, np.sqrt(m2/count)
+
+def streaming_unique(dset, block_size=65536):
+    '''Sorted unique values of an array, read `block_size` rows at a time.'''
+    vals = np.array([], dtype=dset.dtype)
+    for start in range(0, dset.shape[0], block_size):
+        vals = np.union1d(vals, np.unique(dset[start:start+block_size]))
+    return vals
+
+class MetadataCache:
+
+    """
+    Summary statistics of the datasets in a data file (HDF5 file or memmap
+    directory) that are needed when building the networks: the grid of unique
+    values of each label and the mean and standard deviation of a dataset.
+
+    Each statistic is computed in a single streaming pass the first time it is
+    requested and saved in the sidecar directory next to the data file, so that
+    later runs only read a few numbers. The cache is cleared whenever the size
+    or modification time of the data file changes.
+
+    Several jobs can share the cache: each update is written to a temporary
+    file and moved into place with os.replace, so a job never reads a
+    partially written cache. (When two jobs save at the same time, the
+    statistic of one of them may be lost and is simply recomputed later.)
+    """
+
+    def __init__(self, data_file):
+
+        self.data_file = data_file
+        self.cache_file = os.path.join(data_file.rstrip('/') + '_stats', 'metadata.h5')
+        self.fingerprint = json.dumps(file_fingerprint(data_file))
+
+        if self.open_cache() is None:
+            try:
+                os.remove(self.cache_file)
+            except FileNotFoundError:
+                # Missing, or already removed by another job
+                pass
+
+    def open_cache(self):
+        '''Open the cache file for reading, or return None if it is missing or stale.'''
+        try:
+            f = h5py.File(self.cache_file, "r")
+        except FileNotFoundError:
+            return None
+        if f.attrs.get('fingerprint', '') != self.fingerprint:
+            f.close()
+            return None
+        return f
+
+    def cached(self, name):
+        '''Return the cached array `name` or None if it has not been computed.'''
+        f = self.open_cache()
+        if f is None:
+            return None
+        with f:
+            if name in f:
+                return f[name][()]
+        return None
+
+    def save(self, name, value):
+        cache_dir = os.path.dirname(self.cache_file)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(suffix='.h5', dir=cache_dir)
+        os.close(fd)
+        try:
+            with h5py.File(tmp_file, "w") as out:
+                out.attrs['fingerprint'] = self.fingerprint
+                # Keep the statistics that are already cached
+                f = self.open_cache()
+                if f is not None:
+                    with f:
+                        for k in f.keys():
+                            f.copy(f[k], out)
+                if name in out:
+                    del out[name]
+                out.create_dataset(name, data=value)
+            os.replace(tmp_file, self.cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+    def unique(self, key):
+        '''Sorted unique values of dataset `key` (e.g. the class grid of a multimodal label).'''
+        vals = self.cached('unique/%s' % key)
+        if vals is None:
+            store = open_data_file(self.data_file)
+            vals = streaming_unique(store.dataset(key))
+            store.close()
+            self.save('unique/%s' % key, vals)
+        return vals
+
+    def mean_std(self, key):
+        '''Mean and standard deviation of all of the values in dataset `key`.'''
+        vals = self.cached('mean std/%s' % key)
+        if vals is None:
+            store = open_data_file(self.data_file)
+            vals = np.array(streaming_mean_std(store.dataset(key)))
+            store.close()
+            self.save('mean std/%s' % key, vals)
+        return float(vals[0]), float(vals[1])
+
+    def mean(self, key):
+        return self.mean_std(key)[0]
+
+    def std(self, key):
+        return self.mean_std(key)[1]
@@ -0,0 +1,146 @@
+import numpy as np
+import torch
+
+def fetch_samples(dataset, indices):
+    '''List of samples for `indices`, read together if the dataset supports it.'''
+    if hasattr(dataset, '__getitems__') and (dataset.__getitems__ is not None):
+        return dataset.__getitems__(indices)
+    return [dataset[i] for i in indices]
+
+class PairedDataset(torch.utils.data.Dataset):
+
+    """
+    Source and target datasets read through a single DataLoader.
+
+    Each index is a (source indices, target indices) pair produced by
+    PairedBatchSampler and the samples of both domains are read by the same
+    worker.
+    """
+
+    def __init__(self, source_dataset, target_dataset):
+        self.source_dataset = source_dataset
+        self.target_dataset = target_dataset
+
+    def __len__(self):
+        return len(self.target_dataset)
+
+    def __getitems__(self, indices):
+        source_indices, target_indices = indices
+        return (fetch_samples(self.source_dataset, source_indices),
+                fetch_samples(self.target_dataset, target_indices))
+
+class PairedBatchSampler(torch.utils.data.Sampler):
+
+    """
+    Yields (source indices, target indices) batches. One pass goes through the
+    target sampler once while the source sampler is cycled, continuing where it
+    left off in the previous pass rather than starting over.
+    """
+
+    def __init__(self, source_sampler, target_sampler, batch_size):
+        self.source_sampler = source_sampler
+        self.target_sampler = target_sampler
+        self.batch_size = batch_size
+        self.source_batches = None
+
+    def __len__(self):
+        return int(np.ceil(len(self.target_sampler)/self.batch_size))
+
+    def batches(self, sampler):
+        '''Split one pass of a sampler into lists of batch_size indices.'''
+        batch = []
+        for idx in sampler:
+            batch.append(idx)
+            if len(batch)==self.batch_size:
+                yield batch
+                batch = []
+        if len(batch)>0:
+            yield batch
+
+    def cycle_source(self):
+        while True:
+            yield from self.batches(self.source_sampler)
+
+    def __iter__(self):
+        if self.source_batches is None:
+            self.source_batches = self.cycle_source()
+        for target_indices in self.batches(self.target_sampler):
+            yield next(self.source_batches), target_indices
+
+class PairedCollate:
+
+    """Collates the source and target samples of a batch separately."""
+
+    def __init__(self, source_collate=None, target_collate=None):
+        self.source_collate = source_collate or torch.utils.data.default_collate
+        self.target_collate = target_collate or torch.utils.data.default_collate
+
+    def __call__(self, samples):
+        source_samples, target_samples = samples
+        return self.source_collate(source_samples), self.target_collate(target_samples)
+
+def paired_dataloader(source_dataset, target_dataset, batch_size,
+                      source_sampler=None, target_sampler=None,
+                      source_collate=None, target_collate=None,
+                      num_workers=3, pin_memory=True):
+    '''
+    DataLoader that yields (source batch, target batch) pairs from a single
+    pool of persistent workers. Each pass goes through the target dataset once.
+    '''
+    if source_sampler is None:
+        source_sampler = torch.utils.data.RandomSampler(source_dataset)
+    if target_sampler is None:
+        target_sampler = torch.utils.data.RandomSampler(target_dataset)
+
+    return torch.utils.data.DataLoader(PairedDataset(source_dataset, target_dataset),
+                                       batch_sampler=PairedBatchSampler(source_sampler,
+                                                                        target_sampler,
+                                                                        batch_size),
+                                       collate_fn=PairedCollate(source_collate, target_collate),
+                                       num_workers=num_workers,
+                                       pin_memory=pin_memory,
+                                       persistent_workers=num_workers>0)
+
+def pair_transform(source_transform=None, target_transform=None):
+    '''Apply separate transforms to the source and target batches of a pair.'''
+    if (source_transform is None) and (target_transform is None):
+        return None
+    def transform(batches):
+        source_batch, target_batch = batches
+        if source_transform is not None:
+            source_batch = source_transform(source_batch)
+        if target_transform is not None:
+            target_batch = target_transform(target_batch)
+        return source_batch, target_batch
+    return transform
+
+class CyclePairs:
+
+    """
+    (source batch, target batch) pairs from two separate loaders (e.g. the
+    prefetchers of two streaming datasets). One pass goes through the target
+    loader once while the source loader is cycled, continuing where it left
+    off in the previous pass rather than starting over.
+    """
+
+    def __init__(self, source_loader, target_loader):
+        self.source_loader = source_loader
+        self.target_loader = target_loader
+        self.source_batches = None
+
+    def __len__(self):
+        return len(self.target_loader)
+
+    @property
+    def wait_time(self):
+        return self.source_loader.wait_time + self.target_loader.wait_time
+
+    def cycle_source(self):
+        while True:
+            yield from self.source_loader
+
+    def __iter__(self):
+        if self.source_batches is None:
+            self.source_batches = self.cycle_source()
+        for target_batch in self.target_loader:
+            yield next(self.source_batches), target_batch
@@ -0,0 +1,122 @@
+import time
+import queue
+import threading
+import torch
+
+class DevicePrefetcher:
+
+    """
+    Wraps a DataLoader so that the next batches are loaded, moved to the
+    device (and optionally transformed, e.g. augmented) on a background
+    thread while the current batch is being used.
+
+    On GPUs the copies are non-blocking copies from pinned memory made on a
+    separate CUDA stream, and the training stream only waits for the copy of
+    the batch that it is about to use. On the CPU the thread still overlaps
+    the loading and collation of the next batch with the current step.
+
+    The total time that the loop spent waiting for batches is kept in
+    `wait_time`.
+    """
+
+    def __init__(self, dataloader, device, queue_size=2, transform=None):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.queue_size = queue_size
+        self.transform = transform
+        self.wait_time = 0.
+        # Tensors for the Python scalars in the batches
+        self.scalar_cache = {}
+        if self.device.type=='cuda':
+            self.stream = torch.cuda.Stream(self.device)
+        else:
+            self.stream = None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def to_device(self, x):
+        '''Move a (nested) batch to the device without blocking.'''
+        if isinstance(x, torch.Tensor):
+            if (self.stream is not None) and not x.is_pinned():
+                x = x.pin_memory()
+            return x.to(self.device, non_blocking=True)
+        elif isinstance(x, dict):
+            return {k: self.to_device(v) for k, v in x.items()}
+        elif isinstance(x, (list, tuple)):
+            return type(x)(self.to_device(v) for v in x)
+        elif isinstance(x, (bool, int, float)):
+            key = (type(x), x)
+            if key not in self.scalar_cache:
+                self.scalar_cache[key] = torch.tensor(x).to(self.device)
+            return self.scalar_cache[key]
+        return x
+
+    def put(self, out_queue, item, stop):
+        '''Wait for space in the queue unless the loop has stopped. Return whether `item` was queued.'''
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def load(self, out_queue, stop):
+        '''Fill the queue with batches on the device (runs on the background thread).'''
+        try:
+            for batch in self.dataloader:
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = self.to_device(batch)
+                        if self.transform is not None:
+                            batch = self.transform(batch)
+                        ready = torch.cuda.Event()
+                        ready.record(self.stream)
+                else:
+                    batch = self.to_device(batch)
+                    if self.transform is not None:
+                        batch = self.transform(batch)
+                    ready = None
+
+                if not self.put(out_queue, (batch, ready), stop):
+                    return
+        except Exception as e:
+            self.put(out_queue, (e, None), stop)
+            return
+        self.put(out_queue, (StopIteration, None), stop)
+
+    def record_stream(self, x):
+        '''Mark tensors created on the copy stream as used by the current stream.'''
+        if isinstance(x, torch.Tensor):
+            x.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(x, dict):
+            for v in x.values():
+                self.record_stream(v)
+        elif isinstance(x, (list, tuple)):
+            for v in x:
+                self.record_stream(v)
+
+    def __iter__(self):
+        out_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.load, args=(out_queue, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start_time = time.time()
+                batch, ready = out_queue.get()
+                if batch is StopIteration:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                if ready is not None:
+                    # Only wait for the copy of this batch
+                    torch.cuda.current_stream(self.device).wait_event(ready)
+                    self.record_stream(batch)
+                self.wait_time += time.time() - start_time
+                yield batch
+        finally:
+            # Stop the thread if the loop exits early
+            stop.set()
+            thread.join()
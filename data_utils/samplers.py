@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+
+def chunk_aligned_block_size(h5, key, min_block_size=256):
+    '''
+    Smallest multiple of the number of rows in each HDF5 chunk of `key`
+    that is at least `min_block_size`.
+    '''
+    chunk_rows = h5.chunk_rows(key)
+    return int(np.ceil(min_block_size/chunk_rows)*chunk_rows)
+
+class BlockShuffleSampler(torch.utils.data.Sampler):
+
+    """
+    Shuffles a dataset in contiguous blocks of indices.
+
+    The order of the blocks is shuffled and the indices within each block are
+    shuffled, so consecutive samples (and therefore each batch) come from one
+    or two blocks of the file. When the blocks are aligned with the HDF5
+    chunks this turns a random shuffle into mostly sequential reads.
+    """
+
+    def __init__(self, num_samples, block_size=256, generator=None):
+        self.num_samples = num_samples
+        self.block_size = block_size
+        self.generator = generator
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        if self.generator is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+        else:
+            generator = self.generator
+
+        num_blocks = int(np.ceil(self.num_samples/self.block_size))
+        for block in torch.randperm(num_blocks, generator=generator).tolist():
+            start = block*self.block_size
+            stop = min(start+self.block_size, self.num_samples)
+            yield from (start + torch.randperm(stop-start, generator=generator)).tolist()
+
+def block_shuffle_sampler(dataset, min_block_size=256):
+    '''Create a BlockShuffleSampler aligned with the HDF5 chunks of a SpectraDataset.'''
+    block_size = chunk_aligned_block_size(dataset.h5, 'spectra %s' % dataset.dataset, 
+                                          min_block_size)
+    return BlockShuffleSampler(len(dataset), block_size)
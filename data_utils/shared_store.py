@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+
+class SharedMemoryStore:
+
+    """
+    Holds the spectra and label columns of one dataset split in shared memory.
+
+    The arrays are loaded once, in the process that creates the store, into
+    torch tensors that live in shared memory. DataLoader workers (forked or
+    spawned) map the same memory instead of holding their own copy, so the
+    whole dataset is only in RAM once.
+
+    The spectra are clipped at -1 and, if `continua_key` is given, divided by
+    their continua while loading so that this is only done once.
+    The store has the same read interface as H5FileManager.
+    """
+
+    # Random reads of single rows are cheap
+    fast_random_access = True
+
+    def __init__(self, h5, spectra_key, column_keys, continua_key=None, block_size=4096):
+
+        self.tensors = {}
+
+        # Fill the shared block a few thousand spectra at a time to
+        # keep the peak memory close to a single copy of the spectra
+        num_spectra = h5.length(spectra_key)
+        spectra = torch.empty(h5.shape(spectra_key), dtype=torch.float32).share_memory_()
+        spectra_np = spectra.numpy()
+        for start in range(0, num_spectra, block_size):
+            stop = min(start+block_size, num_spectra)
+            block = h5.dataset(spectra_key)[start:stop].astype(np.float32)
+            block[block<-1] = -1.
+            if continua_key is not None:
+                block /= h5.dataset(continua_key)[start:stop]
+            spectra_np[start:stop] = block
+        self.tensors[spectra_key] = spectra
+
+        # Label columns
+        for k in column_keys:
+            column = torch.from_numpy(h5.dataset(k)[:].astype(np.float32))
+            self.tensors[k] = column.share_memory_()
+
+        self.keys = set(self.tensors.keys())
+
+        # The workers will open their own handles if they need them
+        h5.close()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def shape(self, key):
+        return tuple(self.tensors[key].shape)
+
+    def length(self, key):
+        return self.tensors[key].shape[0]
+
+    def read_rows(self, key, indices):
+        '''Return a copy of the rows at `indices` from array `key`.'''
+        return self.tensors[key].numpy()[np.asarray(indices)]
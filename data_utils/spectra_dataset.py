@@ -0,0 +1,163 @@
+import numpy as np
+import torch
+
+from memmap_store import open_data_file
+from shared_store import SharedMemoryStore
+from label_plan import LabelPlan
+from spectrum_stats import load_spectrum_stats
+
+def batch_to_device(batch, device):
+    for k in batch.keys():
+        if isinstance(batch[k], list):
+            for i in range(len(batch[k])):
+                batch[k][i] = batch[k][i].to(device)
+        else:
+            try:
+                batch[k] = batch[k].to(device)
+            except AttributeError:
+                batch[k] = torch.tensor(batch[k]).to(device)
+    return batch
+
+def label_candidates(label_keys, dataset, label_survey=None, fallback=None):
+    '''
+    Candidate dataset names for each label: the (survey-prefixed) key of the
+    split followed by `fallback(data_key)` when it returns a name.
+    '''
+    candidate_keys = []
+    for k in label_keys:
+        data_key = k + ' %s' % dataset
+        if label_survey is not None:
+            data_key = label_survey + ' ' + data_key
+        candidates = [data_key]
+        if fallback is not None:
+            alternative = fallback(data_key)
+            if alternative is not None:
+                candidates.append(alternative)
+        candidate_keys.append(candidates)
+    return candidate_keys
+
+class BaseSpectraDataset(torch.utils.data.Dataset):
+
+    """
+    Spectra and labels of one split of a data file, shared by all of the
+    model families.
+
+    The storage backend is chosen from the arguments: the HDF5 file or
+    memmap directory is read directly (see open_data_file), or the split is
+    preloaded into shared memory. The spectra and labels of a batch are read
+    together and each sample is then (median) normalized and turned into a
+    sample dict by the `layout` (e.g. FullSpectrumLayout or ChunkedLayout),
+    which applies its augmentation pipeline.
+
+    `label_keys` maps each label array of the samples (e.g. 'multimodal
+    labels') to the candidate dataset names of its labels (see
+    label_candidates).
+    """
+
+    def __init__(self, data_file, dataset, label_keys, layout,
+                 continuum_normalize=False, divide_by_median=False, median_thresh=0.,
+                 std_min=0.01, preload=False, use_stats=False, stats_channel_indices=[0]):
+
+        self.data_file = data_file
+        self.dataset = dataset.lower()
+        # Persistent per-worker file handle (HDF5 file or memmap directory)
+        self.h5 = open_data_file(data_file)
+        self.layout = layout
+        self.continuum_normalize = continuum_normalize
+        self.divide_by_median = divide_by_median
+        self.median_thresh = median_thresh
+        self.std_min = std_min
+        self.preload = preload
+        self.use_stats = use_stats
+
+        # Source of the spectra and labels
+        if self.preload:
+            self.store = self.preload_data()
+        else:
+            self.store = self.h5
+
+        if self.use_stats:
+            # Precomputed medians and channel standard deviations
+            self.stats = load_spectrum_stats(self.data_file, self.dataset,
+                                             self.continuum_normalize, self.divide_by_median,
+                                             self.median_thresh, stats_channel_indices)
+
+        # Resolve the dataset name of each label once
+        self.label_plans = {name: LabelPlan(self.store, candidates)
+                            for name, candidates in label_keys.items()}
+
+        # Determine the number of pixels in each spectrum
+        self.num_pixels = self.determine_num_pixels()
+        self.layout.setup(self.num_pixels)
+
+    def __len__(self):
+        return self.h5.length('spectra %s' % self.dataset)
+
+    @property
+    def batch_augment(self):
+        return self.layout.batch_augment
+
+    def determine_num_pixels(self):
+        return self.h5.shape('spectra %s' % self.dataset)[1]
+
+    def preload_data(self):
+        '''Load this split into shared memory, clipping and continuum normalizing the spectra once.'''
+        column_keys = [k for k, shape in self.h5.shapes.items()
+                       if k.endswith(' %s' % self.dataset) and len(shape)==1]
+        if self.continuum_normalize:
+            continua_key = 'continua %s' % self.dataset
+        else:
+            continua_key = None
+        return SharedMemoryStore(self.h5, 'spectra %s' % self.dataset,
+                                 column_keys, continua_key)
+
+    def load_batch(self, indices):
+        '''Load the spectra and labels of a batch of samples using contiguous range reads.'''
+
+        # Load spectra
+        spectra = self.store.read_rows('spectra %s' % self.dataset, indices)
+        if not self.preload:
+            # (The preloaded spectra have already been clipped and normalized)
+            # (Not in place, since a memmap store can return a view of the file)
+            spectra = np.maximum(spectra, -1.)
+
+            if self.continuum_normalize:
+                # Divide spectra by their estimated continua
+                spectra = spectra/self.h5.read_rows('continua %s' % self.dataset, indices)
+
+        # Load target stellar labels
+        labels = {name: plan.load(self.store, indices) for name, plan in self.label_plans.items()}
+
+        return spectra, labels
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+
+        # Read the whole batch at once and then process each sample
+        spectra, labels = self.load_batch(indices)
+        if self.use_stats:
+            # Look up the precomputed statistics instead of recomputing them
+            medians = self.stats['median'][indices]
+            channel_valid = self.stats['channel std'][indices]>self.std_min
+        else:
+            medians = [None]*len(indices)
+            channel_valid = [None]*len(indices)
+        return [self.process_sample(spectra[i], {name: l[i] for name, l in labels.items()},
+                                    medians[i], channel_valid[i]) for i in range(len(indices))]
+
+    def process_sample(self, spectrum, labels, median=None, channel_valid=None):
+
+        if self.divide_by_median:
+            # Divide spectrum by its median to centre it around 1
+            if median is None:
+                median = np.median(spectrum[spectrum>self.median_thresh])
+            spectrum = spectrum/median
+
+        labels = {name: torch.from_numpy(l) for name, l in labels.items()}
+        return self.layout(spectrum, labels, channel_valid)
+
+    def augment_batch(self, batch):
+        '''Apply the batch augmentations of the layout (if it has any) to a collated batch.'''
+        return self.layout.augment_batch(batch)
@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+import h5py
+import torch
+
+from memmap_store import open_data_file
+from augmentations import batch_snr
+
+def file_fingerprint(data_file):
+    '''Identify the contents of an HDF5 file or memmap directory by the size and modification time of its files.'''
+    if os.path.isdir(data_file):
+        filenames = sorted(os.listdir(data_file))
+        paths = [os.path.join(data_file, fn) for fn in filenames]
+    else:
+        filenames = [os.path.basename(data_file)]
+        paths = [data_file]
+    return [(fn, os.stat(p).st_size, os.stat(p).st_mtime_ns) for fn, p in zip(filenames, paths)]
+
+def stats_filename(data_file, continuum_normalize, divide_by_median, median_thresh, channel_indices):
+    '''Sidecar file for the statistics of `data_file` under one set of preprocessing options.'''
+    options = {'fingerprint': file_fingerprint(data_file),
+               'continuum_normalize': bool(continuum_normalize),
+               'divide_by_median': bool(divide_by_median),
+               'median_thresh': float(median_thresh),
+               'channel_indices': [int(i) for i in channel_indices]}
+    key = hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(data_file.rstrip('/') + '_stats', 'stats_%s.h5' % key)
+
+def block_stats(data_file, dataset, start, stop, continuum_normalize, divide_by_median,
+                median_thresh, channel_indices):
+    '''
+    Per-spectrum median, per-channel standard deviation and snr of spectra
+    [start, stop), after the same preprocessing that SpectraDataset applies.
+    '''
+    store = open_data_file(data_file)
+    spectra = store.dataset('spectra %s' % dataset)[start:stop].astype(np.float32)
+    spectra[spectra<-1] = -1.
+    if continuum_normalize:
+        spectra = spectra/store.dataset('continua %s' % dataset)[start:stop]
+    store.close()
+
+    # Median of the pixels above the threshold
+    medians = np.nanmedian(np.where(spectra>median_thresh, spectra, np.nan), axis=1).astype(np.float32)
+    if divide_by_median:
+        spectra = spectra/medians[:,np.newaxis]
+
+    channel_ends = list(channel_indices[1:]) + [spectra.shape[1]]
+    channel_std = np.stack([np.std(spectra[:,start_i:end_i], axis=1) for start_i, end_i
+                            in zip(channel_indices, channel_ends)], axis=1).astype(np.float32)
+    snr = batch_snr(torch.from_numpy(spectra)).numpy()
+
+    return dataset, start, stop, medians, channel_std, snr
+
+def _block_stats(args):
+    return block_stats(*args)
+
+def _init_worker():
+    # Each process handles its own block
+    torch.set_num_threads(1)
+
+def compute_spectrum_stats(data_file, datasets=['train', 'val'], continuum_normalize=True,
+                           divide_by_median=True, median_thresh=0., channel_indices=[0],
+                           num_workers=None, block_size=2048, verbose=True):
+    '''
+    Compute the statistics of every spectrum in `datasets` and write them to
+    the sidecar file of this data file and set of preprocessing options.
+
+    The blocks of spectra are processed in parallel by `num_workers`
+    processes. Each finished block is marked in the sidecar so that an
+    interrupted run picks up where it left off.
+    '''
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    stats_file = stats_filename(data_file, continuum_normalize, divide_by_median,
+                                median_thresh, channel_indices)
+    os.makedirs(os.path.dirname(stats_file), exist_ok=True)
+
+    store = open_data_file(data_file)
+    with h5py.File(stats_file, "a") as f:
+        f.attrs['data_file'] = os.path.abspath(data_file)
+        f.attrs['continuum_normalize'] = continuum_normalize
+        f.attrs['divide_by_median'] = divide_by_median
+        f.attrs['median_thresh'] = median_thresh
+        f.attrs['channel_indices'] = channel_indices
+        # Keep the blocks of a resumed run the same as before
+        if 'block_size' in f.attrs:
+            block_size = int(f.attrs['block_size'])
+        f.attrs['block_size'] = block_size
+
+        tasks = []
+        for dataset in datasets:
+            num_spectra = store.length('spectra %s' % dataset)
+            num_blocks = int(np.ceil(num_spectra/block_size))
+            if 'median %s' % dataset not in f:
+                f.create_dataset('median %s' % dataset, (num_spectra,), dtype=np.float32)
+                f.create_dataset('channel std %s' % dataset, (num_spectra, len(channel_indices)),
+                                 dtype=np.float32)
+                f.create_dataset('snr %s' % dataset, (num_spectra,), dtype=np.float32)
+                f.create_dataset('done %s' % dataset, data=np.zeros(num_blocks, dtype=bool))
+            # Only the blocks that have not been finished yet
+            done = f['done %s' % dataset][:]
+            for b in np.where(~done)[0]:
+                tasks.append((data_file, dataset, b*block_size, min((b+1)*block_size, num_spectra),
+                              continuum_normalize, divide_by_median, median_thresh, channel_indices))
+        store.close()
+
+        if verbose:
+            print('Computing the statistics of %i blocks of spectra...' % len(tasks))
+        with multiprocessing.Pool(num_workers, initializer=_init_worker) as pool:
+            for i, (dataset, start, stop, 
+                    medians, channel_std, snr) in enumerate(pool.imap_unordered(_block_stats, tasks)):
+                f['median %s' % dataset][start:stop] = medians
+                f['channel std %s' % dataset][start:stop] = channel_std
+                f['snr %s' % dataset][start:stop] = snr
+                f['done %s' % dataset][start//block_size] = True
+                f.flush()
+                if verbose and ((i+1) % 100 == 0):
+                    print('\t%i/%i blocks' % (i+1, len(tasks)))
+
+    return stats_file
+
+def stats_complete(data_file, dataset, continuum_normalize, divide_by_median,
+                   median_thresh=0., channel_indices=[0]):
+    '''Whether the sidecar file has the statistics of every spectrum in one dataset split.'''
+    stats_file = stats_filename(data_file, continuum_normalize, divide_by_median,
+                                median_thresh, channel_indices)
+    if not os.path.exists(stats_file):
+        return False
+    with h5py.File(stats_file, "r") as f:
+        return ('done %s' % dataset in f) and bool(f['done %s' % dataset][:].all())
+
+def load_spectrum_stats(data_file, dataset, continuum_normalize, divide_by_median,
+                        median_thresh=0., channel_indices=[0]):
+    '''
+    Load the statistics of one dataset split, computing (or finishing)
+    the sidecar file first if needed.
+    '''
+    stats_file = stats_filename(data_file, continuum_normalize, divide_by_median,
+                                median_thresh, channel_indices)
+    if not stats_complete(data_file, dataset, continuum_normalize, divide_by_median,
+                          median_thresh, channel_indices):
+        print('Computing the spectrum statistics of %s...' % data_file)
+        compute_spectrum_stats(data_file, [dataset], continuum_normalize, divide_by_median,
+                               median_thresh, channel_indices)
+
+    with h5py.File(stats_file, "r") as f:
+        return {k: f['%s %s' % (k, dataset)][:] for k in ['median', 'channel std', 'snr']}
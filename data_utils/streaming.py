@@ -0,0 +1,228 @@
+import time
+import glob
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from memmap_store import open_data_file
+from spectrum_stats import stats_complete
+
+def stream_position():
+    '''
+    Index and total number of (rank, DataLoader worker) pairs reading the
+    stream, along with the shared seed of the current DataLoader iterator.
+    '''
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        rank = torch.distributed.get_rank()
+        world_size = torch.distributed.get_world_size()
+    else:
+        rank = 0
+        world_size = 1
+
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is None:
+        worker_id = 0
+        num_workers = 1
+        base_seed = None
+    else:
+        worker_id = worker_info.id
+        num_workers = worker_info.num_workers
+        # All of the workers of one iterator share this seed
+        base_seed = worker_info.seed - worker_info.id
+
+    return rank*num_workers + worker_id, world_size*num_workers, base_seed
+
+def shard_units(shard_lengths, block_size):
+    '''Split each shard into (shard index, start, stop) blocks of contiguous rows.'''
+    units = []
+    for i, n in enumerate(shard_lengths):
+        for start in range(0, n, block_size):
+            units.append((i, start, min(start+block_size, n)))
+    return units
+
+def assign_units(units, position, num_positions, seed):
+    '''
+    Shuffle the units with a seed that every worker and rank agrees on and
+    give each position an interleaved, non-overlapping subset of them.
+    '''
+    order = np.random.default_rng(seed).permutation(len(units))
+    return [units[i] for i in order[position::num_positions]]
+
+class ShuffleBuffer:
+
+    """
+    Bounded shuffle buffer for approximate random ordering of a stream.
+
+    Samples are added until the buffer holds `size` of them. After that each
+    new sample replaces a random sample in the buffer, which is returned.
+    The throughput and the fill of the buffer are printed every
+    `report_every` samples (0 to disable).
+    """
+
+    def __init__(self, size, seed=None, report_every=0, name=''):
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.report_every = report_every
+        self.name = name
+        self.buffer = []
+        self.num_yielded = 0
+        self.start_time = time.time()
+
+    def report(self):
+        self.num_yielded += 1
+        if (self.report_every>0) and (self.num_yielded % self.report_every == 0):
+            rate = self.num_yielded / (time.time() - self.start_time)
+            print('%s%i spectra streamed (%0.1f spectra/s), shuffle buffer %i/%i' %
+                  (self.name, self.num_yielded, rate, len(self.buffer), self.size))
+
+    def push(self, sample):
+        '''Add a sample and return a random sample once the buffer is full (otherwise None).'''
+        if len(self.buffer) < self.size:
+            self.buffer.append(sample)
+            return None
+        i = self.rng.integers(self.size)
+        out = self.buffer[i]
+        self.buffer[i] = sample
+        self.report()
+        return out
+
+    def drain(self):
+        '''Return the remaining samples in a random order.'''
+        self.rng.shuffle(self.buffer)
+        while len(self.buffer)>0:
+            self.report()
+            yield self.buffer.pop()
+
+class StreamingDataset(torch.utils.data.IterableDataset):
+
+    """
+    Streaming version of a spectra dataset for datasets split across many
+    files (shards) that are too large to shuffle globally.
+
+    The shards are split into blocks of contiguous spectra, which are
+    shuffled and divided between the DataLoader workers (and distributed
+    ranks) without overlap. Each worker reads its blocks in order and mixes
+    the samples with a bounded shuffle buffer. The samples are processed by a
+    `dataset_class` dataset for each shard (set by the subclass of each model
+    family), so the preprocessing, chunk selection and augmentations are the
+    same as for the map-style dataset.
+
+    Each worker keeps the datasets of at most `max_open_shards` shards, and
+    drops a shard's dataset once all of its blocks have been read. The
+    shards cannot be preloaded, and with `use_stats` their statistics
+    sidecars have to be computed beforehand (see compute_spectrum_stats.py).
+
+    `data_file` can be a glob pattern or a list of HDF5 files / memmap directories.
+    The remaining arguments are passed to `dataset_class`.
+    """
+
+    # Map-style dataset used to read each shard
+    dataset_class = None
+
+    def __init__(self, data_file, dataset, buffer_size=1024, shard_block_size=1024,
+                 report_every=10000, seed=0, max_open_shards=4, **kwargs):
+
+        if isinstance(data_file, str):
+            self.shards = sorted(glob.glob(data_file))
+        else:
+            self.shards = list(data_file)
+        if len(self.shards)==0:
+            raise FileNotFoundError('No shards found matching %s' % data_file)
+        self.dataset = dataset
+        self.buffer_size = buffer_size
+        self.shard_block_size = shard_block_size
+        self.report_every = report_every
+        self.seed = seed
+        self.epoch = 0
+        self.max_open_shards = max_open_shards
+        self.kwargs = kwargs
+        if kwargs.get('preload', False):
+            raise ValueError('The shards of a StreamingDataset cannot be preloaded.')
+
+        # Number of spectra and pixels in each shard
+        self.shard_lengths = []
+        for shard in self.shards:
+            h5 = open_data_file(shard)
+            self.shard_lengths.append(h5.length('spectra %s' % dataset.lower()))
+            self.num_pixels = h5.shape('spectra %s' % dataset.lower())[1]
+            h5.close()
+
+        if kwargs.get('use_stats', False):
+            # The statistics cannot be computed in parallel from within the DataLoader workers
+            missing = [shard for shard in self.shards
+                       if not stats_complete(shard, dataset.lower(), **self.stats_options())]
+            if len(missing)>0:
+                raise FileNotFoundError('The spectrum statistics of %i shards (e.g. %s) have not been '
+                                        'computed. Run compute_spectrum_stats.py on each shard first.' % 
+                                        (len(missing), missing[0]))
+
+        self.shard_datasets = OrderedDict()
+        self.batch_augment = kwargs.get('batch_augment', False)
+        # Layout used to augment the collated batches in the main process
+        self.batch_layout = None
+
+    def __len__(self):
+        return sum(self.shard_lengths)
+
+    def build_layout(self):
+        '''Layout of the samples of each shard (set by the subclass of each model family).'''
+        raise NotImplementedError
+
+    def stats_options(self):
+        '''Preprocessing options of the statistics sidecars of the shards (see stats_filename).'''
+        raise NotImplementedError
+
+    def augment_batch(self, batch):
+        '''See BaseSpectraDataset.augment_batch.'''
+        if self.batch_layout is None:
+            self.batch_layout = self.build_layout()
+            self.batch_layout.setup(self.num_pixels)
+        return self.batch_layout.augment_batch(batch)
+
+    def set_epoch(self, epoch):
+        '''Change the order of the blocks (needed for distributed training).'''
+        self.epoch = epoch
+
+    def shard_dataset(self, i):
+        '''Dataset of shard i, created when it is needed and not already open.'''
+        if i in self.shard_datasets:
+            self.shard_datasets.move_to_end(i)
+        else:
+            self.shard_datasets[i] = self.dataset_class(self.shards[i], self.dataset, **self.kwargs)
+            if len(self.shard_datasets)>self.max_open_shards:
+                # Drop the least recently read shard
+                self.shard_datasets.popitem(last=False)
+        return self.shard_datasets[i]
+
+    def __iter__(self):
+
+        position, num_positions, base_seed = stream_position()
+        if (base_seed is None) or torch.distributed.is_initialized():
+            # The ranks do not share a DataLoader seed
+            base_seed = self.seed
+        # (persistent workers keep their seed, so the epoch also changes the order)
+        base_seed += self.epoch
+        self.epoch += 1
+
+        # Blocks of spectra read by this worker
+        units = assign_units(shard_units(self.shard_lengths, self.shard_block_size),
+                             position, num_positions, base_seed)
+
+        # Number of blocks left to read from each shard
+        units_left = np.bincount([i for i, start, stop in units], minlength=len(self.shards))
+
+        buffer = ShuffleBuffer(self.buffer_size, seed=base_seed+position, 
+                               report_every=self.report_every,
+                               name='[stream %i/%i] ' % (position, num_positions))
+        for i, start, stop in units:
+            # Read and process a whole block at once
+            samples = self.shard_dataset(i).__getitems__(np.arange(start, stop))
+            units_left[i] -= 1
+            if units_left[i]==0:
+                # Drop the dataset of a shard once all of its blocks have been read
+                self.shard_datasets.pop(i)
+            for sample in samples:
+                out = buffer.push(sample)
+                if out is not None:
+                    yield out
+        yield from buffer.drain()
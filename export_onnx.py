@@ -0,0 +1,138 @@
+import os
+# Directory of export script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'data_utils'))
+sys.path.append(os.path.join(cur_dir,'onnx_utils'))
+from onnx_predictor import export_onnx, OnnxPredictor, check_parity, time_predictions
+
+import argparse
+import configparser
+import numpy as np
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Export the label prediction of a trained model to ONNX.')
+
+    # Positional mandatory arguments
+    parser.add_argument("model_name", help="Name of model.", type=str)
+
+    # Optional arguments
+    parser.add_argument("-f", "--family",
+                        help="Model family: the self-supervised StarNet, the MAE linear probe or the ConvNeXtV2 encoder.",
+                        type=str, choices=['starnet', 'mae', 'cnv2'], default='starnet')
+    parser.add_argument("-dd", "--data_dir",
+                        help="Data directory if different from StarNet_SS/data/",
+                        type=str, default=None)
+    parser.add_argument("-o", "--output",
+                        help="ONNX file (default: models/<model_name>_labels.onnx).",
+                        type=str, default=None)
+    parser.add_argument("-tm", "--take_mode",
+                        help="Take the mode of the class probabilities instead of the weighted average.",
+                        type=str, default='False')
+    parser.add_argument("-it", "--intra_op_threads",
+                        help="Threads used within each operator by onnxruntime (0 for the default).",
+                        type=int, default=0)
+    parser.add_argument("-et", "--inter_op_threads",
+                        help="Threads used across operators by onnxruntime (0 for the default).",
+                        type=int, default=0)
+    parser.add_argument("-bs", "--batch_size",
+                        help="Number of random spectra used to check the exported graph.",
+                        type=int, default=64)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+args = parseArguments()
+model_name = args.model_name
+take_mode = args.take_mode.lower() in ('yes', 'true', 't', 'y', '1')
+device = torch.device('cpu')
+
+# Directories
+config_dir = os.path.join(cur_dir, 'configs/')
+model_dir = os.path.join(cur_dir, 'models/')
+data_dir = args.data_dir
+if data_dir is None:
+    data_dir = os.path.join(cur_dir, 'data/')
+onnx_filename = args.output
+if onnx_filename is None:
+    onnx_filename = os.path.join(model_dir, model_name+'_labels.onnx')
+
+# Model configuration
+config = configparser.ConfigParser()
+config.read(config_dir+model_name+'.ini')
+
+def multimodal_values(config):
+    '''Multimodal values from the source training set (cached next to the data file).'''
+    from metadata_cache import MetadataCache
+    metadata = MetadataCache(os.path.join(data_dir, config['DATA']['source_data_file']))
+    return [torch.from_numpy(metadata.unique(k + ' train').astype(np.float32))
+            for k in eval(config['DATA']['multimodal_keys'])]
+
+# Build the network, load its weights and wrap its label prediction
+if args.family=='starnet':
+    sys.path.append(os.path.join(cur_dir,'utils'))
+    from network import build_starnet, load_model_state, optimize_for_inference, StarNetInference
+    model = build_starnet(config, device, model_name, multimodal_values(config))
+    model, losses, cur_iter = load_model_state(model, os.path.join(model_dir, model_name+'.pth.tar'))
+    model.eval_mode()
+    label_model = StarNetInference(optimize_for_inference(model), take_mode=take_mode)
+    # The exported graph is checked against the labels of the unfolded model
+    reference_model = StarNetInference(model, take_mode=take_mode)
+    spectrum_size = int(config['ARCHITECTURE']['spectrum_size'])
+    spectra_mean = float(config['ARCHITECTURE']['spectra_mean'])
+    spectra_std = float(config['ARCHITECTURE']['spectra_std'])
+    input_names = ['spectra', 'pixel_indx']
+elif args.family=='mae':
+    sys.path.append(os.path.join(cur_dir,'mae_utils'))
+    from mae_network import build_mae, load_model_state, MAELabelInference
+    model = build_mae(config, device, model_name, multimodal_values(config))
+    model, losses, _, _ = load_model_state(model, os.path.join(model_dir, model_name+'_lp.pth.tar'))
+    model.eval_mode()
+    label_model = MAELabelInference(model, take_mode=take_mode)
+    reference_model = label_model
+    spectrum_size = int(config['MAE ARCHITECTURE']['spectrum_size'])
+    spectra_mean = float(config['DATA']['spectra_mean'])
+    spectra_std = float(config['DATA']['spectra_std'])
+    input_names = ['spectra']
+else:
+    sys.path.append(os.path.join(cur_dir,'cnv2_utils'))
+    from network import build_encoder, load_model_state, ConvNeXtV2Inference
+    model = build_encoder(config, device, model_name)
+    model, losses, _ = load_model_state(model, os.path.join(model_dir, model_name+'_lp.pth.tar'))
+    model.eval()
+    label_model = ConvNeXtV2Inference(model)
+    reference_model = label_model
+    spectrum_size = int(config['MAE ARCHITECTURE']['spectrum_size'])
+    spectra_mean = float(config['DATA']['spectra_mean'])
+    spectra_std = float(config['DATA']['spectra_std'])
+    input_names = ['spectra']
+label_model.eval()
+
+def random_inputs(batch_size):
+    '''Random spectra (and the pixel indices of full spectra) to trace and check the graph.'''
+    spectra = spectra_mean + spectra_std*torch.randn(batch_size, spectrum_size)
+    if len(input_names)==2:
+        return [spectra, torch.zeros(batch_size, dtype=torch.long)]
+    return [spectra]
+
+# Export with a dynamic batch axis
+print('\nExporting the label prediction to %s...' % onnx_filename)
+export_onnx(label_model, random_inputs(2), onnx_filename, input_names)
+
+# Check the exported graph against the labels of the torch model with the
+# trained weights (tests/test_onnx_export.py checks the parity of each family)
+predictor = OnnxPredictor(onnx_filename, intra_op_threads=args.intra_op_threads,
+                          inter_op_threads=args.inter_op_threads)
+inputs = random_inputs(args.batch_size)
+max_diff = check_parity(reference_model, predictor, inputs)
+print('The ONNX and torch labels agree to within %0.2e.' % max_diff)
+
+with torch.no_grad():
+    torch_time = time_predictions(label_model, inputs)
+onnx_time = time_predictions(predictor, inputs)
+print('Prediction time for %i spectra: %0.1fms with torch, %0.1fms with onnxruntime.' % (args.batch_size,
+                                                                                          torch_time, onnx_time))
@@ -4,7 +4,9 @@ cur_dir = os.path.dirname(__file__)
 import sys
 import glob
 sys.path.append(os.path.join(cur_dir,'mae_utils'))
+sys.path.append(os.path.join(cur_dir,'data_utils'))
 from data_loader import SpectraDataset, batch_to_device
+from metadata_cache import MetadataCache
 from training_utils import str2bool, parseArguments, LARS
 from mae_network import build_mae, load_model_state
 from analysis_fns import (plot_progress, plot_val_MAEs, encoder_predict,
@@ -61,11 +63,12 @@ wave_grid = np.load(wave_grid_file)
 
 
 # Calculate multimodal values from source training set
-with h5py.File(source_data_file, "r") as f:
-    mutlimodal_vals = []
-    for k in multimodal_keys:
-        vals = np.unique(f[k + ' train'][:]).astype(np.float32)
-        mutlimodal_vals.append(torch.from_numpy(vals).to(device))
+# (cached next to the data file after the first run)
+metadata = MetadataCache(source_data_file)
+mutlimodal_vals = []
+for k in multimodal_keys:
+    vals = metadata.unique(k + ' train').astype(np.float32)
+    mutlimodal_vals.append(torch.from_numpy(vals).to(device))
         
 # Load survey labels and spectra
 surveys = ['APOGEE', 'GAIA']
@@ -6,6 +6,11 @@ from typing import List
 from torchvision.ops import StochasticDepth
 
 import os
+import sys
+cur_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(cur_dir, '..', 'data_utils'))
+from label_grid import LabelGrid
+from fused_heads import fuse_head_states, convert_optimizer_state
 from training_utils import str2bool
 from itertools import chain
 from collections import defaultdict
@@ -26,6 +31,7 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from timm.models.vision_transformer import PatchEmbed, Block
 
@@ -83,6 +89,42 @@ class StarNet_head(torch.nn.Module):
     def forward(self, x):
         return self.fc_model(x)
 
+class StarNet_multihead(torch.nn.Module):
+    '''
+    Fused Linear output layers for several labels.
+    
+    One Linear layer (with the outputs of every label concatenated) is
+    applied to the features, and the output is split into a segment for
+    each label.
+    '''
+    def __init__(self, in_features, out_features, dropout=0.0, logsoftmax=False):
+        super().__init__()
+        self.out_features = list(out_features)
+        self.logsoftmax = logsoftmax
+        
+        # Define proportion or neurons to dropout
+        self.dropout = torch.nn.Dropout(dropout) if dropout>0 else torch.nn.Identity()
+        self.fc = torch.nn.Linear(in_features, sum(self.out_features))
+
+    def forward(self, x):
+        x = self.fc(self.dropout(x))
+        outputs = torch.split(x, self.out_features, dim=1)
+        if self.logsoftmax:
+            outputs = [torch.log_softmax(out, dim=1) for out in outputs]
+        return list(outputs)
+    
+    @staticmethod
+    def convert_head_states(states):
+        '''Convert the state dicts of separate StarNet_head modules into a fused state dict.'''
+        # Each head only has the parameters of its Linear layer
+        weights = [[v for k, v in state.items() if k.endswith('weight')][0] for state in states]
+        biases = [[v for k, v in state.items() if k.endswith('bias')][0] for state in states]
+        return fuse_head_states(weights, biases)
+
+    def convert_optimizer_state(self, optimizer, state):
+        '''Convert an optimizer state dict of the separate heads (see fused_heads.convert_optimizer_state).'''
+        return convert_optimizer_state(self, optimizer, state)
+
 class MaskedAutoencoderViT(nn.Module):
     """ Masked Autoencoder with VisionTransformer backbone
     """
@@ -92,7 +134,8 @@ class MaskedAutoencoderViT(nn.Module):
                  mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False,
                  input_mean=None, input_std=None, device='cpu',
                 multimodal_keys=None, unimodal_keys=None, mutlimodal_vals=None, 
-                 unimodal_means=None, unimodal_stds=None, head_dropout=0.0, lp_enc_layers=0):
+                 unimodal_means=None, unimodal_stds=None, head_dropout=0.0, lp_enc_layers=0,
+                 checkpoint_blocks=False):
         
         super().__init__()
 
@@ -102,6 +145,8 @@ class MaskedAutoencoderViT(nn.Module):
         self.input_mean = input_mean
         self.input_std = input_std
         self.lp_enc_layers = lp_enc_layers
+        # Checkpoint each Transformer block (see apply_blocks)
+        self.checkpoint_blocks = checkpoint_blocks
         
         # --------------------------------------------------------------------------
         # MAE encoder specifics
@@ -142,6 +187,8 @@ class MaskedAutoencoderViT(nn.Module):
         self.multimodal_keys = multimodal_keys
         self.unimodal_keys = unimodal_keys
         self.mutlimodal_vals = mutlimodal_vals
+        # Sorted grids used to convert between labels and classes
+        self.label_grid = LabelGrid(mutlimodal_vals if mutlimodal_vals is not None else [])
         self.unimodal_means = torch.tensor(unimodal_means).to(device)
         self.unimodal_stds = torch.tensor(unimodal_stds).to(device)
         self.num_mm_labels = len(self.multimodal_keys)
@@ -149,20 +196,12 @@ class MaskedAutoencoderViT(nn.Module):
         
         in_features = (num_patches+1)*embed_dim
         # Network head that predicts labels as linear output
-        self.label_classifiers = []
         if self.num_mm_labels>0:
-            for vals in mutlimodal_vals:
-                # Fully connected classifier
-                self.label_classifiers.append(StarNet_head(in_features=in_features, 
-                                                          out_features=len(vals), 
-                                                           dropout=head_dropout,
-                                                          logsoftmax=False).to(device))
-                '''
-                self.label_classifiers.append(StarNet_head_old(in_features=in_features, 
-                                                          out_features=len(vals), 
-                                                           #dropout=head_dropout,
-                                                          logsoftmax=True).to(device))
-                '''
+            # Fully connected classifiers of every label in one layer
+            self.label_classifier = StarNet_multihead(in_features=in_features, 
+                                                      out_features=[len(vals) for vals in mutlimodal_vals], 
+                                                      dropout=head_dropout,
+                                                      logsoftmax=False).to(device)
         
         # Network head that predicts unimodal labels as linear output
         if self.num_um_labels>0:
@@ -195,8 +234,7 @@ class MaskedAutoencoderViT(nn.Module):
         self.apply(self._init_weights)
         
         if self.num_mm_labels>0:
-            for net in self.label_classifiers:
-                net.apply(self._init_weights)
+            self.label_classifier.apply(self._init_weights)
                 
         if self.num_um_labels>0:
             self.unimodal_predictor.apply(self._init_weights)
@@ -213,10 +251,7 @@ class MaskedAutoencoderViT(nn.Module):
             
     def multimodal_to_class(self, labels):
         '''Convert labels into classes based on the multimodal values.'''
-        classes = []
-        for i, vals in enumerate(self.mutlimodal_vals):
-            classes.append(torch.cat([torch.where(vals==labels[j,i])[0] for j in range(len(labels))]))
-        return classes
+        return list(self.label_grid.to_class(labels).unbind(1))
     
     def class_to_label(self, classes, take_mode=False):
         '''Convert probabilities into labels using a weighted average and the multimodal values.'''
@@ -229,8 +264,7 @@ class MaskedAutoencoderViT(nn.Module):
             
             if take_mode:
                 # Take the class with the highest probability
-                class_indices = torch.argmax(prob, dim=(1), keepdim=True)
-                labels.append(torch.cat([c_vals[i] for i in class_indices]))
+                labels.append(c_vals[torch.argmax(prob, dim=1)])
             else:
                 # Take weighted average using class values and probabilities
                 labels.append(torch.sum(prob*c_vals, axis=1))
@@ -348,8 +382,7 @@ class MaskedAutoencoderViT(nn.Module):
             self.blocks[-1].mlp.fc1.train()
         
         if self.num_mm_labels>0:
-            for classifier in self.label_classifiers:
-                classifier.train()
+            self.label_classifier.train()
                 
         if self.num_um_labels>0:
             self.unimodal_predictor.train()
@@ -360,8 +393,7 @@ class MaskedAutoencoderViT(nn.Module):
         self.eval()
 
         if self.num_mm_labels>0:
-            for classifier in self.label_classifiers:
-                classifier.eval()
+            self.label_classifier.eval()
                 
         if self.num_um_labels>0:
             self.unimodal_predictor.eval()
@@ -377,6 +409,10 @@ class MaskedAutoencoderViT(nn.Module):
             if ('mlp.fc1' in name) and (self.lp_enc_layers>1):
                 param.requires_grad = True
                 
+        if self.num_mm_labels>0:
+            for name, param in self.label_classifier.named_parameters():
+                param.requires_grad = True
+                
         if self.num_um_labels>0:
             for name, param in self.unimodal_predictor.named_parameters():
                 param.requires_grad = True
@@ -392,15 +428,28 @@ class MaskedAutoencoderViT(nn.Module):
             parameters.append(self.blocks[-1].mlp.fc1.parameters())
         
         if self.num_mm_labels>0:
-            for net in self.label_classifiers:
-                parameters.append(net.parameters())
+            parameters.append(self.label_classifier.parameters())
         
         if self.num_um_labels>0:
             parameters.append(self.unimodal_predictor.parameters())            
         
         return chain(*parameters)
 
-    def forward_encoder(self, x, mask_ratio, norm_in=False):
+    def apply_blocks(self, blocks, x):
+        '''
+        Apply the Transformer `blocks` in turn, with activation checkpointing when training.
+        Recomputing the blocks in the backward pass costs roughly a third more step time,
+        so checkpointing is only worthwhile when the batches are large enough for the
+        block activations to dominate the memory (e.g. batch_size = 64 and above).
+        '''
+        for blk in blocks:
+            if self.checkpoint_blocks and torch.is_grad_enabled():
+                x = checkpoint(blk, x, use_reentrant=False)
+            else:
+                x = blk(x)
+        return x
+
+    def forward_encoder(self, x, mask_ratio, norm_in=False, keep_order=False):
         
         if norm_in:
             # Normalize input data
@@ -416,7 +465,12 @@ class MaskedAutoencoderViT(nn.Module):
         x = x + self.pos_embed[:, 1:, :]
 
         # masking: length -> length * mask_ratio
-        x, mask, ids_restore = self.random_masking(x, mask_ratio)
+        if not keep_order:
+            x, mask, ids_restore = self.random_masking(x, mask_ratio)
+        else:
+            # Keep every patch in order without masking (for export)
+            mask = torch.zeros(x.shape[:2], device=x.device)
+            ids_restore = torch.arange(x.shape[1], device=x.device).expand(x.shape[0], -1)
 
         # append cls token
         cls_token = self.cls_token + self.pos_embed[:, :1, :]
@@ -424,8 +478,7 @@ class MaskedAutoencoderViT(nn.Module):
         x = torch.cat((cls_tokens, x), dim=1)
 
         # apply Transformer blocks
-        for blk in self.blocks:
-            x = blk(x)
+        x = self.apply_blocks(self.blocks, x)
         x = self.norm(x)
 
         return x, mask, ids_restore
@@ -444,8 +497,7 @@ class MaskedAutoencoderViT(nn.Module):
         x = x + self.decoder_pos_embed
 
         # apply Transformer blocks
-        for blk in self.decoder_blocks:
-            x = blk(x)
+        x = self.apply_blocks(self.decoder_blocks, x)
         x = self.decoder_norm(x)
 
         # predictor projection
@@ -489,10 +541,11 @@ class MaskedAutoencoderViT(nn.Module):
         return loss, pred, mask, latent
     
     def forward_labels(self, imgs, norm_in=False, denorm_out=False, return_feats=False,
-                      take_mode=False):
+                      take_mode=False, keep_order=False):
         
         # Encode without masking
-        latent, mask, ids_restore = self.forward_encoder(imgs, mask_ratio=0., norm_in=norm_in)
+        latent, mask, ids_restore = self.forward_encoder(imgs, mask_ratio=0., norm_in=norm_in,
+                                                         keep_order=keep_order)
         
         return_dict = {}
             
@@ -502,7 +555,7 @@ class MaskedAutoencoderViT(nn.Module):
         latent = torch.flatten(latent, start_dim=1)
         if self.num_mm_labels>0:
             # Predict labels from features
-            mm_labels = [classifier(latent) for classifier in self.label_classifiers]
+            mm_labels = self.label_classifier(latent)
             if denorm_out:
                 # Denormalize labels
                 mm_labels = self.class_to_label(mm_labels, take_mode=take_mode)
@@ -519,6 +572,36 @@ class MaskedAutoencoderViT(nn.Module):
         
         return return_dict
 
+class MAELabelInference(nn.Module):
+    """ Label prediction with the MAE encoder and linear probe heads, for export.
+    
+    Maps spectra [batch, num_pixels] to a [batch, num_mm_labels+num_um_labels]
+    tensor of the denormalized multimodal labels (probability-weighted class
+    values, or the modes) followed by the unimodal labels, as predicted by
+    forward_labels with keep_order=True.
+
+    By default, forward_labels passes the patches through random_masking,
+    which shuffles them even without masking, so its labels are random.
+    The exported graph keeps the patches in their original order instead,
+    so its labels are deterministic but can differ from those of
+    forward_labels for linear probes trained on shuffled patches.
+    """
+    def __init__(self, model, norm_in=True, take_mode=False):
+        super().__init__()
+        self.model = model
+        self.norm_in = norm_in
+        self.take_mode = take_mode
+
+    def forward(self, spectra):
+        outputs = self.model.forward_labels(spectra, norm_in=self.norm_in, denorm_out=True,
+                                            take_mode=self.take_mode, keep_order=True)
+        labels = []
+        if self.model.num_mm_labels>0:
+            labels.append(outputs['multimodal labels'].to(spectra.dtype))
+        if self.model.num_um_labels>0:
+            labels.append(outputs['unimodal labels'])
+        return torch.cat(labels, dim=1)
+
 def mae_vit_base_patch16_dec512d8b(**kwargs):
     model = MaskedAutoencoderViT(
         patch_size=16, embed_dim=768, depth=12, num_heads=12,
@@ -585,7 +668,8 @@ def build_mae(config, device, model_name, mutlimodal_vals):
                                  unimodal_means=eval(config['DATA']['unimodal_means']), 
                                  unimodal_stds=eval(config['DATA']['unimodal_stds']),
                                 head_dropout=float(config['LINEAR PROBE TRAINING']['dropout']),
-                                lp_enc_layers=int(config['LINEAR PROBE TRAINING']['num_enc_layers']))
+                                lp_enc_layers=int(config['LINEAR PROBE TRAINING']['num_enc_layers']),
+                                checkpoint_blocks=str2bool(config['MAE ARCHITECTURE'].get('checkpoint_activations', 'False')))
     
     model.to(device)
 
@@ -594,8 +678,8 @@ def build_mae(config, device, model_name, mutlimodal_vals):
     print(model)
     
     if model.num_mm_labels>0:
-        print('Classifier1 Architecture:')
-        print(model.label_classifiers[0])
+        print('Classifier Architecture:')
+        print(model.label_classifier)
     if model.num_um_labels>0:
         print('Linear Head Architecture:')
         print(model.unimodal_predictor)
@@ -622,29 +706,41 @@ def load_model_state(model, model_filename, optimizer=None, lr_scheduler=None,
         else:
             cur_lp_iter = 1
 
+        model_state = checkpoint['model']
+        # Older checkpoints saved each classifier head separately
+        old_heads = (model.num_mm_labels>0) and ('label_classifier.fc.weight' not in model_state)
+        if old_heads:
+            if len(checkpoint.get('classifier models', []))>0:
+                head_state = StarNet_multihead.convert_head_states(checkpoint['classifier models'])
+            else:
+                # Keep the initial classifier weights
+                head_state = model.label_classifier.state_dict()
+            model_state.update({'label_classifier.'+k: v for k, v in head_state.items()})
+            # The saved states of the separate heads do not match the fused parameters
+            print('Starting fresh optimizer states for the fused classifier heads.')
+
+        def optimizer_state(optimizer):
+            if old_heads:
+                return model.label_classifier.convert_optimizer_state(optimizer, checkpoint['optimizer'])
+            return checkpoint['optimizer']
+
         # Load optimizer states
         try:
             if optimizer is not None:
-                optimizer.load_state_dict(checkpoint['optimizer'])
+                optimizer.load_state_dict(optimizer_state(optimizer))
             if lr_scheduler is not None:
                 lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
-            if loss_scaler is not None:
+            if (loss_scaler is not None) and ('loss_scaler' in checkpoint):
                 loss_scaler.load_state_dict(checkpoint['loss_scaler'])
             if (lp_optimizer is not None) & (cur_lp_iter>1):
-                lp_optimizer.load_state_dict(checkpoint['optimizer'])
+                lp_optimizer.load_state_dict(optimizer_state(lp_optimizer))
             if (lp_lr_scheduler is not None) & (cur_lp_iter>1):
                 lp_lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
         except ValueError:
             pass
         
         # Load model weights
-        model.load_state_dict(checkpoint['model'])
-        try:
-            if model.num_mm_labels>0:
-                for net, state in zip(model.label_classifiers, checkpoint['classifier models']):
-                    net.load_state_dict(state)
-        except KeyError:
-            pass
+        model.load_state_dict(model_state)
         
     else:
         print('\nStarting fresh model to train...')
@@ -1,9 +1,16 @@
 import torch
-from torch import nn, inf
+from torch import nn
 import torch.nn.functional as F
 
 import argparse
 import numpy as np
+from contextlib import nullcontext
+
+import os
+import sys
+cur_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(cur_dir, '..', 'amp_utils'))
+from mixed_precision import NativeScalerWithGradNormCount, get_grad_norm_, to_float
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
@@ -30,55 +37,16 @@ def parseArguments():
     parser.add_argument("-dd", "--data_dir", 
                         help="Data directory if different from StarNet_SS/data/", 
                         type=str, default=None)
+    # Int8 model written by quantize_model.py (for the test scripts)
+    parser.add_argument("-q", "--quantized", 
+                        help="Evaluate the int8 checkpoint instead of the float model.", 
+                        type=str, default='False')
     
     # Parse arguments
     args = parser.parse_args()
     
     return args
 
-def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
-    if isinstance(parameters, torch.Tensor):
-        parameters = [parameters]
-    parameters = [p for p in parameters if p.grad is not None]
-    norm_type = float(norm_type)
-    if len(parameters) == 0:
-        return torch.tensor(0.)
-    device = parameters[0].grad.device
-    if norm_type == inf:
-        total_norm = max(p.grad.detach().abs().max().to(device) for p in parameters)
-    else:
-        total_norm = torch.norm(torch.stack([torch.norm(p.grad.detach(), norm_type).to(device) for p in parameters]), norm_type)
-    return total_norm
-
-class NativeScalerWithGradNormCount:
-    state_dict_key = "amp_scaler"
-
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
-
-    def __call__(self, loss, optimizer, clip_grad=None, 
-                 parameters=None, create_graph=False, update_grad=True):
-        self._scaler.scale(loss).backward(create_graph=create_graph)
-        if update_grad:
-            if clip_grad is not None:
-                assert parameters is not None
-                self._scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
-                norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad)
-            else:
-                self._scaler.unscale_(optimizer)
-                norm = get_grad_norm_(parameters)
-            self._scaler.step(optimizer)
-            self._scaler.update()
-        else:
-            norm = None
-        return norm
-
-    def state_dict(self):
-        return self._scaler.state_dict()
-
-    def load_state_dict(self, state_dict):
-        self._scaler.load_state_dict(state_dict)
-
 class LARS(torch.optim.Optimizer):
     """
     LARS optimizer, no rate scaling or weight decay for parameters <= 1D.
@@ -132,9 +100,13 @@ def latent_distance(latent1, latent2):
     # Compute mean absolute error
     return torch.mean(torch.abs(latent1_norm-latent2_norm))   
         
-def mae_iter(model, optimizer, lr_scheduler, #loss_scaler, 
+def mae_iter(model, optimizer, lr_scheduler,
                src_batch, tgt_batch, mask_ratio, target_loss_weight,
-               losses_cp, cur_iter, total_batch_iters, mode, device):
+               losses_cp, cur_iter, total_batch_iters, mode, device, loss_scaler=None):
+    '''
+    With a `loss_scaler` (NativeScalerWithGradNormCount) the training forward
+    passes run at its precision and it takes the optimizer step.
+    '''
 
     if mode=='train':
         model.train(True)
@@ -155,14 +127,16 @@ def mae_iter(model, optimizer, lr_scheduler, #loss_scaler,
     #mask_ratio = mask_ratio.item()
     
     # Compute predictions and losses
-    #with torch.cuda.amp.autocast():
     #loss, _, _, latent = model(torch.concatenate((src_batch['spectrum'],
     #                                                  tgt_batch['spectrum']), dim=0), 
     #                                   mask_ratio=mask_ratio, norm_in=True)
-    src_loss, _, _, src_latent = model(src_batch['spectrum'], 
-                                       mask_ratio=mask_ratio, norm_in=True)
-    tgt_loss, _, _, tgt_latent = model(tgt_batch['spectrum'], 
-                                       mask_ratio=mask_ratio, norm_in=True)
+    # (validation runs in float32)
+    with loss_scaler.autocast() if (loss_scaler is not None and mode=='train') else nullcontext():
+        src_loss, _, _, src_latent = model(src_batch['spectrum'], 
+                                           mask_ratio=mask_ratio, norm_in=True)
+        tgt_loss, _, _, tgt_latent = model(tgt_batch['spectrum'], 
+                                           mask_ratio=mask_ratio, norm_in=True)
+    src_loss, src_latent, tgt_loss, tgt_latent = to_float([src_loss, src_latent, tgt_loss, tgt_latent])
 
     # Compute total loss
     loss = src_loss + target_loss_weight*tgt_loss
@@ -170,9 +144,12 @@ def mae_iter(model, optimizer, lr_scheduler, #loss_scaler,
     if mode=='train':
 
         # Backpropagate and update weights
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 2.0)
-        optimizer.step()
+        if loss_scaler is not None:
+            loss_scaler(loss, optimizer, clip_grad=2.0, parameters=model.parameters())
+        else:
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 2.0)
+            optimizer.step()
     
         # Adjust learning rate
         lr_scheduler.step()
@@ -194,7 +171,11 @@ def mae_iter(model, optimizer, lr_scheduler, #loss_scaler,
     return model, optimizer, lr_scheduler, losses_cp
 
 def linear_probe_iter(model, optimizer, lr_scheduler, label_smoothing, src_batch,
-                      losses_cp, cur_iter, device):
+                      losses_cp, cur_iter, device, loss_scaler=None):
+    '''
+    With a `loss_scaler` (NativeScalerWithGradNormCount) the forward pass
+    runs at its precision and it takes the optimizer step.
+    '''
 
     model.train_head_mode()
 
@@ -204,10 +185,11 @@ def linear_probe_iter(model, optimizer, lr_scheduler, label_smoothing, src_batch
     total_loss = 0.
 
     # Compute predictions
-    #with torch.cuda.amp.autocast():
-    model_outputs = model.forward_labels(src_batch['spectrum'], 
-                                               norm_in=True, denorm_out=False, 
-                                                 return_feats=False)
+    with loss_scaler.autocast() if loss_scaler is not None else nullcontext():
+        model_outputs = model.forward_labels(src_batch['spectrum'], 
+                                                   norm_in=True, denorm_out=False, 
+                                                     return_feats=False)
+    model_outputs = to_float(model_outputs)
 
     # Compute the average loss on stellar class labels
     src_mm_loss_tot = 0.    
@@ -240,9 +222,12 @@ def linear_probe_iter(model, optimizer, lr_scheduler, label_smoothing, src_batch
     total_loss += src_um_loss_tot
 
     # Backpropagate and update weights
-    total_loss.backward()
-    
-    optimizer.step()
+    if loss_scaler is not None:
+        loss_scaler(total_loss, optimizer, parameters=model.parameters())
+    else:
+        total_loss.backward()
+        
+        optimizer.step()
     
     # Adjust learning rate
     lr_scheduler.step()
@@ -0,0 +1,81 @@
+import time
+import numpy as np
+import torch
+import onnxruntime
+
+def export_onnx(model, example_inputs, filename, input_names, output_names=['labels'],
+                opset_version=18):
+    '''
+    Export `model` (a module with a pure-tensor forward) to ONNX with the
+    first axis of every input and output left dynamic.
+    '''
+    model = model.eval()
+    dynamic_axes = {name: {0: 'batch'} for name in input_names+output_names}
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(example_inputs), filename,
+                          input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version)
+    return filename
+
+class OnnxPredictor:
+
+    """
+    Runs an exported label prediction graph with onnxruntime on the CPU.
+
+    `intra_op_threads` sets the threads used within each operator and
+    `inter_op_threads` the threads used to run independent operators in
+    parallel (0 lets onnxruntime choose). Batches larger than `batch_size`
+    are split into chunks of at most `batch_size` spectra.
+    """
+
+    def __init__(self, filename, intra_op_threads=0, inter_op_threads=0,
+                 batch_size=None, providers=['CPUExecutionProvider']):
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads>1:
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = onnxruntime.InferenceSession(filename, sess_options=options,
+                                                    providers=providers)
+        self.input_names = [inp.name for inp in self.session.get_inputs()]
+        self.input_types = [np.int64 if 'int64' in inp.type else np.float32
+                            for inp in self.session.get_inputs()]
+        self.batch_size = batch_size
+
+    def __call__(self, *inputs):
+        '''Return the [batch, num_labels] labels of the input arrays (or tensors).'''
+        inputs = [np.ascontiguousarray(inp.detach().cpu().numpy() if torch.is_tensor(inp) else inp,
+                                       dtype=dtype)
+                  for inp, dtype in zip(inputs, self.input_types)]
+        num_samples = len(inputs[0])
+        batch_size = self.batch_size or num_samples
+
+        labels = []
+        for start in range(0, num_samples, batch_size):
+            feed = {name: inp[start:start+batch_size] for name, inp in zip(self.input_names, inputs)}
+            labels.append(self.session.run(None, feed)[0])
+        return np.concatenate(labels)
+
+def check_parity(torch_model, predictor, inputs, rtol=1e-4, atol=1e-5):
+    '''
+    Compare the labels of the torch module and the ONNX predictor for the
+    same inputs. Returns the largest absolute difference and raises a
+    ValueError if the labels do not agree within the tolerances.
+    '''
+    with torch.no_grad():
+        torch_labels = torch_model.eval()(*inputs).cpu().numpy()
+    onnx_labels = predictor(*inputs)
+    max_diff = float(np.max(np.abs(torch_labels - onnx_labels)))
+    if not np.allclose(onnx_labels, torch_labels, rtol=rtol, atol=atol):
+        raise ValueError('The ONNX labels differ from the torch labels by up to %0.2e.' % max_diff)
+    return max_diff
+
+def time_predictions(predict_fn, inputs, num_iters=5):
+    '''Return the mean time (ms) of a prediction.'''
+    predict_fn(*inputs)
+    start_time = time.time()
+    for i in range(num_iters):
+        predict_fn(*inputs)
+    return (time.time() - start_time)/num_iters*1e3
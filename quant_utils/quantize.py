@@ -0,0 +1,172 @@
+import io
+import copy
+import time
+import warnings
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+
+class PointwiseLinear(nn.Module):
+    """
+    A 1x1 Conv1d applied as a Linear layer over the channels of the
+    [batch, channels, length] inputs, which dynamic quantization supports.
+    """
+    def __init__(self, conv):
+        super().__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight[:,:,0])
+            if conv.bias is not None:
+                self.linear.bias.copy_(conv.bias)
+
+    def forward(self, x):
+        return self.linear(x.transpose(1,2)).transpose(1,2)
+
+class StaticSite(nn.Module):
+    """
+    Runs `layer` with int8 inputs and weights within an otherwise float
+    model: the input is quantized with the scale found during calibration
+    and the output is dequantized.
+    """
+    def __init__(self, layer):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.layer = layer
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.layer(self.quant(x)))
+
+def is_pointwise_conv(mod):
+    return (isinstance(mod, nn.Conv1d) and mod.kernel_size==(1,) and mod.stride==(1,)
+            and mod.groups==1 and mod.padding in [(0,), 'valid'])
+
+def quantizable_layers(model):
+    '''
+    Names of the layers of `model` that are quantized: the Linear layers
+    and the pointwise (1x1) convolutions, which hold most of the compute of
+    the ConvNeXt blocks and ViT blocks. The depthwise and strided
+    convolutions are slower in int8 on the CPU and stay in float.
+    '''
+    return [name for name, mod in model.named_modules()
+            if isinstance(mod, nn.Linear) or is_pointwise_conv(mod)]
+
+def replace_layer(model, name, layer):
+    parent_name, _, child_name = name.rpartition('.')
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, child_name, layer)
+
+def quantize_dynamic(model, layer_names=None):
+    '''
+    Return an int8 copy of `model` (eval mode only) in which the weights of
+    the layers (by default all of the quantizable_layers) are quantized per
+    output channel and the activations are quantized on the fly.
+    '''
+    model = copy.deepcopy(model).eval()
+    if layer_names is None:
+        layer_names = quantizable_layers(model)
+
+    qconfig_spec = {}
+    for name in layer_names:
+        layer = model.get_submodule(name)
+        if is_pointwise_conv(layer):
+            replace_layer(model, name, PointwiseLinear(layer))
+            name = name + '.linear'
+        qconfig_spec[name] = tq.per_channel_dynamic_qconfig
+    return tq.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+def quantize_static(model, calibrate_fn=None, layer_names=None, engine=None):
+    '''
+    Return an int8 copy of `model` (eval mode only) in which the layers run
+    with int8 activations as well as weights. The activation ranges are
+    collected by `calibrate_fn(model)`, which should run the (wrapped) model
+    on a few hundred spectra. Layers that the calibration does not reach
+    (e.g. the decoder of an MAE) are left in float.
+
+    Returns the model and the names of its quantized layers. Without a
+    `calibrate_fn` only the structure is built, so that the weights can be
+    loaded from a checkpoint.
+    '''
+    model = copy.deepcopy(model).eval()
+    if layer_names is None:
+        layer_names = quantizable_layers(model)
+    if engine is None:
+        engine = torch.backends.quantized.engine
+
+    for name in layer_names:
+        site = StaticSite(model.get_submodule(name))
+        site.qconfig = tq.get_default_qconfig(engine)
+        replace_layer(model, name, site)
+    tq.prepare(model, inplace=True)
+
+    if calibrate_fn is not None:
+        with torch.no_grad():
+            calibrate_fn(model)
+        # Return the layers that were not calibrated to float
+        calibrated_names = []
+        for name in layer_names:
+            site = model.get_submodule(name)
+            if torch.isfinite(site.quant.activation_post_process.min_val):
+                calibrated_names.append(name)
+            else:
+                replace_layer(model, name, site.layer)
+                site.layer.qconfig = None
+                del site.layer.activation_post_process
+                site.layer._forward_hooks.clear()
+        layer_names = calibrated_names
+
+    with warnings.catch_warnings():
+        # Observers that have not seen data warn when the structure is only being rebuilt
+        warnings.simplefilter('ignore')
+        tq.convert(model, inplace=True)
+    return model, layer_names
+
+def quantize_model(model, mode, calibrate_fn=None, layer_names=None):
+    '''Quantize `model` with the 'dynamic' or 'static' mode and return it with its quantized layers.'''
+    if mode=='dynamic':
+        if layer_names is None:
+            layer_names = quantizable_layers(model)
+        return quantize_dynamic(model, layer_names), layer_names
+    elif mode=='static':
+        return quantize_static(model, calibrate_fn, layer_names)
+    else:
+        raise ValueError('Unknown quantization mode: %s' % mode)
+
+def save_quantized_model(model, mode, layer_names, model_filename, **kwargs):
+    '''Save the int8 weights along with the settings needed to rebuild the model.'''
+    torch.save({'quantization': mode,
+                'quantized layers': layer_names,
+                'model': model.state_dict(), **kwargs},
+               model_filename)
+
+def load_quantized_model(model, model_filename, prepare_fn=None):
+    '''
+    Rebuild the int8 version of the float `model` saved by
+    save_quantized_model and load its weights. `prepare_fn` applies the
+    float transformations that were applied before quantizing (e.g.
+    optimize_for_inference). Quantized models run on the CPU.
+    '''
+    print('\nLoading quantized model weights...')
+    checkpoint = torch.load(model_filename, map_location='cpu', weights_only=False)
+    model = model.cpu().eval()
+    if prepare_fn is not None:
+        model = prepare_fn(model)
+    model, _ = quantize_model(model, checkpoint['quantization'],
+                              layer_names=checkpoint['quantized layers'])
+    model.load_state_dict(checkpoint['model'])
+    return model
+
+def model_size_mb(model):
+    '''Size (MB) of the serialized state dict.'''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes/1e6
+
+def time_predictions(predict_fn, inputs, num_iters=5):
+    '''Return the mean time (ms) of a prediction.'''
+    with torch.no_grad():
+        predict_fn(*inputs)
+        start_time = time.time()
+        for i in range(num_iters):
+            predict_fn(*inputs)
+    return (time.time() - start_time)/num_iters*1e3
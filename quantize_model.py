@@ -0,0 +1,214 @@
+import os
+# Directory of quantization script
+cur_dir = os.path.dirname(__file__)
+import sys
+sys.path.append(os.path.join(cur_dir,'data_utils'))
+sys.path.append(os.path.join(cur_dir,'quant_utils'))
+from quantize import (quantize_model, save_quantized_model, quantizable_layers,
+                      model_size_mb, time_predictions)
+
+import argparse
+import configparser
+import numpy as np
+import torch
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Quantize a trained model to int8 for CPU inference.')
+
+    # Positional mandatory arguments
+    parser.add_argument("model_name", help="Name of model.", type=str)
+
+    # Optional arguments
+    parser.add_argument("-f", "--family",
+                        help="Model family: the self-supervised StarNet, the MAE linear probe or the ConvNeXtV2 encoder.",
+                        type=str, choices=['starnet', 'mae', 'cnv2'], default='starnet')
+    parser.add_argument("-m", "--mode",
+                        help="Dynamic (int8 weights) or static (int8 weights and calibrated activations) quantization.",
+                        type=str, choices=['dynamic', 'static'], default='dynamic')
+    parser.add_argument("-dd", "--data_dir",
+                        help="Data directory if different from StarNet_SS/data/",
+                        type=str, default=None)
+    parser.add_argument("-o", "--output",
+                        help="Quantized checkpoint (default: the float checkpoint with an _int8 suffix).",
+                        type=str, default=None)
+    parser.add_argument("-nc", "--num_calibration",
+                        help="Number of training spectra used to calibrate the static quantization.",
+                        type=int, default=256)
+    parser.add_argument("-ne", "--num_eval",
+                        help="Number of validation spectra used to compare the int8 and float labels.",
+                        type=int, default=1024)
+    parser.add_argument("-bs", "--batch_size",
+                        help="Batch size of the predictions.",
+                        type=int, default=64)
+    parser.add_argument("-tm", "--take_mode",
+                        help="Take the mode of the class probabilities instead of the weighted average.",
+                        type=str, default='False')
+    parser.add_argument("-nt", "--num_threads",
+                        help="Number of CPU threads.",
+                        type=int, default=None)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+args = parseArguments()
+model_name = args.model_name
+take_mode = args.take_mode.lower() in ('yes', 'true', 't', 'y', '1')
+if args.num_threads is not None:
+    torch.set_num_threads(args.num_threads)
+# Quantized models run on the CPU
+device = torch.device('cpu')
+
+# Directories
+config_dir = os.path.join(cur_dir, 'configs/')
+model_dir = os.path.join(cur_dir, 'models/')
+data_dir = args.data_dir
+if data_dir is None:
+    data_dir = os.path.join(cur_dir, 'data/')
+
+# Model configuration
+config = configparser.ConfigParser()
+config.read(config_dir+model_name+'.ini')
+source_data_file = os.path.join(data_dir, config['DATA']['source_data_file'])
+continuum_normalize = config['DATA'].get('continuum_normalize', 'False').lower() in ('yes', 'true', 't', 'y', '1')
+divide_by_median = config['DATA'].get('divide_by_median', 'False').lower() in ('yes', 'true', 't', 'y', '1')
+
+def multimodal_values(multimodal_keys):
+    '''Multimodal values from the source training set (cached next to the data file).'''
+    from metadata_cache import MetadataCache
+    metadata = MetadataCache(source_data_file)
+    return [torch.from_numpy(metadata.unique(k + ' train').astype(np.float32))
+            for k in multimodal_keys]
+
+# Build the network, load its weights and wrap its label prediction.
+# `prepare_fn` holds the float transformations applied before quantizing,
+# which load_quantized_model has to repeat.
+prepare_fn = None
+if args.family=='starnet':
+    sys.path.append(os.path.join(cur_dir,'utils'))
+    from network import build_starnet, load_model_state, optimize_for_inference, StarNetInference
+    from data_loader import SpectraDataset
+    multimodal_keys = eval(config['DATA']['multimodal_keys'])
+    unimodal_keys = eval(config['DATA']['unimodal_keys'])
+    label_keys = multimodal_keys + unimodal_keys
+    model = build_starnet(config, device, model_name, multimodal_values(multimodal_keys))
+    model_filename = os.path.join(model_dir, model_name+'.pth.tar')
+    model, losses, cur_iter = load_model_state(model, model_filename)
+    model.eval_mode()
+    prepare_fn = optimize_for_inference
+    label_model = lambda model: StarNetInference(model, take_mode=take_mode)
+    make_dataset = lambda dataset: SpectraDataset(source_data_file, dataset=dataset,
+                                                  wave_grid_file=os.path.join(data_dir, config['DATA']['wave_grid_file']),
+                                                  multimodal_keys=multimodal_keys,
+                                                  unimodal_keys=unimodal_keys,
+                                                  continuum_normalize=continuum_normalize,
+                                                  divide_by_median=divide_by_median,
+                                                  inference_mode=True)
+    batch_inputs = lambda batch: [batch['spectrum'], batch['spectrum index']]
+    batch_labels = lambda batch: torch.cat((batch['multimodal labels'], batch['unimodal labels']), dim=1)
+elif args.family=='mae':
+    sys.path.append(os.path.join(cur_dir,'mae_utils'))
+    from mae_network import build_mae, load_model_state, MAELabelInference
+    from data_loader import SpectraDataset
+    multimodal_keys = eval(config['DATA']['multimodal_keys'])
+    unimodal_keys = eval(config['DATA']['unimodal_keys'])
+    label_keys = multimodal_keys + unimodal_keys
+    model = build_mae(config, device, model_name, multimodal_values(multimodal_keys))
+    model_filename = os.path.join(model_dir, model_name+'_lp.pth.tar')
+    model, losses, _, _ = load_model_state(model, model_filename)
+    model.eval_mode()
+    label_model = lambda model: MAELabelInference(model, take_mode=take_mode)
+    make_dataset = lambda dataset: SpectraDataset(source_data_file, dataset=dataset,
+                                                  multimodal_keys=multimodal_keys,
+                                                  unimodal_keys=unimodal_keys,
+                                                  continuum_normalize=continuum_normalize,
+                                                  divide_by_median=divide_by_median)
+    batch_inputs = lambda batch: [batch['spectrum']]
+    batch_labels = lambda batch: torch.cat((batch['multimodal labels'], batch['unimodal labels']), dim=1)
+else:
+    sys.path.append(os.path.join(cur_dir,'cnv2_utils'))
+    from network import build_encoder, load_model_state, ConvNeXtV2Inference
+    from data_loader import SpectraDataset
+    label_keys = eval(config['DATA']['label_keys'])
+    source_val_survey = config['DATA']['source_val_survey']
+    if source_val_survey.lower()=='none':
+        source_val_survey = None
+    model = build_encoder(config, device, model_name)
+    model_filename = os.path.join(model_dir, model_name+'_lp.pth.tar')
+    model, losses, _ = load_model_state(model, model_filename)
+    model.eval()
+    label_model = lambda model: ConvNeXtV2Inference(model)
+    make_dataset = lambda dataset: SpectraDataset(source_data_file, dataset=dataset,
+                                                  label_keys=label_keys,
+                                                  label_survey=source_val_survey,
+                                                  continuum_normalize=continuum_normalize,
+                                                  divide_by_median=divide_by_median)
+    batch_inputs = lambda batch: [batch['spectrum']]
+    batch_labels = lambda batch: batch['stellar labels']
+
+quant_filename = args.output
+if quant_filename is None:
+    quant_filename = model_filename.replace('.pth.tar', '_int8.pth.tar')
+
+def make_dataloader(dataset, num_samples):
+    '''Loader of the first `num_samples` spectra of a split.'''
+    dataset = make_dataset(dataset)
+    dataset = torch.utils.data.Subset(dataset, range(min(num_samples, len(dataset))))
+    return torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+
+def calibrate(model):
+    '''Run the label prediction on the calibration spectra to collect the activation ranges.'''
+    predictor = label_model(model)
+    for batch in make_dataloader('train', args.num_calibration):
+        predictor(*batch_inputs(batch))
+
+def predict(model, dataloader):
+    '''Predicted and target labels of the validation spectra.'''
+    predictor = label_model(model)
+    pred_labels = []
+    tgt_labels = []
+    with torch.no_grad():
+        for batch in dataloader:
+            pred_labels.append(predictor(*batch_inputs(batch)).numpy())
+            tgt_labels.append(batch_labels(batch).numpy())
+    return np.concatenate(pred_labels), np.concatenate(tgt_labels)
+
+# Float model (with the same transformations as the quantized one)
+float_model = model.eval()
+if prepare_fn is not None:
+    float_model = prepare_fn(float_model)
+
+print('\nQuantizing the %s model (%s mode)...' % (args.family, args.mode))
+quant_model, layer_names = quantize_model(float_model, args.mode, calibrate_fn=calibrate)
+print('Quantized %i of the %i Linear and pointwise convolution layers.' % (len(layer_names),
+                                                                           len(quantizable_layers(float_model))))
+
+# Accuracy of the int8 labels compared to the float labels
+val_dataloader = make_dataloader('val', args.num_eval)
+float_labels, tgt_labels = predict(float_model, val_dataloader)
+quant_labels, _ = predict(quant_model, val_dataloader)
+float_mae = np.nanmean(np.abs(float_labels - tgt_labels), axis=0)
+quant_mae = np.nanmean(np.abs(quant_labels - tgt_labels), axis=0)
+diff_mae = np.mean(np.abs(quant_labels - float_labels), axis=0)
+
+print('\n%-10s %14s %14s %14s %16s' % ('Label', 'Float MAE', 'Int8 MAE', 'Delta', 'Int8 vs float'))
+for i, key in enumerate(label_keys):
+    print('%-10s %14.4f %14.4f %14.4f %16.4f' % (key, float_mae[i], quant_mae[i],
+                                                 quant_mae[i]-float_mae[i], diff_mae[i]))
+
+# Speed and memory
+inputs = batch_inputs(next(iter(val_dataloader)))
+float_time = time_predictions(label_model(float_model), inputs)
+quant_time = time_predictions(label_model(quant_model), inputs)
+float_size = model_size_mb(float_model)
+quant_size = model_size_mb(quant_model)
+print('\nPrediction time for %i spectra: %0.1fms in float, %0.1fms in int8 (%0.2fx speedup).' % (len(inputs[0]),
+                                                                                              float_time, quant_time,
+                                                                                              float_time/quant_time))
+print('Model size: %0.1fMB in float, %0.1fMB in int8 (%0.2fx smaller).' % (float_size, quant_size,
+                                                                          float_size/quant_size))
+
+save_quantized_model(quant_model, args.mode, layer_names, quant_filename)
+print('\nSaved the quantized model to %s' % quant_filename)
@@ -4,12 +4,15 @@ cur_dir = os.path.dirname(__file__)
 import sys
 import glob
 sys.path.append(os.path.join(cur_dir,'starnet_utils'))
+sys.path.append(os.path.join(cur_dir,'data_utils'))
+from metadata_cache import MetadataCache
 from training_utils import str2bool, parseArguments
-from network import build_starnet, load_model_state
+from network import build_starnet, load_model_state, build_inference_model
 from analysis_fns import (plot_resid_violinplot,
                           plot_resid, compare_veracity, plot_resid_hexbin)
 
 import configparser
+import copy
 import time
 import numpy as np
 import h5py
@@ -71,11 +74,13 @@ obs_spectra = torch.from_numpy(np.asarray(obs_spectra[indices]).astype(np.float3
 survey_labels = survey_labels[:,indices]
 
 # Collect mean and std of the training data
-with h5py.File(source_data_file, "r") as f:
-    labels_mean = [np.mean(f[k + ' train'][:]) for k in label_keys]
-    labels_std = [np.std(f[k + ' train'][:]) for k in label_keys]
-    spectra_mean = np.mean(f['spectra train'][:]) 
-    spectra_std = np.mean(f['spectra train'][:])
+# (cached next to the data file after the first run)
+metadata = MetadataCache(source_data_file)
+labels_mean = [metadata.mean(k + ' train') for k in label_keys]
+labels_std = [metadata.std(k + ' train') for k in label_keys]
+spectra_mean = metadata.mean('spectra train')
+# (The existing networks were trained with the spectra mean in place of the std)
+spectra_std = metadata.mean('spectra train')
 
 # Build network
 model = build_starnet(config, device, model_name, 
@@ -97,7 +102,13 @@ for model_filename in model_filenames:
     model, losses, _ = load_model_state(model, model_filename)
     
     model.eval()
-    models.append(model)
+    if str2bool(args.traced):
+        # Predict with the traced model (of a copy, since the next model of the
+        # ensemble is loaded into the same module)
+        models.append(build_inference_model(copy.deepcopy(model), int(config['ARCHITECTURE']['spectrum_size']),
+                                            device, cache_dir=os.path.join(model_dir, 'inference_cache')))
+    else:
+        models.append(model)
 
 def predict_ensemble_labels(models, spectra, batchsize=2048):
     
@@ -113,9 +124,12 @@ def predict_ensemble_labels(models, spectra, batchsize=2048):
             for model in models:
                 # Perform forward propagation
                 # Forward propagation (and denormalize outputs)
-                label_preds = model(spectra[i:i+batchsize], 
-                                    norm_in=True, 
-                                    denorm_out=True)
+                if isinstance(model, torch.jit.ScriptModule):
+                    label_preds = model(spectra[i:i+batchsize])
+                else:
+                    label_preds = model(spectra[i:i+batchsize], 
+                                        norm_in=True, 
+                                        denorm_out=True)
 
 
                 # Save predictions
@@ -1,86 +1,33 @@
 import numpy as np
 import torch
-import h5py
 
-def add_noise(x, noise_factor=0.07):
+import os
+import sys
+cur_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(cur_dir, '..', 'data_utils'))
+from spectra_dataset import BaseSpectraDataset, label_candidates, batch_to_device
+from layouts import FullSpectrumLayout
+from augmentations import SpectrumAugmenter
 
-    if type(noise_factor) == float or type(noise_factor) == int or type(noise_factor) == np.float64:
-        noise_factor = noise_factor*np.median(x)
-        noise = noise_factor * np.random.normal(loc=0.0, scale=1.0, size=x.shape)
-        x += noise
-    else:
-        raise ValueError('Noise parameter must be a float or integer')
-    return x
+class SpectraDatasetSimple(BaseSpectraDataset):
 
-def batch_to_device(batch, device):
-    for k in batch.keys():
-        if isinstance(batch[k], list):
-            for i in range(len(batch[k])):
-                batch[k][i] = batch[k][i].to(device)
-        else:
-            try:
-                batch[k] = batch[k].to(device)
-            except AttributeError:
-                batch[k] = torch.tensor(batch[k]).to(device)
-    return batch
-
-class SpectraDatasetSimple(torch.utils.data.Dataset):
-    
     """
     Dataset loader for the spectral datasets.
+
+    Each sample has the full spectrum (with optional random noise) and its labels.
     """
 
-    def __init__(self, data_file, dataset, label_keys, 
+    def __init__(self, data_file, dataset, label_keys,
                  label_survey=None, max_noise_factor=0.0):
-        
-        self.data_file = data_file
-        self.dataset = dataset.lower()
+
         self.label_keys = label_keys
         self.label_survey = label_survey
         self.max_noise_factor = max_noise_factor
-        # Determine the number of pixels in each spectrum
-        self.num_pixels = self.determine_num_pixels()
-                        
-    def __len__(self):
-        with h5py.File(self.data_file, "r") as f:    
-            num_spectra = len(f['spectra %s' % self.dataset])
-        return num_spectra
-    
-    def determine_num_pixels(self):
-        with h5py.File(self.data_file, "r") as f:    
-            num_pixels = f['spectra %s' % self.dataset].shape[1]
-        return num_pixels
-    
-    def __getitem__(self, idx):
-        
-        with h5py.File(self.data_file, "r") as f: 
-                
-            # Load spectrum
-            spectrum = f['spectra %s' % self.dataset][idx]
-            spectrum[spectrum<-1] = -1.
 
-            # Add random noise
-            if self.max_noise_factor>0.0:
-                # Determine noise factor
-                noise_factor = np.random.uniform(0.0001, self.max_noise_factor)
-                spectrum = add_noise(spectrum, noise_factor=noise_factor)
-            
-            spectrum = torch.from_numpy(spectrum.astype(np.float32))
-            
-            # Load target stellar labels
-            data_keys = f.keys()
-            labels = []
-            for k in self.label_keys:                
-                data_key = k + ' %s' % self.dataset
-                if self.label_survey is not None:
-                    data_key = self.label_survey + ' ' + data_key
-                
-                if data_key in data_keys:
-                    labels.append(f[data_key][idx])
-                else:
-                    labels.append(np.nan)
-            labels = torch.from_numpy(np.asarray(labels).astype(np.float32))
-            
-        # Return full spectrum and target labels
-        return {'spectrum':spectrum,
-                'labels':labels}
\ No newline at end of file
+        # Add random noise
+        layout = FullSpectrumLayout(SpectrumAugmenter(add_noise=max_noise_factor>0.0,
+                                                      max_noise_factor=max_noise_factor))
+
+        super().__init__(data_file, dataset,
+                         {'labels': label_candidates(label_keys, dataset.lower(), label_survey)},
+                         layout)
@@ -1,20 +1,49 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from torchsummary import summary
 
 import numpy as np
 import os
+import sys
+cur_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(cur_dir, '..', 'data_utils'))
+from inference_cache import inference_cache_key, trace_inference_model
+from layer_shapes import compute_out_size
 from training_utils import str2bool
 from collections import defaultdict
 
-def compute_out_size(in_size, mod):
+def summary(model, input_size):
     """
-    Compute output size of Module `mod` given an input with size `in_size`.
+    Print the output shape and number of parameters of each layer, as
+    torchsummary does, without running the model.
+    
+    The shapes are propagated through the child modules in the order that
+    they were created, which is assumed to be the order of the forward pass
+    (with the input flattened before the first Linear layer).
     """
     
-    f = mod.forward(torch.autograd.Variable(torch.Tensor(1, *in_size)))
-    return f.size()[1:]
+    shape = (1, input_size[0])
+    rows = []
+    for i, (name, layer) in enumerate(model.named_children()):
+        if isinstance(layer, nn.Linear):
+            shape = (layer.out_features,)
+        else:
+            shape = tuple(compute_out_size(shape, layer))
+        num_params = sum(p.numel() for p in layer.parameters())
+        rows.append(('%s-%i' % (type(layer).__name__, i+1), str([-1, *shape]), num_params))
+    
+    total_params = sum(p.numel() for p in model.parameters())
+    trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    print('-'*64)
+    print('%20s  %25s %15s' % ('Layer (type)', 'Output Shape', 'Param #'))
+    print('='*64)
+    for row in rows:
+        print('%20s  %25s %15s' % (row[0], row[1], '{0:,}'.format(row[2])))
+    print('='*64)
+    print('Total params: {0:,}'.format(total_params))
+    print('Trainable params: {0:,}'.format(trainable_params))
+    print('Non-trainable params: {0:,}'.format(total_params - trainable_params))
+    print('-'*64)
 
 class StarNet(nn.Module):
     def __init__(self, num_pixels, num_filters, filter_length, 
@@ -71,6 +100,32 @@ class StarNet(nn.Module):
             
         return x
 
+class StarNetInference(nn.Module):
+    '''Denormalized label prediction of StarNet from unnormalized spectra.'''
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, spectra):
+        return self.model(spectra, norm_in=True, denorm_out=True)
+
+def build_inference_model(model, spectrum_size, device, cache_dir=None):
+    '''
+    Build a traced and frozen StarNetInference module for spectra of
+    `spectrum_size` pixels. With a `cache_dir`, the traced module is saved
+    there under a hash of the weights, normalization and options and loaded
+    by later builds.
+    '''
+    device = torch.device(device)
+    inference_model = StarNetInference(model).to(device).eval()
+    options = {'spectrum_size': spectrum_size, 'device': device.type, 'torch': torch.__version__}
+    # The normalization is stored outside of the state dict
+    norm_tensors = [torch.as_tensor(np.asarray(t, dtype=np.float32)) if not torch.is_tensor(t) else t
+                    for t in [model.spectra_mean, model.spectra_std, model.labels_mean, model.labels_std]]
+    return trace_inference_model(inference_model, [torch.ones(2, spectrum_size, device=device)],
+                                 'starnet_supervised_inference', cache_dir,
+                                 inference_cache_key(model, options, norm_tensors))
+
 def build_starnet(config, device, model_name, 
                   spectra_mean, spectra_std, 
                   labels_mean, labels_std):
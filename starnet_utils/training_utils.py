@@ -30,6 +30,10 @@ def parseArguments():
     parser.add_argument("-dd", "--data_dir", 
                         help="Data directory if different from StarNet_SS/data/", 
                         type=str, default=None)
+    # Traced model built by build_inference_model (for the prediction scripts)
+    parser.add_argument("-tr", "--traced", 
+                        help="Predict with the traced inference model (cached in models/inference_cache/).", 
+                        type=str, default='False')
     
     # Parse arguments
     args = parser.parse_args()
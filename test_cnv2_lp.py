@@ -24,6 +24,10 @@ print('Using Torch version: %s' % (torch.__version__))
 
 # Collect the command line arguments
 args = parseArguments()
+if str2bool(args.quantized):
+    # The int8 model runs on the CPU, so the model and its label grids
+    # are built there
+    device = torch.device('cpu')
 model_name = args.model_name
 data_dir = args.data_dir
 
@@ -64,6 +68,12 @@ model = build_encoder(config, device, model_name)
 model_filename =  os.path.join(model_dir, model_name+'_lp.pth.tar')
 model, losses, _ = load_model_state(model, model_filename)
 
+if str2bool(args.quantized):
+    # Evaluate the int8 model written by quantize_model.py (on the CPU)
+    sys.path.append(os.path.join(cur_dir,'quant_utils'))
+    from quantize import load_quantized_model
+    model = load_quantized_model(model, os.path.join(model_dir, model_name+'_lp_int8.pth.tar'))
+
 # Create data loaders
 source_train_dataset = SpectraDataset(source_data_file, 
                                       dataset='train', 
@@ -3,7 +3,9 @@ import os
 cur_dir = os.path.dirname(__file__)
 import sys
 sys.path.append(os.path.join(cur_dir,'mae_utils'))
+sys.path.append(os.path.join(cur_dir,'data_utils'))
 from data_loader import SpectraDataset, batch_to_device
+from metadata_cache import MetadataCache
 from training_utils import str2bool, parseArguments, LARS
 from mae_network import build_mae, load_model_state
 from analysis_fns import (plot_progress, plot_val_MAEs, encoder_predict,
@@ -24,6 +26,10 @@ print('Using Torch version: %s' % (torch.__version__))
 
 # Collect the command line arguments
 args = parseArguments()
+if str2bool(args.quantized):
+    # The int8 model runs on the CPU, so the model and its label grids
+    # are built there
+    device = torch.device('cpu')
 model_name = args.model_name
 data_dir = args.data_dir
 
@@ -55,11 +61,12 @@ wave_grid = np.load(wave_grid_file)
 
 
 # Calculate multimodal values from source training set
-with h5py.File(source_data_file, "r") as f:
-    mutlimodal_vals = []
-    for k in multimodal_keys:
-        vals = np.unique(f[k + ' train'][:]).astype(np.float32)
-        mutlimodal_vals.append(torch.from_numpy(vals).to(device))
+# (cached next to the data file after the first run)
+metadata = MetadataCache(source_data_file)
+mutlimodal_vals = []
+for k in multimodal_keys:
+    vals = metadata.unique(k + ' train').astype(np.float32)
+    mutlimodal_vals.append(torch.from_numpy(vals).to(device))
         
 # Build network
 model = build_mae(config, device, model_name, mutlimodal_vals)
@@ -68,6 +75,12 @@ model = build_mae(config, device, model_name, mutlimodal_vals)
 model_filename =  os.path.join(model_dir, model_name+'_lp.pth.tar')
 model, losses, _ ,_ = load_model_state(model, model_filename)
 
+if str2bool(args.quantized):
+    # Evaluate the int8 model written by quantize_model.py (on the CPU)
+    sys.path.append(os.path.join(cur_dir,'quant_utils'))
+    from quantize import load_quantized_model
+    model = load_quantized_model(model, os.path.join(model_dir, model_name+'_lp_int8.pth.tar'))
+
 # Create data loaders
 source_train_dataset = SpectraDataset(source_data_file, 
                                       dataset='train', 
@@ -3,9 +3,12 @@ import os
 cur_dir = os.path.dirname(__file__)
 import sys
 sys.path.append(os.path.join(cur_dir,'utils'))
+sys.path.append(os.path.join(cur_dir,'data_utils'))
 from data_loader import SpectraDataset, batch_to_device
+from metadata_cache import MetadataCache
 from training_utils import (parseArguments, str2bool)
-from network import StarNet, build_starnet, load_model_state
+from network import (StarNet, build_starnet, load_model_state, optimize_for_inference,
+                     build_inference_model)
 from analysis_fns import (plot_progress, plot_val_MAEs, predict_labels, 
                           predict_ensemble, plot_resid, plot_resid_violinplot,
                            plot_one_to_one, plot_wave_sigma, plot_resid, tsne_comparison)
@@ -23,6 +26,10 @@ print('Using Torch version: %s' % (torch.__version__))
 
 # Collect the command line arguments
 args = parseArguments()
+if str2bool(args.quantized):
+    # The int8 model runs on the CPU, so the model and its label grids
+    # are built there
+    device = torch.device('cpu')
 model_name = args.model_name
 data_dir = args.data_dir
 
@@ -49,11 +56,12 @@ divide_by_median = str2bool(config['DATA']['divide_by_median'])
 batch_size = int(config['TRAINING']['batchsize'])
 
 # Calculate multimodal values from source training set
-with h5py.File(source_data_file, "r") as f:
-    mutlimodal_vals = []
-    for k in multimodal_keys:
-        vals = np.unique(f[k + ' train'][:]).astype(np.float32)
-        mutlimodal_vals.append(torch.from_numpy(vals).to(device))
+# (cached next to the data file after the first run)
+metadata = MetadataCache(source_data_file)
+mutlimodal_vals = []
+for k in multimodal_keys:
+    vals = metadata.unique(k + ' train').astype(np.float32)
+    mutlimodal_vals.append(torch.from_numpy(vals).to(device))
 
 # Build network
 model = build_starnet(config, device, model_name, mutlimodal_vals)
@@ -62,6 +70,22 @@ model = build_starnet(config, device, model_name, mutlimodal_vals)
 model_filename =  os.path.join(model_dir, model_name+'.pth.tar')
 model, losses, cur_iter = load_model_state(model, model_filename)
 
+if str2bool(args.quantized):
+    # Evaluate the int8 model written by quantize_model.py (on the CPU)
+    sys.path.append(os.path.join(cur_dir,'quant_utils'))
+    from quantize import load_quantized_model
+    model = load_quantized_model(model, os.path.join(model_dir, model_name+'_int8.pth.tar'),
+                                 prepare_fn=optimize_for_inference)
+    inference_model = None
+elif str2bool(args.traced):
+    # Predict the labels and feature maps with the folded and traced model
+    model.eval_mode()
+    inference_model = build_inference_model(model, int(config['ARCHITECTURE']['spectrum_size']), device,
+                                            cache_dir=os.path.join(model_dir, 'inference_cache'),
+                                            return_feats=True)
+else:
+    inference_model = None
+
 # Create dataset for loading spectra
 source_train_dataset = SpectraDataset(source_data_file, 
                                       dataset='train', 
@@ -129,7 +153,7 @@ print('The source validation set consists of %i spectra.' % (len(source_val_data
 print('The target training set consists of %i spectra.' % (len(target_train_dataset)))
 print('The target validation set consists of %i spectra.' % (len(target_val_dataset)))
 
-def predict_labels(model, dataloader, device, batchsize=16, take_mode=False):
+def predict_labels(model, dataloader, device, batchsize=16, take_mode=False, inference_model=None):
     
     print('Predicting on %i batches...' % (len(dataloader)))
     try:
@@ -155,14 +179,20 @@ def predict_labels(model, dataloader, device, batchsize=16, take_mode=False):
                 tgt_um_labels.append(batch['unimodal labels'].data.cpu().numpy())
 
             # Perform forward propagation
-            try:
-                model_outputs = model(batch['spectrum'],
-                                  batch['spectrum index'],
-                                  norm_in=True, denorm_out=True, return_feats=True)
-            except AttributeError:
-                model_outputs = model.module(batch['spectrum'],
-                                  batch['spectrum index'],
-                                  norm_in=True, denorm_out=True, return_feats=True)
+            if inference_model is not None:
+                labels, feature_map = inference_model(batch['spectrum'], batch['spectrum index'])
+                model_outputs = {'multimodal labels': labels[:,:model.num_mm_labels],
+                                 'unimodal labels': labels[:,model.num_mm_labels:],
+                                 'feature map': feature_map}
+            else:
+                try:
+                    model_outputs = model(batch['spectrum'],
+                                      batch['spectrum index'],
+                                      norm_in=True, denorm_out=True, return_feats=True)
+                except AttributeError:
+                    model_outputs = model.module(batch['spectrum'],
+                                      batch['spectrum index'],
+                                      norm_in=True, denorm_out=True, return_feats=True)
 
                 
             # Save predictions
@@ -195,7 +225,8 @@ plot_val_MAEs(losses, multimodal_keys+unimodal_keys,
  pred_mm_labels, pred_um_labels, feature_maps_src) = predict_labels(model,
                                                                 source_val_dataloader, 
                                                                 device=device, 
-                                                                take_mode=False)
+                                                                take_mode=False,
+                                                                inference_model=inference_model)
 # Save predictions
 np.save(os.path.join(results_dir, '%s_source_mm_preds.npy'%model_name), pred_mm_labels)
 np.save(os.path.join(results_dir, '%s_source_mm_tgts.npy'%model_name), tgt_mm_labels)
@@ -210,7 +241,8 @@ plot_resid_violinplot(multimodal_keys, tgt_mm_labels, pred_mm_labels,
  pred_mm_labels, pred_um_labels, feature_maps_tgt) = predict_labels(model,
                                                                 target_val_dataloader, 
                                                                 device=device, 
-                                                                take_mode=False)
+                                                                take_mode=False,
+                                                                inference_model=inference_model)
 '''
 (tgt_mm_labels2, tgt_um_labels, 
  pred_mm_labels2, pred_um_labels, feature_maps_tgt2) = predict_labels(model, target_train_dataloader, 
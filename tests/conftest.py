@@ -0,0 +1,57 @@
+import os
+import sys
+cur_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(cur_dir, '..', 'utils'))
+sys.path.append(os.path.join(cur_dir, '..', 'data_utils'))
+sys.path.append(os.path.join(cur_dir, '..', 'mae_utils'))
+sys.path.append(os.path.join(cur_dir, '..', 'onnx_utils'))
+
+import configparser
+import pytest
+import torch
+
+from network import StarNet
+
+@pytest.fixture
+def starnet_config():
+    '''Architecture of starnet_ss_1 with narrower and shallower encoder stages.'''
+    config = configparser.ConfigParser()
+    config.read(os.path.join(cur_dir, '..', 'configs', 'starnet_ss_1.ini'))
+    config['ARCHITECTURE']['conv_widths_sh'] = '[16, 32]'
+    config['ARCHITECTURE']['conv_depths_sh'] = '[1, 2]'
+    config['ARCHITECTURE']['stem_features_sh'] = '8'
+    config['ARCHITECTURE']['unimodal_means'] = '[0.5]'
+    config['ARCHITECTURE']['unimodal_stds'] = '[2.0]'
+    return config
+
+@pytest.fixture
+def small_starnet(starnet_config):
+    '''
+    A small StarNet (with multimodal, unimodal and task heads) in eval mode,
+    with non-trivial BatchNorm statistics, LayerScaler gammas and LayerNorm
+    affine parameters, as in a trained model.
+    '''
+    torch.manual_seed(0)
+    mutlimodal_vals = [torch.linspace(-1, 1, 11) for k in range(4)]
+    model = StarNet(starnet_config['ARCHITECTURE'], ['teff', 'feh', 'logg', 'alpha'], ['vrad'],
+                    mutlimodal_vals, 'cpu')
+    with torch.no_grad():
+        for mod in model.modules():
+            if isinstance(mod, torch.nn.BatchNorm1d):
+                mod.running_mean.normal_(0, 0.5)
+                mod.running_var.uniform_(0.5, 2.)
+                mod.weight.normal_(1, 0.2)
+                mod.bias.normal_(0, 0.2)
+            elif isinstance(mod, torch.nn.LayerNorm) and mod.elementwise_affine:
+                mod.weight.normal_(1, 0.2)
+                mod.bias.normal_(0, 0.2)
+            elif hasattr(mod, 'gamma'):
+                mod.gamma.normal_(0, 0.1)
+    model.eval_mode()
+    return model.eval()
+
+@pytest.fixture
+def spectra():
+    '''Random full spectra (800 pixels) and their pixel indices.'''
+    torch.manual_seed(1)
+    return 0.913 + 0.16*torch.randn(8, 800), torch.zeros(8, dtype=torch.long)
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import torch
+
+from augmentations import batch_median, batch_snr, calc_snr, BatchAugmenter
+from chunks import BatchChunkSampler
+
+@pytest.fixture
+def noisy_spectra():
+    '''Spectra with dropped out pixels, including one with too few pixels for an snr.'''
+    rng = np.random.default_rng(0)
+    x = 1 + 0.05*rng.standard_normal((16, 300))
+    x[rng.random(x.shape)<0.2] = 0.
+    x[3,:295] = 0.
+    return x
+
+@pytest.mark.parametrize('num_pixels', [9, 10])
+def test_batch_median(num_pixels):
+    rng = np.random.default_rng(1)
+    x = rng.standard_normal((8, num_pixels))
+    mask = rng.random(x.shape)<0.7
+    mask[:,0] = True
+    expected = [np.median(row[m]) for row, m in zip(x, mask)]
+    assert np.allclose(batch_median(torch.from_numpy(x), torch.from_numpy(mask)).numpy(), expected)
+    assert np.allclose(batch_median(torch.from_numpy(x)).numpy(), np.median(x, axis=1))
+
+@pytest.mark.parametrize('dtype, rtol', [(np.float64, 1e-12), (np.float32, 3e-6)])
+def test_batch_snr_matches_calc_snr(noisy_spectra, dtype, rtol):
+    x = noisy_spectra.astype(dtype)
+    expected = np.array([calc_snr(s[s>0.1]) for s in x])
+    assert expected[3]==1/(1+1e-3)
+    assert np.allclose(batch_snr(torch.from_numpy(x)).numpy(), expected, rtol=rtol, atol=0)
+
+def test_batch_augmenter_labels(noisy_spectra):
+    spectra = torch.from_numpy(noisy_spectra.astype(np.float32))
+    original = spectra.clone()
+    centre_wave = torch.linspace(15000, 17000, len(spectra))
+    tasks = ['wavelength', 'bias', 'snr', 'slope']
+    augmenter = BatchAugmenter(tasks, [0, 0.1, 0, 1e-4], [1, 0.05, 1, 1e-4],
+                               generator=torch.Generator().manual_seed(0))
+    augmented, task_labels = augmenter(spectra, centre_wave)
+
+    # The input is left untouched
+    assert torch.equal(spectra, original)
+    assert task_labels.shape==(len(spectra), len(tasks))
+    assert torch.equal(task_labels[:,0], centre_wave)
+    # The bias and slope are added with the values of their labels
+    pixel_indx = torch.arange(spectra.shape[1]).unsqueeze(0)
+    expected = original + task_labels[:,1:2] + pixel_indx*task_labels[:,3:4]
+    assert torch.allclose(augmented, expected, atol=1e-5)
+    # The snr is measured after the bias (and before the slope)
+    with_bias = (original + task_labels[:,1:2]).numpy()
+    assert np.allclose(task_labels[:,2].numpy(), [calc_snr(s[s>0.1]) for s in with_bias], rtol=3e-6)
+
+def test_batch_augmenter_dropout_and_noise(noisy_spectra):
+    spectra = torch.from_numpy(noisy_spectra.astype(np.float32)) + 1
+    augmenter = BatchAugmenter([], [], [], add_noise=True, apply_dropout=True,
+                               max_chunks=3, max_chunk_size=50, generator=torch.Generator().manual_seed(0))
+    augmented, task_labels = augmenter(spectra, torch.zeros(len(spectra)))
+    assert task_labels.shape==(len(spectra), 0)
+    # Only the dropped out chunks are zero and everything else is noisy
+    dropped = augmented==0
+    assert dropped.any()
+    assert (augmented[~dropped]!=spectra[~dropped]).all()
+
+def test_batch_chunk_sampler():
+    num_pixels, chunk_size = 300, 40
+    wave_grid = np.linspace(15000, 17000, num_pixels)
+    sampler = BatchChunkSampler(wave_grid, [0, 100, 200], chunk_size, random_chunk=True,
+                                generator=torch.Generator().manual_seed(0))
+    spectra = torch.rand((32, num_pixels))
+    # The middle channel of the first half of the batch is flat
+    spectra[:16,100:200] = 1.
+
+    chunks, chunk_indx, centre_wave, centre_wave_full = sampler(spectra)
+    for spectrum, chunk, start, centre, full in zip(spectra, chunks, chunk_indx, centre_wave, centre_wave_full):
+        assert torch.equal(chunk, spectrum[start:start+chunk_size])
+        assert centre==np.float32(np.median(wave_grid[start:start+chunk_size]))
+        # Each chunk is entirely within one channel
+        assert start//100==(start+chunk_size-1)//100
+    # Chunks are only taken from the valid channels
+    assert ((chunk_indx[:16]<100) | (chunk_indx[:16]>=200)).all()
+    valid_wave = np.concatenate([wave_grid[:100], wave_grid[200:]])
+    assert np.allclose(centre_wave_full[:16].numpy(), valid_wave.mean())
+    assert np.allclose(centre_wave_full[16:].numpy(), wave_grid.mean())
@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+
+from collate import RingCollate
+
+def make_samples(batch_size, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{'spectrum': torch.from_numpy(rng.standard_normal(20).astype(np.float32)),
+             'multimodal labels': rng.standard_normal(3),
+             'chunk index': int(rng.integers(100)),
+             'centre wave': float(rng.random()),
+             'valid': bool(rng.random()>0.5)} for _ in range(batch_size)]
+
+def assert_batches_equal(batch, expected):
+    assert batch.keys()==expected.keys()
+    for k in expected.keys():
+        assert batch[k].dtype==expected[k].dtype
+        assert torch.equal(batch[k], expected[k])
+
+def test_matches_default_collate():
+    collate = RingCollate(num_slots=2)
+    for seed, batch_size in enumerate([8, 8, 8, 5]):
+        samples = make_samples(batch_size, seed)
+        assert_batches_equal(collate.collate(samples), torch.utils.data.default_collate(samples))
+
+def test_buffers_are_reused_after_num_slots():
+    collate = RingCollate(num_slots=2)
+    first = collate.collate(make_samples(8, 0))
+    second = collate.collate(make_samples(8, 1))
+    third = collate.collate(make_samples(8, 2))
+    assert first['spectrum'].data_ptr()!=second['spectrum'].data_ptr()
+    assert first['spectrum'].data_ptr()==third['spectrum'].data_ptr()
+    # The smaller last batch is a view of the same buffer
+    fourth = collate.collate(make_samples(5, 3))
+    assert fourth['spectrum'].data_ptr()==second['spectrum'].data_ptr()
+
+class SampleDataset(torch.utils.data.Dataset):
+    def __len__(self):
+        return 20
+
+    def __getitem__(self, idx):
+        return make_samples(1, idx)[0]
+
+def test_dataloader_batches():
+    dataset = SampleDataset()
+    # The main process falls back on default_collate
+    assert RingCollate()(make_samples(4)).keys()==make_samples(1)[0].keys()
+    loader = torch.utils.data.DataLoader(dataset, batch_size=8, num_workers=1,
+                                         collate_fn=RingCollate())
+    reference = torch.utils.data.DataLoader(dataset, batch_size=8)
+    for batch, expected in zip(loader, reference):
+        assert_batches_equal(batch, expected)
@@ -0,0 +1,69 @@
+import os
+import torch
+
+import network
+from network import build_inference_model, inference_cache_key, StarNetInference
+
+def eager_labels(model, x, pixel_indx):
+    '''Labels of the (unfolded) eager model.'''
+    with torch.no_grad():
+        return StarNetInference(model).eval()(x, pixel_indx)
+
+def test_traced_model_matches_eager(small_starnet, spectra, tmp_path):
+    x, pixel_indx = spectra
+    traced = build_inference_model(small_starnet, 800, 'cpu', cache_dir=str(tmp_path))
+    with torch.no_grad():
+        labels = traced(x, pixel_indx)
+    # Four multimodal labels and one unimodal label per spectrum
+    assert labels.shape==(8, 5)
+    assert torch.allclose(labels, eager_labels(small_starnet, x, pixel_indx), rtol=1e-4, atol=1e-5)
+    assert len(os.listdir(tmp_path))==1
+
+def test_cached_model_is_reloaded(small_starnet, spectra, tmp_path, monkeypatch):
+    x, pixel_indx = spectra
+    build_inference_model(small_starnet, 800, 'cpu', cache_dir=str(tmp_path))
+
+    # The second build has to load the module saved by the first
+    def no_trace(*args, **kwargs):
+        raise AssertionError('The model was traced again instead of loaded from the cache.')
+    monkeypatch.setattr(network.torch.jit, 'trace', no_trace)
+    cached = build_inference_model(small_starnet, 800, 'cpu', cache_dir=str(tmp_path))
+    with torch.no_grad():
+        labels = cached(x, pixel_indx)
+    assert torch.allclose(labels, eager_labels(small_starnet, x, pixel_indx), rtol=1e-4, atol=1e-5)
+
+def test_cache_key_changes(small_starnet):
+    options = {'spectrum_size': 800, 'norm_in': True, 'take_mode': False}
+    key = inference_cache_key(small_starnet, options)
+    assert inference_cache_key(small_starnet, dict(options))==key
+
+    # Build options
+    assert inference_cache_key(small_starnet, dict(options, take_mode=True))!=key
+    # Weights
+    with torch.no_grad():
+        small_starnet.unimodal_predictor.fc_model[-1].bias.add_(1e-3)
+    assert inference_cache_key(small_starnet, options)!=key
+
+def test_rebuild_after_weight_change(small_starnet, spectra, tmp_path):
+    x, pixel_indx = spectra
+    build_inference_model(small_starnet, 800, 'cpu', cache_dir=str(tmp_path))
+    with torch.no_grad():
+        small_starnet.unimodal_predictor.fc_model[-1].bias.add_(1.)
+    rebuilt = build_inference_model(small_starnet, 800, 'cpu', cache_dir=str(tmp_path))
+    # A new module is traced for the new weights rather than the stale one loaded
+    assert len(os.listdir(tmp_path))==2
+    with torch.no_grad():
+        labels = rebuilt(x, pixel_indx)
+    assert torch.allclose(labels, eager_labels(small_starnet, x, pixel_indx), rtol=1e-4, atol=1e-5)
+
+def test_traced_feature_maps(small_starnet, spectra, tmp_path):
+    x, pixel_indx = spectra
+    traced = build_inference_model(small_starnet, 800, 'cpu', cache_dir=str(tmp_path), return_feats=True)
+    with torch.no_grad():
+        labels, feature_map = traced(x, pixel_indx)
+        feature_map_eager = small_starnet(x, pixel_indx, return_feats_only=True)
+    assert torch.allclose(labels, eager_labels(small_starnet, x, pixel_indx), rtol=1e-4, atol=1e-5)
+    assert torch.allclose(feature_map, feature_map_eager, rtol=1e-4, atol=1e-4)
+    # The labels-only model is cached separately
+    build_inference_model(small_starnet, 800, 'cpu', cache_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path))==2
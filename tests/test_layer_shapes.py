@@ -0,0 +1,26 @@
+import pytest
+import torch
+from torch import nn
+
+from layer_shapes import propagate_size, compute_out_size
+from network import ConvNextEncoder, StarNet_convs
+
+@pytest.mark.parametrize('mod', [
+    nn.Sequential(nn.Conv1d(1, 4, 8), nn.ReLU(), nn.Conv1d(4, 16, 8, stride=3), nn.MaxPool1d(4)),
+    nn.Sequential(nn.Conv1d(1, 4, 7, padding=3, dilation=2), nn.AvgPool1d(3, ceil_mode=True)),
+    nn.Sequential(nn.Conv1d(1, 8, 5, padding='same'), nn.GELU(), nn.AdaptiveAvgPool1d(10)),
+    StarNet_convs(num_filters=[4, 16], strides=[2, 1], pool_length=7),
+    ConvNextEncoder(in_channels=1, stem_features=8, stem_filt_size=4, stem_stride=4,
+                    depths=[1, 1], widths=[8, 16], pool_length=5),
+])
+def test_sizes_match_the_forward_pass(mod):
+    with torch.no_grad():
+        out = mod.eval()(torch.zeros(1, 1, 801))
+    assert tuple(propagate_size((1, 801), mod))==tuple(out.shape[1:])
+    assert compute_out_size((1, 801), mod)==out.shape[1:]
+
+def test_unsupported_layers_are_traced():
+    mod = nn.Sequential(nn.Conv1d(1, 4, 8), nn.Upsample(scale_factor=2))
+    with pytest.raises(NotImplementedError):
+        propagate_size((1, 100), mod)
+    assert compute_out_size((1, 100), mod)==torch.Size((4, 186))
@@ -0,0 +1,57 @@
+import torch
+
+from network import StarNet_head, load_model_state
+
+def old_checkpoint(model, x, pixel_indx):
+    '''
+    A checkpoint in the older format, where each multimodal classifier was a
+    separate StarNet_head, saved in 'classifier models' and optimized after
+    the encoder parameters (and before the unimodal head parameters).
+    '''
+    heads = [StarNet_head(model.label_classifier.fc.in_features, n, logsoftmax=True)
+             for n in model.label_classifier.out_features]
+    head_params = set(id(p) for p in model.label_classifier.parameters())
+    params = []
+    for p in model.all_parameters():
+        if id(p) not in head_params:
+            params.append(p)
+        elif p is model.label_classifier.fc.weight:
+            for head in heads:
+                params += list(head.parameters())
+    optimizer = torch.optim.AdamW(params, lr=1e-3)
+
+    # One step to fill the optimizer states
+    outputs = model(x, pixel_indx, denorm_out=False, return_feats=True)
+    loss = outputs['unimodal labels'].abs().mean() + sum(head(outputs['feature map']).mean() for head in heads)
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad()
+
+    model_state = {k: v for k, v in model.state_dict().items() if not k.startswith('label_classifier.')}
+    return {'model': model_state, 'classifier models': [head.state_dict() for head in heads],
+            'optimizer': optimizer.state_dict(), 'losses': {}, 'batch_iters': 1}, optimizer
+
+def test_old_heads_keep_encoder_optimizer_states(small_starnet, spectra, tmp_path):
+    x, pixel_indx = spectra
+    small_starnet.train_mode()
+    checkpoint, old_optimizer = old_checkpoint(small_starnet, x, pixel_indx)
+    model_filename = str(tmp_path / 'old.pth.tar')
+    torch.save(checkpoint, model_filename)
+
+    optimizer = torch.optim.AdamW(small_starnet.all_parameters(), lr=1e-3)
+    load_model_state(small_starnet, model_filename, optimizer)
+
+    head_params = set(id(p) for p in small_starnet.label_classifier.parameters())
+    for p in optimizer.param_groups[0]['params']:
+        if id(p) in head_params:
+            # The fused classifier starts with fresh states
+            assert len(optimizer.state[p])==0
+        else:
+            # The old optimizer held the same encoder and unimodal head parameters
+            old_state = old_optimizer.state[p]
+            assert optimizer.state[p].keys()==old_state.keys()
+            assert all(torch.equal(optimizer.state[p][k], old_state[k]) for k in old_state.keys())
+
+    # The loaded states match their parameters
+    small_starnet(x, pixel_indx, denorm_out=False)['unimodal labels'].abs().mean().backward()
+    optimizer.step()
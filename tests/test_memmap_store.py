@@ -0,0 +1,32 @@
+import numpy as np
+import h5py
+import pytest
+
+from memmap_store import convert_h5_to_memmap, open_data_file
+
+@pytest.fixture
+def stores(tmp_path):
+    '''The same random columns in an HDF5 file and in a memmap directory.'''
+    rng = np.random.default_rng(0)
+    data_file = str(tmp_path / 'data.h5')
+    with h5py.File(data_file, 'w') as f:
+        f.create_dataset('spectra train', data=rng.standard_normal((200, 50)).astype(np.float32))
+        f.create_dataset('APOGEE teff train', data=rng.standard_normal(200))
+    convert_h5_to_memmap(data_file, str(tmp_path / 'data'), verbose=False)
+    return open_data_file(data_file), open_data_file(str(tmp_path / 'data'))
+
+@pytest.mark.parametrize('key', ['spectra train', 'APOGEE teff train'])
+def test_contiguous_rows_are_views(stores, key):
+    h5, store = stores
+    rows = store.read_rows(key, np.arange(40, 72))
+    assert np.shares_memory(rows, store.dataset(key))
+    assert not rows.flags.writeable
+    assert np.array_equal(rows, h5.read_rows(key, np.arange(40, 72)))
+
+@pytest.mark.parametrize('key', ['spectra train', 'APOGEE teff train'])
+def test_scattered_rows_are_copied(stores, key):
+    h5, store = stores
+    indices = np.array([150, 3, 4, 90, 3, 199, 0])
+    rows = store.read_rows(key, indices)
+    assert not np.shares_memory(rows, store.dataset(key))
+    assert np.array_equal(rows, h5.read_rows(key, indices))
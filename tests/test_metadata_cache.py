@@ -0,0 +1,65 @@
+import os
+import threading
+import numpy as np
+import h5py
+
+from metadata_cache import MetadataCache
+
+def write_data_file(data_file, seed=0):
+    rng = np.random.default_rng(seed)
+    with h5py.File(data_file, 'w') as f:
+        f.create_dataset('teff train', data=rng.integers(0, 20, 500).astype(np.float64))
+        f.create_dataset('vrad train', data=rng.standard_normal(500))
+
+def test_statistics_are_cached(tmp_path):
+    data_file = str(tmp_path / 'data.h5')
+    write_data_file(data_file)
+    with h5py.File(data_file, 'r') as f:
+        teff, vrad = f['teff train'][:], f['vrad train'][:]
+
+    cache = MetadataCache(data_file)
+    assert np.array_equal(cache.unique('teff train'), np.unique(teff))
+    assert np.allclose(cache.mean_std('vrad train'), (vrad.mean(), vrad.std()))
+
+    # A new cache reads both statistics back from the same file
+    cache = MetadataCache(data_file)
+    assert np.array_equal(cache.cached('unique/teff train'), np.unique(teff))
+    assert cache.cached('mean std/vrad train') is not None
+    # Only the cache file is left in the sidecar directory
+    assert os.listdir(os.path.dirname(cache.cache_file))==['metadata.h5']
+
+def test_stale_cache_is_cleared(tmp_path):
+    data_file = str(tmp_path / 'data.h5')
+    write_data_file(data_file)
+    MetadataCache(data_file).unique('teff train')
+
+    write_data_file(data_file, seed=1)
+    os.utime(data_file, ns=(0, 0))
+    caches = [MetadataCache(data_file), MetadataCache(data_file)]
+    assert not os.path.exists(caches[0].cache_file)
+    with h5py.File(data_file, 'r') as f:
+        assert np.array_equal(caches[1].unique('teff train'), np.unique(f['teff train'][:]))
+
+def test_concurrent_saves(tmp_path):
+    data_file = str(tmp_path / 'data.h5')
+    write_data_file(data_file)
+    cache = MetadataCache(data_file)
+    errors = []
+
+    def save(i):
+        try:
+            for j in range(5):
+                cache.save('value %i' % i, np.full(10, j))
+                cache.cached('value %i' % i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(errors)==0
+    # The cache file is always complete, although concurrent saves may drop each other's values
+    assert any(np.array_equal(cache.cached('value %i' % i), np.full(10, 4)) for i in range(4))
+    assert os.listdir(os.path.dirname(cache.cache_file))==['metadata.h5']
@@ -0,0 +1,55 @@
+import os
+import configparser
+import pytest
+import torch
+
+from network import optimize_for_inference, StarNetInference
+from mae_network import build_mae, MAELabelInference
+from onnx_predictor import export_onnx, OnnxPredictor, check_parity
+
+@pytest.fixture
+def small_mae():
+    '''A small MAE (of starnet_mae_91) with multimodal and unimodal linear probe heads, in eval mode.'''
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(__file__), '..', 'configs', 'starnet_mae_91.ini'))
+    config['MAE ARCHITECTURE']['encoder_depth'] = '2'
+    config['MAE ARCHITECTURE']['decoder_depth'] = '1'
+    config['DATA']['unimodal_keys'] = "['vrad']"
+    config['DATA']['unimodal_means'] = '[0.5]'
+    config['DATA']['unimodal_stds'] = '[2.0]'
+    torch.manual_seed(0)
+    mutlimodal_vals = [torch.linspace(-1, 1, 11) for k in range(4)]
+    model = build_mae(config, 'cpu', 'small_mae', mutlimodal_vals)
+    model.eval_mode()
+    return model.eval()
+
+def test_starnet_onnx_parity(small_starnet, spectra, tmp_path):
+    x, pixel_indx = spectra
+    onnx_filename = str(tmp_path / 'starnet_labels.onnx')
+    export_onnx(StarNetInference(optimize_for_inference(small_starnet)), [x[:2], pixel_indx[:2]],
+                onnx_filename, ['spectra', 'pixel_indx'])
+    # The exported (folded) graph against the labels of the unfolded model,
+    # for a batch size other than the one it was exported with
+    predictor = OnnxPredictor(onnx_filename)
+    check_parity(StarNetInference(small_starnet), predictor, [x, pixel_indx])
+
+def test_mae_onnx_parity(small_mae, spectra, tmp_path):
+    x, _ = spectra
+    onnx_filename = str(tmp_path / 'mae_labels.onnx')
+    export_onnx(MAELabelInference(small_mae), [x[:2]], onnx_filename, ['spectra'])
+    predictor = OnnxPredictor(onnx_filename)
+    check_parity(MAELabelInference(small_mae), predictor, [x])
+
+    # forward_labels with the patches in order gives the exported labels
+    with torch.no_grad():
+        outputs = small_mae.forward_labels(x, norm_in=True, denorm_out=True, keep_order=True)
+    labels = torch.cat([outputs['multimodal labels'], outputs['unimodal labels']], dim=1)
+    assert torch.allclose(labels, torch.from_numpy(predictor(x)), rtol=1e-4, atol=1e-5)
+
+def test_mae_encoder_shuffles_patches_by_default(small_mae, spectra):
+    x, _ = spectra
+    with torch.no_grad():
+        latent, mask, ids_restore = small_mae.forward_encoder(x, mask_ratio=0., norm_in=True)
+    # random_masking still shuffles the patches without masking them
+    assert torch.all(mask==0)
+    assert not torch.equal(ids_restore, torch.arange(ids_restore.shape[1]).expand_as(ids_restore))
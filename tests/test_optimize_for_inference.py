@@ -0,0 +1,48 @@
+import torch
+from torch import nn
+
+from network import (optimize_for_inference, ConvNextStem, BottleNeckBlock,
+                     LayerScaler, StarNet_head)
+
+def outputs_close(outputs, folded_outputs, rtol=1e-4):
+    '''Whether every output matches to within `rtol` of its largest value.'''
+    assert outputs.keys()==folded_outputs.keys()
+    for key in outputs.keys():
+        out = outputs[key] if isinstance(outputs[key], list) else [outputs[key]]
+        folded_out = folded_outputs[key] if isinstance(folded_outputs[key], list) else [folded_outputs[key]]
+        for a, b in zip(out, folded_out):
+            if not torch.allclose(a, b, rtol=0, atol=rtol*torch.max(torch.abs(a)).item()):
+                return False
+    return True
+
+def test_folded_layers(small_starnet):
+    folded = optimize_for_inference(small_starnet)
+    for mod in folded.modules():
+        if isinstance(mod, ConvNextStem):
+            assert not any(isinstance(m, nn.BatchNorm1d) for m in mod)
+        elif isinstance(mod, BottleNeckBlock):
+            assert not isinstance(mod.layer_scaler, LayerScaler)
+        elif isinstance(mod, StarNet_head):
+            assert not mod.fc_model[0].elementwise_affine
+    # The original model is left unchanged
+    assert any(isinstance(m, LayerScaler) for m in small_starnet.modules())
+
+def test_folded_outputs_match(small_starnet, spectra):
+    x, pixel_indx = spectra
+    folded = optimize_for_inference(small_starnet)
+    for kwargs in [dict(norm_in=True, denorm_out=True, return_feats=True),
+                   dict(norm_in=True, denorm_out=False)]:
+        with torch.no_grad():
+            outputs = small_starnet(x, pixel_indx, **kwargs)
+            folded_outputs = folded(x, pixel_indx, **kwargs)
+        assert outputs_close(outputs, folded_outputs)
+
+def test_folded_chunk_outputs_match(small_starnet, spectra):
+    # Chunks taken from the middle of the spectra (with their pixel offsets)
+    x, pixel_indx = spectra
+    x, pixel_indx = x[:, 100:350], pixel_indx + 100
+    folded = optimize_for_inference(small_starnet)
+    with torch.no_grad():
+        outputs = small_starnet(x, pixel_indx, norm_in=True, denorm_out=True)
+        folded_outputs = folded(x, pixel_indx, norm_in=True, denorm_out=True)
+    assert outputs_close(outputs, folded_outputs)
@@ -0,0 +1,8 @@
+from paired import CyclePairs
+
+def test_source_continues_across_passes():
+    pairs = CyclePairs(source_loader=[0, 1, 2], target_loader=['a', 'b'])
+    assert list(pairs)==[(0, 'a'), (1, 'b')]
+    # The next pass continues the source loader and restarts it when it runs out
+    assert list(pairs)==[(2, 'a'), (0, 'b')]
+    assert list(pairs)==[(1, 'a'), (2, 'b')]
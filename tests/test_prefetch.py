@@ -0,0 +1,33 @@
+import time
+import threading
+import pytest
+import torch
+
+from prefetch import DevicePrefetcher
+
+def test_batches_in_order():
+    batches = [torch.full((2,), float(i)) for i in range(5)]
+    prefetcher = DevicePrefetcher(batches, torch.device('cpu'), queue_size=2)
+    assert all(torch.equal(a, b) for a, b in zip(prefetcher, batches))
+    assert len(list(prefetcher))==5
+
+def test_early_exit_stops_the_thread():
+    def consume():
+        for batch in DevicePrefetcher([torch.zeros(2)]*3, torch.device('cpu'), queue_size=2):
+            # Let the thread fill the queue and block on the end of the loader
+            time.sleep(0.5)
+            break
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    consumer.join(timeout=5)
+    assert not consumer.is_alive()
+
+def test_loader_errors_are_raised():
+    def loader():
+        yield torch.zeros(2)
+        raise ValueError('bad batch')
+    prefetcher = DevicePrefetcher(loader(), torch.device('cpu'))
+    batches = iter(prefetcher)
+    next(batches)
+    with pytest.raises(ValueError, match='bad batch'):
+        next(batches)
@@ -0,0 +1,77 @@
+import numpy as np
+import h5py
+import pytest
+import torch
+
+from data_loader import SpectraDataset
+from memmap_store import convert_h5_to_memmap
+from spectrum_stats import compute_spectrum_stats
+
+@pytest.fixture
+def data_file(tmp_path):
+    '''60 spectra with continua and labels, including an 'alpha' in place of 'mg'.'''
+    rng = np.random.default_rng(0)
+    np.save(tmp_path / 'wavegrid.npy', np.linspace(15000, 17000, 800))
+    data_file = str(tmp_path / 'data.h5')
+    with h5py.File(data_file, 'w') as f:
+        spectra = 1 + 0.1*rng.standard_normal((60, 800))
+        spectra[rng.random(spectra.shape)<0.05] = -5.
+        f.create_dataset('spectra train', data=spectra.astype(np.float32))
+        f.create_dataset('continua train', data=(1 + 0.2*rng.random((60, 800))).astype(np.float32))
+        for k in ['teff', 'alpha']:
+            f.create_dataset('%s train' % k, data=rng.standard_normal(60))
+    return data_file
+
+def spectra_dataset(data_file, **kwargs):
+    wave_grid_file = data_file.replace('data.h5', 'wavegrid.npy')
+    return SpectraDataset(kwargs.pop('store_file', data_file), 'train', wave_grid_file,
+                          multimodal_keys=['teff', 'mg'], unimodal_keys=['vrad'],
+                          continuum_normalize=True, divide_by_median=True, chunk_size=100,
+                          tasks=['wavelength'], task_means=[16000.], task_stds=[500.],
+                          channel_indices=[0], **kwargs)
+
+def reference_sample(dataset, data_file, idx):
+    '''Sample `idx` read and normalized on its own, straight from the HDF5 file.'''
+    with h5py.File(data_file, 'r') as f:
+        spectrum = f['spectra train'][idx]
+        spectrum[spectrum<-1] = -1.
+        spectrum = spectrum/f['continua train'][idx]
+        labels = {'multimodal labels': np.array([f['teff train'][idx], f['alpha train'][idx]], dtype=np.float32),
+                  'unimodal labels': np.array([np.nan], dtype=np.float32)}
+    spectrum = spectrum/np.median(spectrum[spectrum>dataset.median_thresh])
+    return dataset.layout(spectrum, {k: torch.from_numpy(l) for k, l in labels.items()})
+
+def assert_samples_close(sample, expected, rtol=1e-6):
+    assert sample.keys()==expected.keys()
+    for k in expected.keys():
+        if isinstance(expected[k], torch.Tensor):
+            assert torch.allclose(sample[k], expected[k], rtol=rtol, equal_nan=True), k
+        else:
+            assert sample[k]==expected[k], k
+
+# Unsorted, with a contiguous run and a repeated index
+INDICES = [17, 3, 40, 41, 42, 43, 3, 59, 0]
+
+@pytest.mark.parametrize('backend', ['h5', 'memmap', 'preload'])
+@pytest.mark.parametrize('inference_mode', [True, False])
+def test_getitems_matches_single_samples(data_file, tmp_path, backend, inference_mode):
+    kwargs = {'inference_mode': inference_mode}
+    if backend=='memmap':
+        kwargs['store_file'] = str(tmp_path / 'data')
+        convert_h5_to_memmap(data_file, kwargs['store_file'], verbose=False)
+    elif backend=='preload':
+        kwargs['preload'] = True
+    dataset = spectra_dataset(data_file, **kwargs)
+
+    samples = dataset.__getitems__(INDICES)
+    assert len(samples)==len(INDICES)
+    for idx, sample in zip(INDICES, samples):
+        assert_samples_close(sample, dataset[idx])
+        assert_samples_close(sample, reference_sample(dataset, data_file, idx))
+
+def test_getitems_with_stats(data_file):
+    compute_spectrum_stats(data_file, datasets=['train'], channel_indices=[0],
+                           num_workers=1, verbose=False)
+    dataset = spectra_dataset(data_file, inference_mode=True, use_stats=True)
+    for idx, sample in zip(INDICES, dataset.__getitems__(INDICES)):
+        assert_samples_close(sample, reference_sample(dataset, data_file, idx), rtol=1e-5)
@@ -0,0 +1,55 @@
+import numpy as np
+import h5py
+import pytest
+import torch
+
+from data_loader import StreamingSpectraDataset
+
+@pytest.fixture
+def shards(tmp_path):
+    '''Three shards of 100 random spectra, with teff labels numbering the spectra.'''
+    rng = np.random.default_rng(0)
+    np.save(tmp_path / 'wavegrid.npy', np.linspace(15000, 17000, 800))
+    for s in range(3):
+        with h5py.File(tmp_path / ('shard_%i.h5' % s), 'w') as f:
+            f.create_dataset('spectra train', data=(1 + 0.1*rng.standard_normal((100, 800))).astype(np.float32))
+            for k in ['feh', 'logg', 'alpha']:
+                f.create_dataset('%s train' % k, data=rng.standard_normal(100))
+            f.create_dataset('teff train', data=np.arange(s*100, (s+1)*100, dtype=np.float64))
+    return tmp_path
+
+def streaming_dataset(shards, **kwargs):
+    return StreamingSpectraDataset(str(shards / 'shard_*.h5'), 'train', 
+                                   wave_grid_file=str(shards / 'wavegrid.npy'),
+                                   multimodal_keys=['teff', 'feh', 'logg', 'alpha'], unimodal_keys=[],
+                                   continuum_normalize=False, divide_by_median=True, chunk_size=100,
+                                   tasks=[], task_means=np.zeros(0), task_stds=np.ones(0),
+                                   channel_indices=[0], buffer_size=32, shard_block_size=16,
+                                   report_every=0, max_open_shards=2, **kwargs)
+
+def test_every_spectrum_once_with_bounded_shards(shards):
+    dataset = streaming_dataset(shards)
+    teff = []
+    for sample in dataset:
+        teff.append(int(sample['multimodal labels'][0]))
+        assert len(dataset.shard_datasets)<=2
+    assert sorted(teff)==list(range(300))
+    # The dataset of each shard is dropped once it has been read
+    assert len(dataset.shard_datasets)==0
+
+def test_preload_is_rejected(shards):
+    with pytest.raises(ValueError):
+        streaming_dataset(shards, preload=True)
+
+def test_missing_stats_are_rejected(shards):
+    with pytest.raises(FileNotFoundError, match='compute_spectrum_stats'):
+        streaming_dataset(shards, use_stats=True)
+
+def test_augment_batch_without_shard_datasets(shards):
+    dataset = streaming_dataset(shards, batch_augment=True)
+    batch = torch.utils.data.default_collate([sample for sample, i in zip(dataset, range(8))])
+    dataset.shard_datasets.clear()
+
+    batch = dataset.augment_batch(batch)
+    assert batch['spectrum chunk'].shape[-1]==100
+    assert len(dataset.shard_datasets)==0
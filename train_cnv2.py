@@ -4,7 +4,7 @@ cur_dir = os.path.dirname(__file__)
 import sys
 sys.path.append(os.path.join(cur_dir,'cnv2_utils'))
 from data_loader import SpectraDataset, batch_to_device
-from training_utils import parseArguments, mae_iter, str2bool
+from training_utils import parseArguments, mae_iter, str2bool, NativeScalerWithGradNormCount
 from network import build_mae, load_model_state
 
 import configparser
@@ -70,6 +70,8 @@ target_loss_weight = float(config['MAE TRAINING']['target_loss_weight'])
 weight_decay = float(config['MAE TRAINING']['weight_decay'])
 total_batch_iters = int(config['MAE TRAINING']['total_batch_iters'])
 mask_ratio = float(config['MAE TRAINING']['mask_ratio'])
+# Training precision (fp32, bf16 or fp16 autocast)
+precision = config['MAE TRAINING'].get('precision', 'fp32')
 
 # Build network
 model = build_mae(config, device, model_name)
@@ -81,6 +83,8 @@ optimizer = torch.optim.AdamW(model.parameters(),
                               betas=(0.9, 0.95))
 print(optimizer)
 
+# Autocast precision and loss scaling
+loss_scaler = NativeScalerWithGradNormCount(precision, device)
 
 # Learning rate scheduler
 lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, lr,
@@ -98,7 +102,7 @@ if use_prev_ae:
 else:
     model_filename =  os.path.join(model_dir, model_name+'.pth.tar')
 model, losses, cur_iter = load_model_state(model, model_filename, 
-                                           optimizer, lr_scheduler)
+                                           optimizer, lr_scheduler, loss_scaler=loss_scaler)
 model_filename =  os.path.join(model_dir, model_name+'.pth.tar')
 
 # Create data loaders
@@ -199,7 +203,8 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                                  losses_cp, 
                                                                  cur_iter, 
                                                                  total_batch_iters, 
-                                                                 mode='train')
+                                                                 mode='train',
+                                                                 loss_scaler=loss_scaler)
             
             # Evaluate validation set and display losses
             if cur_iter % verbose_iters == 0:
@@ -223,6 +228,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                                  total_batch_iters, 
                                                                  mode='val')
 
+                # Fractions of non-finite losses and overflowed steps since the last evaluation
+                losses_cp = loss_scaler.log_metrics(losses_cp, 'train')
+
                 # Calculate averages
                 for k in losses_cp.keys():
                     losses[k].append(np.mean(np.array(losses_cp[k]), axis=0))
@@ -233,6 +241,8 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 print('Losses:')
                 print('\tTraining Dataset')
                 print('\t\tTotal Loss: %0.3f'% (losses['train_loss'][-1]))
+                print('\t\tOverflowed Steps: %i (%i non-finite losses)' % (loss_scaler.num_overflows,
+                                                                          loss_scaler.num_nonfinite_losses))
                 print('\t\tSource Loss: %0.3f' % (losses['train_src_loss'][-1]))
                 print('\t\tTarget Loss: %0.3f' % (losses['train_tgt_loss'][-1]))
                 
@@ -256,6 +266,7 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                                 'losses': losses,
                                 'optimizer' : optimizer.state_dict(),
+                                'loss_scaler': loss_scaler.state_dict(),
                                 'lr_scheduler' : lr_scheduler.state_dict(),
                                 'model' : model.state_dict()},
                                 model_filename)
@@ -269,6 +280,7 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                                 'losses': losses,
                                 'optimizer' : optimizer.state_dict(),
+                                'loss_scaler': loss_scaler.state_dict(),
                                 'lr_scheduler' : lr_scheduler.state_dict(),
                                 'model' : model.state_dict()},
                                 model_filename)
@@ -4,7 +4,8 @@ cur_dir = os.path.dirname(__file__)
 import sys
 sys.path.append(os.path.join(cur_dir,'cnv2_utils'))
 from data_loader import SpectraDataset, batch_to_device
-from training_utils import parseArguments, linear_probe_iter, linear_probe_val_iter, str2bool, LARS
+from training_utils import (parseArguments, linear_probe_iter, linear_probe_val_iter, str2bool, LARS,
+                            NativeScalerWithGradNormCount)
 from network import build_encoder, load_model_state
 
 import configparser
@@ -69,6 +70,8 @@ lr = float(config['LINEAR PROBE TRAINING']['lr'])
 final_lr_factor = float(config['LINEAR PROBE TRAINING']['final_lr_factor'])
 weight_decay = float(config['LINEAR PROBE TRAINING']['weight_decay'])
 total_batch_iters = int(config['LINEAR PROBE TRAINING']['total_batch_iters'])
+# Training precision (fp32, bf16 or fp16 autocast)
+precision = config['LINEAR PROBE TRAINING'].get('precision', 'fp32')
 
 # Build network
 model = build_encoder(config, device, model_name)
@@ -82,6 +85,9 @@ else:
                                   weight_decay=weight_decay, betas=(0.9, 0.999))
 print(optimizer)
 
+# Autocast precision and loss scaling
+loss_scaler = NativeScalerWithGradNormCount(precision, device)
+
 # Learning rate scheduler
 lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, lr,
                                                    total_steps=int(total_batch_iters), 
@@ -111,7 +117,8 @@ else:
     model, losses, cur_iter = load_model_state(model, model_filename,
                                               optimizer=optimizer, 
                                               lr_scheduler=lr_scheduler, 
-                                               sparse_to_nonsparse=False)
+                                               sparse_to_nonsparse=False,
+                                               loss_scaler=loss_scaler)
 
 # Save under new name
 model_filename =  os.path.join(model_dir, model_name+'_lp.pth.tar')
@@ -188,7 +195,8 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                                           lr_scheduler, 
                                                                           source_train_batch,
                                                                           losses_cp, 
-                                                                          cur_iter)
+                                                                          cur_iter,
+                                                                          loss_scaler=loss_scaler)
             
             # Evaluate validation set and display losses
             if cur_iter % verbose_iters == 0:
@@ -205,6 +213,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                           target_val_batch, 
                                                           losses_cp)
 
+                # Fractions of non-finite losses and overflowed steps since the last evaluation
+                losses_cp = loss_scaler.log_metrics(losses_cp, 'lp_train')
+
                 # Calculate averages
                 for k in losses_cp.keys():
                     losses[k].append(np.mean(np.array(losses_cp[k]), axis=0))
@@ -215,6 +226,8 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 print('Losses:')
                 print('\tTraining Dataset')
                 print('\t\tTotal Loss: %0.3f'% (losses['lp_train_loss'][-1]))
+                print('\t\tOverflowed Steps: %i (%i non-finite losses)' % (loss_scaler.num_overflows,
+                                                                          loss_scaler.num_nonfinite_losses))
                 #print('\t\tSource Loss: %0.3f' % (losses['train_src_loss'][-1]))
                 #print('\t\tTarget Loss: %0.3f' % (losses['train_tgt_loss'][-1]))
                 
@@ -240,6 +253,7 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                                 'losses': losses,
                                 'optimizer' : optimizer.state_dict(),
+                                'loss_scaler': loss_scaler.state_dict(),
                                 'lr_scheduler' : lr_scheduler.state_dict(),
                                 'model' : model.state_dict()},
                                 model_filename)
@@ -253,6 +267,7 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                                 'losses': losses,
                                 'optimizer' : optimizer.state_dict(),
+                                'loss_scaler': loss_scaler.state_dict(),
                                 'lr_scheduler' : lr_scheduler.state_dict(),
                                 'model' : model.state_dict()},
                                 model_filename)
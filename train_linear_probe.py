@@ -3,8 +3,13 @@ import os
 cur_dir = os.path.dirname(__file__)
 import sys
 sys.path.append(os.path.join(cur_dir,'mae_utils'))
+sys.path.append(os.path.join(cur_dir,'data_utils'))
 from data_loader import SpectraDataset, batch_to_device
-from training_utils import parseArguments, linear_probe_iter, linear_probe_val_iter, str2bool, LARS
+from samplers import block_shuffle_sampler
+from collate import RingCollate
+from metadata_cache import MetadataCache
+from training_utils import (parseArguments, linear_probe_iter, linear_probe_val_iter, str2bool, LARS,
+                            NativeScalerWithGradNormCount)
 from mae_network import build_mae, load_model_state
 
 import configparser
@@ -66,13 +71,24 @@ final_lr_factor = float(config['LINEAR PROBE TRAINING']['final_lr_factor'])
 weight_decay = float(config['LINEAR PROBE TRAINING']['weight_decay'])
 total_batch_iters = int(config['LINEAR PROBE TRAINING']['total_batch_iters'])
 label_smoothing = float(config['LINEAR PROBE TRAINING']['label_smoothing'])
+# Training precision (fp32, bf16 or fp16 autocast)
+precision = config['LINEAR PROBE TRAINING'].get('precision', 'fp32')
+# Shuffle in chunk-aligned blocks to keep the HDF5 reads mostly sequential
+block_shuffle = str2bool(config['DATA'].get('block_shuffle', 'False'))
+# Hold the datasets in shared memory rather than reading from disk
+preload = str2bool(config['DATA'].get('preload', 'False'))
+# Assemble the training batches in reusable buffers
+ring_collate = str2bool(config['DATA'].get('ring_collate', 'False'))
+# Use the precomputed spectrum statistics sidecar
+use_stats = str2bool(config['DATA'].get('use_stats', 'False'))
         
 # Calculate multimodal values from source training set
-with h5py.File(source_data_file, "r") as f:
-    mutlimodal_vals = []
-    for k in multimodal_keys:
-        vals = np.unique(f[k + ' train'][:]).astype(np.float32)
-        mutlimodal_vals.append(torch.from_numpy(vals).to(device))
+# (cached next to the data file after the first run)
+metadata = MetadataCache(source_data_file)
+mutlimodal_vals = []
+for k in multimodal_keys:
+    vals = metadata.unique(k + ' train').astype(np.float32)
+    mutlimodal_vals.append(torch.from_numpy(vals).to(device))
         
 # Build network
 model = build_mae(config, device, model_name, mutlimodal_vals)
@@ -85,6 +101,9 @@ else:
     optimizer = torch.optim.AdamW(model.head_parameters(), lr=lr, 
                                   weight_decay=weight_decay, betas=(0.9, 0.999))
 print(optimizer)
+
+# Autocast precision and loss scaling
+loss_scaler = NativeScalerWithGradNormCount(precision, device)
     
 # Learning rate scheduler
 lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, lr,
@@ -111,7 +130,8 @@ if fresh_model:
 else:
     model, losses, _, cur_iter = load_model_state(model, model_filename,
                                               lp_optimizer=optimizer, 
-                                              lp_lr_scheduler=lr_scheduler)
+                                              lp_lr_scheduler=lr_scheduler,
+                                              loss_scaler=loss_scaler)
 # Save under new name
 model_filename =  os.path.join(model_dir, model_name+'_lp.pth.tar')
     
@@ -126,13 +146,22 @@ source_train_dataset = SpectraDataset(source_data_file,
                                       divide_by_median=divide_by_median,
                                       median_thresh=0., std_min=std_min,
                                       add_noise=add_noise_to_source, 
-                                      max_noise_factor=max_noise_factor)
+                                      max_noise_factor=max_noise_factor,
+                                      preload=preload,
+                                      use_stats=use_stats)
+
+if block_shuffle:
+    source_train_sampler = block_shuffle_sampler(source_train_dataset)
+else:
+    source_train_sampler = None
 
 source_train_dataloader = torch.utils.data.DataLoader(source_train_dataset,
                                                       batch_size=batch_size, 
-                                                      shuffle=True, 
+                                                      shuffle=(source_train_sampler is None),
+                                                      sampler=source_train_sampler, 
                                                       num_workers=11,
-                                                      pin_memory=True)
+                                                      pin_memory=True,
+                                                      collate_fn=RingCollate(num_slots=8) if ring_collate else None)
 
 source_val_dataset = SpectraDataset(source_data_file, 
                                       dataset='val', 
@@ -140,7 +169,9 @@ source_val_dataset = SpectraDataset(source_data_file,
                                       unimodal_keys=unimodal_keys,
                                       continuum_normalize=continuum_normalize,
                                       divide_by_median=divide_by_median,
-                                      median_thresh=0., std_min=std_min)
+                                      median_thresh=0., std_min=std_min,
+                                      preload=preload,
+                                      use_stats=use_stats)
 
 source_val_dataloader = torch.utils.data.DataLoader(source_val_dataset, 
                                                     batch_size=batch_size, 
@@ -155,7 +186,9 @@ target_val_dataset = SpectraDataset(target_data_file,
                                       label_survey=target_val_survey,
                                       continuum_normalize=continuum_normalize,
                                       divide_by_median=divide_by_median,
-                                      median_thresh=0., std_min=std_min)
+                                      median_thresh=0., std_min=std_min,
+                                      preload=preload,
+                                      use_stats=use_stats)
 
 target_val_dataloader = torch.utils.data.DataLoader(target_val_dataset, 
                                                     batch_size=batch_size, 
@@ -190,7 +223,8 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                                           source_train_batch,
                                                                           losses_cp, 
                                                                           cur_iter, 
-                                                                          device)
+                                                                          device,
+                                                                          loss_scaler=loss_scaler)
             
             # Evaluate validation set and display losses
             if cur_iter % verbose_iters == 0:
@@ -207,6 +241,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                           target_val_batch, 
                                                           losses_cp)
 
+                # Fractions of non-finite losses and overflowed steps since the last evaluation
+                losses_cp = loss_scaler.log_metrics(losses_cp, 'lp_train')
+
                 # Calculate averages
                 for k in losses_cp.keys():
                     losses[k].append(np.mean(np.array(losses_cp[k]), axis=0))
@@ -217,6 +254,8 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 print('Losses:')
                 print('\tTraining Dataset')
                 print('\t\tTotal Loss: %0.3f'% (losses['lp_train_loss'][-1]))
+                print('\t\tOverflowed Steps: %i (%i non-finite losses)' % (loss_scaler.num_overflows,
+                                                                          loss_scaler.num_nonfinite_losses))
                 #print('\t\tSource Loss: %0.3f' % (losses['train_src_loss'][-1]))
                 #print('\t\tTarget Loss: %0.3f' % (losses['train_tgt_loss'][-1]))
                 
@@ -250,10 +289,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                             'lp_batch_iters': cur_iter,
                                 'losses': losses,
                                 'optimizer' : optimizer.state_dict(),
-                                #'loss_scaler': loss_scaler.state_dict(),
+                                'loss_scaler': loss_scaler.state_dict(),
                                 'lr_scheduler' : lr_scheduler.state_dict(),
-                                'model' : model.state_dict(),
-                            'classifier models': [net.state_dict() for net in model.label_classifiers]},
+                                'model' : model.state_dict()},
                                 model_filename)
 
                 cp_start_time = time.time()
@@ -266,10 +304,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                             'lp_batch_iters': cur_iter,
                                 'losses': losses,
                                 'optimizer' : optimizer.state_dict(),
-                                #'loss_scaler': loss_scaler.state_dict(),
+                                'loss_scaler': loss_scaler.state_dict(),
                                 'lr_scheduler' : lr_scheduler.state_dict(),
-                                'model' : model.state_dict(),
-                            'classifier models': [net.state_dict() for net in model.label_classifiers]},
+                                'model' : model.state_dict()},
                                 model_filename)
                 # Finish training
                 break 
@@ -3,8 +3,14 @@ import os
 cur_dir = os.path.dirname(__file__)
 import sys
 sys.path.append(os.path.join(cur_dir,'mae_utils'))
+sys.path.append(os.path.join(cur_dir,'data_utils'))
 from data_loader import SpectraDataset, batch_to_device
-from training_utils import parseArguments, mae_iter, str2bool
+from samplers import block_shuffle_sampler
+from collate import RingCollate
+from metadata_cache import MetadataCache
+from prefetch import DevicePrefetcher
+from paired import paired_dataloader
+from training_utils import parseArguments, mae_iter, str2bool, NativeScalerWithGradNormCount
 from mae_network import build_mae, load_model_state
 
 import configparser
@@ -66,13 +72,24 @@ target_loss_weight = float(config['TRAINING']['target_loss_weight'])
 weight_decay = float(config['TRAINING']['weight_decay'])
 total_batch_iters = int(config['TRAINING']['total_batch_iters'])
 mask_ratio = float(config['TRAINING']['mask_ratio'])
+# Training precision (fp32, bf16 or fp16 autocast)
+precision = config['TRAINING'].get('precision', 'fp32')
+# Shuffle in chunk-aligned blocks to keep the HDF5 reads mostly sequential
+block_shuffle = str2bool(config['DATA'].get('block_shuffle', 'False'))
+# Hold the datasets in shared memory rather than reading from disk
+preload = str2bool(config['DATA'].get('preload', 'False'))
+# Assemble the training batches in reusable buffers
+ring_collate = str2bool(config['DATA'].get('ring_collate', 'False'))
+# Use the precomputed spectrum statistics sidecar
+use_stats = str2bool(config['DATA'].get('use_stats', 'False'))
         
 # Calculate multimodal values from source training set
-with h5py.File(source_data_file, "r") as f:
-    mutlimodal_vals = []
-    for k in multimodal_keys:
-        vals = np.unique(f[k + ' train'][:]).astype(np.float32)
-        mutlimodal_vals.append(torch.from_numpy(vals).to(device))
+# (cached next to the data file after the first run)
+metadata = MetadataCache(source_data_file)
+mutlimodal_vals = []
+for k in multimodal_keys:
+    vals = metadata.unique(k + ' train').astype(np.float32)
+    mutlimodal_vals.append(torch.from_numpy(vals).to(device))
         
 # Build network
 model = build_mae(config, device, model_name, mutlimodal_vals)
@@ -84,6 +101,8 @@ optimizer = torch.optim.AdamW(model.parameters(),
                               betas=(0.9, 0.95))
 print(optimizer)
 
+# Autocast precision and loss scaling
+loss_scaler = NativeScalerWithGradNormCount(precision, device)
 
 # Learning rate scheduler
 lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, lr,
@@ -101,7 +120,7 @@ if use_prev_ae:
 else:
     model_filename =  os.path.join(model_dir, model_name+'.pth.tar')
 model, losses, cur_iter, _ = load_model_state(model, model_filename, 
-                                           optimizer, lr_scheduler)#, loss_scaler)
+                                           optimizer, lr_scheduler, loss_scaler=loss_scaler)
 model_filename =  os.path.join(model_dir, model_name+'.pth.tar')
     
 # Create data loaders
@@ -112,13 +131,14 @@ source_train_dataset = SpectraDataset(source_data_file,
                                       continuum_normalize=continuum_normalize,
                                       divide_by_median=divide_by_median,
                                       median_thresh=0., std_min=std_min,
-                                     add_noise=add_noise_to_source, max_noise_factor=max_noise_factor)
+                                     add_noise=add_noise_to_source, max_noise_factor=max_noise_factor,
+                                     preload=preload,
+                                     use_stats=use_stats)
 
-source_train_dataloader = torch.utils.data.DataLoader(source_train_dataset,
-                                                      batch_size=batch_size, 
-                                                      shuffle=True, 
-                                                      num_workers=5,
-                                                      pin_memory=True)
+if block_shuffle:
+    source_train_sampler = block_shuffle_sampler(source_train_dataset)
+else:
+    source_train_sampler = None
 
 source_val_dataset = SpectraDataset(source_data_file, 
                                       dataset='val', 
@@ -126,7 +146,9 @@ source_val_dataset = SpectraDataset(source_data_file,
                                       unimodal_keys=unimodal_keys,
                                       continuum_normalize=continuum_normalize,
                                       divide_by_median=divide_by_median,
-                                      median_thresh=0., std_min=std_min)
+                                      median_thresh=0., std_min=std_min,
+                                      preload=preload,
+                                      use_stats=use_stats)
 
 source_val_dataloader = torch.utils.data.DataLoader(source_val_dataset, 
                                                     batch_size=batch_size, 
@@ -141,13 +163,14 @@ target_train_dataset = SpectraDataset(target_data_file,
                                       label_survey=target_val_survey,
                                       continuum_normalize=continuum_normalize,
                                       divide_by_median=divide_by_median,
-                                      median_thresh=0., std_min=std_min)
+                                      median_thresh=0., std_min=std_min,
+                                      preload=preload,
+                                      use_stats=use_stats)
 
-target_train_dataloader = torch.utils.data.DataLoader(target_train_dataset,
-                                                      batch_size=batch_size, 
-                                                      shuffle=True, 
-                                                      num_workers=5,
-                                                      pin_memory=True)
+if block_shuffle:
+    target_train_sampler = block_shuffle_sampler(target_train_dataset)
+else:
+    target_train_sampler = None
 
 target_val_dataset = SpectraDataset(target_data_file, 
                                       dataset='val', 
@@ -156,7 +179,9 @@ target_val_dataset = SpectraDataset(target_data_file,
                                       label_survey=target_val_survey,
                                       continuum_normalize=continuum_normalize,
                                       divide_by_median=divide_by_median,
-                                      median_thresh=0., std_min=std_min)
+                                      median_thresh=0., std_min=std_min,
+                                      preload=preload,
+                                      use_stats=use_stats)
 
 target_val_dataloader = torch.utils.data.DataLoader(target_val_dataset, 
                                                     batch_size=batch_size, 
@@ -164,6 +189,18 @@ target_val_dataloader = torch.utils.data.DataLoader(target_val_dataset,
                                                     num_workers=5,
                                                     pin_memory=True)
 
+# Read the (source, target) batch pairs with a single pool of workers
+train_dataloader = paired_dataloader(source_train_dataset, target_train_dataset,
+                                     batch_size, 
+                                     source_sampler=source_train_sampler,
+                                     target_sampler=target_train_sampler,
+                                     source_collate=RingCollate(num_slots=8) if ring_collate else None,
+                                     target_collate=RingCollate(num_slots=8) if ring_collate else None,
+                                     num_workers=5)
+
+# Load the next training batches onto the device in the background
+train_pairs = DevicePrefetcher(train_dataloader, device)
+
 print('The source training set consists of %i spectra.' % (len(source_train_dataset)))
 print('The source validation set consists of %i spectra.' % (len(source_val_dataset)))
 
@@ -180,24 +217,13 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
     cp_start_time = time.time()
     while cur_iter < (total_batch_iters):
         # Iterate through both training datasets simultaneously
-        source_dataloader_iterator = iter(source_train_dataloader)
-        for target_train_batch in target_train_dataloader:
-
-            try:
-                source_train_batch = next(source_dataloader_iterator)
-            except StopIteration:
-                source_dataloader_iterator = iter(source_train_dataloader)
-                source_train_batch = next(source_dataloader_iterator)
-        
-            # Switch to GPU if available
-            source_train_batch = batch_to_device(source_train_batch, device)
-            target_train_batch = batch_to_device(target_train_batch, device)
+        # (the batches are already on the device)
+        for source_train_batch, target_train_batch in train_pairs:
             
             # Run iteration on a batch of training samples            
             model, optimizer, lr_scheduler, losses_cp = mae_iter(model, 
                                                                  optimizer, 
                                                                  lr_scheduler, 
-                                                                 #loss_scaler, 
                                                                  source_train_batch, 
                                                                  target_train_batch, 
                                                                  mask_ratio,
@@ -206,7 +232,8 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                                  cur_iter, 
                                                                  total_batch_iters, 
                                                                  mode='train',
-                                                                device=device)
+                                                                device=device,
+                                                                loss_scaler=loss_scaler)
             
             # Evaluate validation set and display losses
             if cur_iter % verbose_iters == 0:
@@ -221,7 +248,6 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                         model, optimizer, lr_scheduler, losses_cp = mae_iter(model, 
                                                                  optimizer, 
                                                                  lr_scheduler, 
-                                                                 #loss_scaler, 
                                                                  source_val_batch, 
                                                                  target_val_batch, 
                                                                  mask_ratio,
@@ -232,6 +258,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                                  mode='val',
                                                                             device=device)
 
+                # Fractions of non-finite losses and overflowed steps since the last evaluation
+                losses_cp = loss_scaler.log_metrics(losses_cp, 'train')
+
                 # Calculate averages
                 for k in losses_cp.keys():
                     losses[k].append(np.mean(np.array(losses_cp[k]), axis=0))
@@ -239,9 +268,13 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 
                 # Print current status
                 print('\nBatch Iterations: %i/%i ' % (cur_iter, total_batch_iters))
+                print('Time spent waiting for training batches: %0.1f s' % 
+                      (train_pairs.wait_time))
                 print('Losses:')
                 print('\tTraining Dataset')
                 print('\t\tTotal Loss: %0.3f'% (losses['train_loss'][-1]))
+                print('\t\tOverflowed Steps: %i (%i non-finite losses)' % (loss_scaler.num_overflows,
+                                                                          loss_scaler.num_nonfinite_losses))
                 print('\t\tSource Loss: %0.3f' % (losses['train_src_loss'][-1]))
                 print('\t\tTarget Loss: %0.3f' % (losses['train_tgt_loss'][-1]))
                 
@@ -265,10 +298,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                                 'losses': losses,
                                 'optimizer' : optimizer.state_dict(),
-                                #'loss_scaler': loss_scaler.state_dict(),
+                                'loss_scaler': loss_scaler.state_dict(),
                                 'lr_scheduler' : lr_scheduler.state_dict(),
-                                'model' : model.state_dict(),
-                            'classifier models': [net.state_dict() for net in model.label_classifiers]},
+                                'model' : model.state_dict()},
                                 model_filename)
 
                 cp_start_time = time.time()
@@ -280,10 +312,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                                 'losses': losses,
                                 'optimizer' : optimizer.state_dict(),
-                                #'loss_scaler': loss_scaler.state_dict(),
+                                'loss_scaler': loss_scaler.state_dict(),
                                 'lr_scheduler' : lr_scheduler.state_dict(),
-                                'model' : model.state_dict(),
-                            'classifier models': [net.state_dict() for net in model.label_classifiers]},
+                                'model' : model.state_dict()},
                                 model_filename)
                 # Finish training
                 break 
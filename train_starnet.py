@@ -3,7 +3,9 @@ import os
 cur_dir = os.path.dirname(__file__)
 import sys
 sys.path.append(os.path.join(cur_dir,'starnet_utils'))
+sys.path.append(os.path.join(cur_dir,'data_utils'))
 from data_loader import SpectraDatasetSimple, batch_to_device
+from metadata_cache import MetadataCache
 from network import build_starnet, load_model_state
 from training_utils import parseArguments, run_iter
 
@@ -56,11 +58,13 @@ weight_decay = float(config['TRAINING']['weight_decay'])
 total_batch_iters = int(config['TRAINING']['total_batch_iters'])
 
 # Collect mean and std of the training data
-with h5py.File(source_data_file, "r") as f:
-    labels_mean = [np.mean(f[k + ' train'][:]) for k in label_keys]
-    labels_std = [np.std(f[k + ' train'][:]) for k in label_keys]
-    spectra_mean = np.mean(f['spectra train'][:]) 
-    spectra_std = np.mean(f['spectra train'][:])
+# (cached next to the data file after the first run)
+metadata = MetadataCache(source_data_file)
+labels_mean = [metadata.mean(k + ' train') for k in label_keys]
+labels_std = [metadata.std(k + ' train') for k in label_keys]
+spectra_mean = metadata.mean('spectra train')
+# (The existing networks were trained with the spectra mean in place of the std)
+spectra_std = metadata.mean('spectra train')
 
 # Build network
 model = build_starnet(config, device, model_name, 
@@ -3,12 +3,19 @@ import os
 cur_dir = os.path.dirname(__file__)
 import sys
 sys.path.append(os.path.join(cur_dir,'utils'))
-from data_loader import SpectraDataset, batch_to_device
+sys.path.append(os.path.join(cur_dir,'data_utils'))
+from data_loader import SpectraDataset, StreamingSpectraDataset, batch_to_device
+from samplers import block_shuffle_sampler
+from collate import RingCollate
+from metadata_cache import MetadataCache
+from prefetch import DevicePrefetcher
+from paired import paired_dataloader, pair_transform, CyclePairs
 from training_utils import (parseArguments,CosineSimilarityLoss, run_iter, 
-                            str2bool, val_iter)
+                            str2bool, val_iter, NativeScalerWithGradNormCount)
 from network import StarNet, build_starnet, load_model_state
 
 import configparser
+import glob
 import time
 import numpy as np
 import h5py
@@ -69,13 +76,33 @@ target_feature_weight = float(config['TRAINING']['target_feature_weight'])
 target_task_weights = torch.tensor(eval(config['TRAINING']['target_task_weights'])).to(device)
 source_task_weights = torch.tensor(eval(config['TRAINING']['source_task_weights'])).to(device)
 feat_loss_fn = config['TRAINING']['feat_loss_fn']
+# Pass the source and target batches through the model together
+fused_step = str2bool(config['TRAINING'].get('fused_step', 'False'))
+# Keep separate BatchNorm statistics for each domain in the fused step
+domain_batchnorm = str2bool(config['TRAINING'].get('domain_batchnorm', 'True'))
+# Training precision (fp32, bf16 or fp16 autocast)
+precision = config['TRAINING'].get('precision', 'fp32')
+# Shuffle in chunk-aligned blocks to keep the HDF5 reads mostly sequential
+block_shuffle = str2bool(config['DATA'].get('block_shuffle', 'False'))
+# Hold the datasets in shared memory rather than reading from disk
+preload = str2bool(config['DATA'].get('preload', 'False'))
+# Assemble the training batches in reusable buffers
+ring_collate = str2bool(config['DATA'].get('ring_collate', 'False'))
+# Use the precomputed spectrum statistics sidecar
+use_stats = str2bool(config['DATA'].get('use_stats', 'False'))
+# Apply the augmentations to whole batches on the training device
+batch_augment = str2bool(config['DATA'].get('batch_augment', 'False'))
+# Stream the training sets from shards (the data files can then be glob patterns)
+streaming = str2bool(config['DATA'].get('streaming', 'False'))
 
 # Calculate multimodal values from source training set
-with h5py.File(source_data_file, "r") as f:
-    mutlimodal_vals = []
-    for k in multimodal_keys:
-        vals = np.unique(f[k + ' train'][:]).astype(np.float32)
-        mutlimodal_vals.append(torch.from_numpy(vals).to(device))
+# (cached next to the data file after the first run)
+# (combined over all of the shards when streaming)
+source_files = sorted(glob.glob(source_data_file))
+mutlimodal_vals = []
+for k in multimodal_keys:
+    vals = np.unique(np.concatenate([MetadataCache(fn).unique(k + ' train') for fn in source_files]))
+    mutlimodal_vals.append(torch.from_numpy(vals.astype(np.float32)).to(device))
 
 # Build network
 model = build_starnet(config, device, model_name, mutlimodal_vals)
@@ -86,6 +113,9 @@ optimizer = torch.optim.AdamW(model.all_parameters(),
                              weight_decay=weight_decay, 
                              betas=(0.9, 0.999))
 
+# Autocast precision and loss scaling
+loss_scaler = NativeScalerWithGradNormCount(precision, device)
+
 # Learning rate scheduler
 lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, lr,
                                                    total_steps=int(total_batch_iters), 
@@ -99,7 +129,7 @@ lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, lr,
 # Load model state from previous training (if any)
 model_filename =  os.path.join(model_dir, model_name+'.pth.tar')
 model, losses, cur_iter = load_model_state(model, model_filename, 
-                                           optimizer, lr_scheduler)
+                                           optimizer, lr_scheduler, loss_scaler)
 
 # Multi GPUs
 model = torch.nn.parallel.DataParallel(model, device_ids=list(range(num_gpus)), dim=0)
@@ -107,7 +137,18 @@ if num_gpus>1:
     batch_size *= num_gpus
 
 # Create data loaders
-source_train_dataset = SpectraDataset(source_data_file, 
+if streaming:
+    TrainDataset = StreamingSpectraDataset
+    # Validate on the first shard
+    # (only the validation sets are preloaded, the training shards are streamed from disk)
+    source_val_file = source_files[0]
+    target_val_file = sorted(glob.glob(target_data_file))[0]
+else:
+    TrainDataset = SpectraDataset
+    source_val_file = source_data_file
+    target_val_file = target_data_file
+    
+source_train_dataset = TrainDataset(source_data_file, 
                                       dataset='train', 
                                       wave_grid_file=wave_grid_file, 
                                       multimodal_keys=multimodal_keys,
@@ -124,22 +165,26 @@ source_train_dataset = SpectraDataset(source_data_file,
                                       max_noise_factor=max_noise_factor,
                                       random_chunk=random_chunk,
                                       overlap=overlap,
-                                      channel_indices=channel_indices)
+                                      channel_indices=channel_indices,
+                                      preload=preload and not streaming,
+                                      use_stats=use_stats,
+                                      batch_augment=batch_augment)
 
-source_train_dataloader = torch.utils.data.DataLoader(source_train_dataset,
-                                                      batch_size=batch_size, 
-                                                      shuffle=True, 
-                                                      num_workers=3,
-                                                      pin_memory=True)
+if block_shuffle and not streaming:
+    source_train_sampler = block_shuffle_sampler(source_train_dataset)
+else:
+    source_train_sampler = None
 
-source_val_dataset = SpectraDataset(source_data_file, 
+source_val_dataset = SpectraDataset(source_val_file, 
                                     dataset='val', 
                                     wave_grid_file=wave_grid_file, 
                                       multimodal_keys=multimodal_keys,
                                       unimodal_keys=unimodal_keys,
                                       continuum_normalize=continuum_normalize,
                                       divide_by_median=divide_by_median,
-                                      inference_mode=True)
+                                      inference_mode=True,
+                                      preload=preload,
+                                      use_stats=use_stats)
 
 source_val_dataloader = torch.utils.data.DataLoader(source_val_dataset, 
                                                     batch_size=batch_size, 
@@ -147,7 +192,7 @@ source_val_dataloader = torch.utils.data.DataLoader(source_val_dataset,
                                                     num_workers=3,
                                                     pin_memory=True)
 
-target_train_dataset = SpectraDataset(target_data_file, 
+target_train_dataset = TrainDataset(target_data_file, 
                                       dataset='train', 
                                       wave_grid_file=wave_grid_file, 
                                       multimodal_keys=multimodal_keys,
@@ -162,22 +207,26 @@ target_train_dataset = SpectraDataset(target_data_file,
                                       apply_dropout=False,
                                       random_chunk=random_chunk,
                                       overlap=overlap,
-                                      channel_indices=channel_indices)
+                                      channel_indices=channel_indices,
+                                      preload=preload and not streaming,
+                                      use_stats=use_stats,
+                                      batch_augment=batch_augment)
 
-target_train_dataloader = torch.utils.data.DataLoader(target_train_dataset,
-                                                      batch_size=batch_size, 
-                                                      shuffle=True, 
-                                                      num_workers=3,
-                                                      pin_memory=True)
+if block_shuffle and not streaming:
+    target_train_sampler = block_shuffle_sampler(target_train_dataset)
+else:
+    target_train_sampler = None
 
-target_val_dataset = SpectraDataset(target_data_file, 
+target_val_dataset = SpectraDataset(target_val_file, 
                                     dataset='val', 
                                     wave_grid_file=wave_grid_file, 
                                       multimodal_keys=multimodal_keys,
                                       unimodal_keys=unimodal_keys,
                                       continuum_normalize=continuum_normalize,
                                       divide_by_median=divide_by_median,
-                                      inference_mode=True)
+                                      inference_mode=True,
+                                      preload=preload,
+                                      use_stats=use_stats)
 
 target_val_dataloader = torch.utils.data.DataLoader(target_val_dataset, 
                                                     batch_size=batch_size, 
@@ -185,6 +234,44 @@ target_val_dataloader = torch.utils.data.DataLoader(target_val_dataset,
                                                     num_workers=3,
                                                     pin_memory=True)
 
+if streaming:
+    # The streams cannot share a sampler, so each domain has its own loader
+    source_train_dataloader = torch.utils.data.DataLoader(source_train_dataset,
+                                                          batch_size=batch_size, 
+                                                          num_workers=3,
+                                                          pin_memory=True,
+                                                          persistent_workers=True,
+                                                          collate_fn=RingCollate(num_slots=8) if ring_collate else None)
+    target_train_dataloader = torch.utils.data.DataLoader(target_train_dataset,
+                                                          batch_size=batch_size, 
+                                                          num_workers=3,
+                                                          pin_memory=True,
+                                                          persistent_workers=True,
+                                                          collate_fn=RingCollate(num_slots=8) if ring_collate else None)
+
+    # Load the next training batches onto the device in the background
+    train_pairs = CyclePairs(DevicePrefetcher(source_train_dataloader, device,
+                                              transform=(source_train_dataset.augment_batch 
+                                                         if batch_augment else None)),
+                             DevicePrefetcher(target_train_dataloader, device,
+                                              transform=(target_train_dataset.augment_batch 
+                                                         if batch_augment else None)))
+else:
+    # Read the (source, target) batch pairs with a single pool of workers
+    train_dataloader = paired_dataloader(source_train_dataset, target_train_dataset,
+                                         batch_size, 
+                                         source_sampler=source_train_sampler,
+                                         target_sampler=target_train_sampler,
+                                         source_collate=RingCollate(num_slots=8) if ring_collate else None,
+                                         target_collate=RingCollate(num_slots=8) if ring_collate else None,
+                                         num_workers=3)
+
+    # Load the next training batches onto the device in the background
+    train_pairs = DevicePrefetcher(train_dataloader, device,
+                                   transform=pair_transform(source_train_dataset.augment_batch,
+                                                            target_train_dataset.augment_batch) 
+                                             if batch_augment else None)
+
 print('The source training set consists of %i spectra.' % (len(source_train_dataset)))
 print('The source validation set consists of %i spectra.' % (len(source_val_dataset)))
 
@@ -209,18 +296,8 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
     cp_start_time = time.time()
     while cur_iter < (total_batch_iters):
         # Iterate through both training datasets simultaneously
-        source_dataloader_iterator = iter(source_train_dataloader)
-        for target_train_batch in target_train_dataloader:
-
-            try:
-                source_train_batch = next(source_dataloader_iterator)
-            except StopIteration:
-                source_dataloader_iterator = iter(source_train_dataloader)
-                source_train_batch = next(source_dataloader_iterator)
-        
-            # Switch to GPU if available
-            source_train_batch = batch_to_device(source_train_batch, device)
-            target_train_batch = batch_to_device(target_train_batch, device)
+        # (the batches are already on the device)
+        for source_train_batch, target_train_batch in train_pairs:
             
             # Run iteration on a batch of training samples            
             model, optimizer, lr_scheduler, losses_cp = run_iter(model, 
@@ -236,7 +313,10 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                                  target_task_weights,
                                                                  feat_loss_fn,
                                                                  losses_cp, 
-                                                                 mode='train')
+                                                                 mode='train',
+                                                                 fused=fused_step,
+                                                                 split_batchnorm=domain_batchnorm,
+                                                                 loss_scaler=loss_scaler)
 
             # Evaluate validation set and display losses
             if cur_iter % verbose_iters == 0:
@@ -251,7 +331,11 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                         losses_cp = val_iter(model, 
                                              source_val_batch, 
                                              target_val_batch, 
-                                             losses_cp)
+                                             losses_cp,
+                                             fused=fused_step)
+
+                # Fractions of non-finite losses and overflowed steps since the last evaluation
+                losses_cp = loss_scaler.log_metrics(losses_cp, 'train')
 
                 # Calculate averages
                 for k in losses_cp.keys():
@@ -260,9 +344,13 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
 
                 # Print current status
                 print('\nBatch Iterations: %i/%i ' % (cur_iter, total_batch_iters))
+                print('Time spent waiting for training batches: %0.1f s' % 
+                      (train_pairs.wait_time))
                 print('Losses:')
                 print('\tTraining Dataset')
                 print('\t\tTotal Loss: %0.3f'% (losses['train_loss'][-1]))
+                print('\t\tOverflowed Steps: %i (%i non-finite losses)' % (loss_scaler.num_overflows,
+                                                                          loss_scaler.num_nonfinite_losses))
                 if model.module.num_mm_labels>0:
                     print('\t\tStellar Multimodal Loss: %0.3f' % (losses['train_src_mm_labels'][-1]))
                     print('\t\tChunk Multimodal Loss: %0.3f' % (losses['train_src_mm_labels_chunk'][-1]))
@@ -310,9 +398,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                             'losses': losses,
                             'optimizer' : optimizer.state_dict(),
+                            'loss_scaler': loss_scaler.state_dict(),
                             'lr_scheduler' : lr_scheduler.state_dict(),
-                            'model' : model.module.state_dict(),
-                            'classifier models': [net.state_dict() for net in model.module.label_classifiers]},
+                            'model' : model.module.state_dict()},
                             model_filename)
 
                 cp_start_time = time.time()
@@ -324,9 +412,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                             'losses': losses,
                             'optimizer' : optimizer.state_dict(),
+                            'loss_scaler': loss_scaler.state_dict(),
                             'lr_scheduler' : lr_scheduler.state_dict(),
-                            'model' : model.module.state_dict(),
-                            'classifier models': [net.state_dict() for net in model.module.label_classifiers]},
+                            'model' : model.module.state_dict()},
                             model_filename)
                 # Finish training
                 break 
@@ -3,9 +3,11 @@ import os
 cur_dir = os.path.dirname(__file__)
 import sys
 sys.path.append(os.path.join(cur_dir,'utils'))
+sys.path.append(os.path.join(cur_dir,'data_utils'))
 from data_loader import SpectraDataset, batch_to_device
+from metadata_cache import MetadataCache
 from training_utils import (parseArguments,CosineSimilarityLoss, run_iter, 
-                            str2bool, val_iter)
+                            str2bool, val_iter, NativeScalerWithGradNormCount)
 from network import StarNet, build_starnet, load_model_state
 
 import configparser
@@ -69,13 +71,20 @@ target_feature_weight = float(config['TRAINING']['target_feature_weight'])
 target_task_weights = torch.tensor(eval(config['TRAINING']['target_task_weights'])).to(device)
 source_task_weights = torch.tensor(eval(config['TRAINING']['source_task_weights'])).to(device)
 feat_loss_fn = config['TRAINING']['feat_loss_fn']
+# Pass the source and target batches through the model together
+fused_step = str2bool(config['TRAINING'].get('fused_step', 'False'))
+# Keep separate BatchNorm statistics for each domain in the fused step
+domain_batchnorm = str2bool(config['TRAINING'].get('domain_batchnorm', 'True'))
+# Training precision (fp32, bf16 or fp16 autocast)
+precision = config['TRAINING'].get('precision', 'fp32')
 
 # Calculate multimodal values from source training set
-with h5py.File(source_data_file, "r") as f:
-    mutlimodal_vals = []
-    for k in multimodal_keys:
-        vals = np.unique(f[k + ' train'][:]).astype(np.float32)
-        mutlimodal_vals.append(torch.from_numpy(vals).to(device))
+# (cached next to the data file after the first run)
+metadata = MetadataCache(source_data_file)
+mutlimodal_vals = []
+for k in multimodal_keys:
+    vals = metadata.unique(k + ' train').astype(np.float32)
+    mutlimodal_vals.append(torch.from_numpy(vals).to(device))
 
 # Build network
 model = build_starnet(config, device, model_name, mutlimodal_vals)
@@ -86,6 +95,9 @@ optimizer = torch.optim.AdamW(model.predictor_parameters(),
                              weight_decay=weight_decay, 
                              betas=(0.9, 0.999))
 
+# Autocast precision and loss scaling
+loss_scaler = NativeScalerWithGradNormCount(precision, device)
+
 # Learning rate scheduler
 lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, lr,
                                                    total_steps=15000, 
@@ -237,7 +249,10 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                                                  np.zeros((len(target_task_weights),)),
                                                                  feat_loss_fn,
                                                                  losses_cp, 
-                                                                 mode='predictor_train_mode')
+                                                                 mode='predictor_train_mode',
+                                                                 fused=fused_step,
+                                                                 split_batchnorm=domain_batchnorm,
+                                                                 loss_scaler=loss_scaler)
 
             # Evaluate validation set and display losses
             if cur_iter % verbose_iters == 0:
@@ -252,7 +267,11 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                         losses_cp = val_iter(model, 
                                              source_val_batch, 
                                              target_val_batch, 
-                                             losses_cp)
+                                             losses_cp,
+                                             fused=fused_step)
+
+                # Fractions of non-finite losses and overflowed steps since the last evaluation
+                losses_cp = loss_scaler.log_metrics(losses_cp, 'train')
 
                 # Calculate averages
                 for k in losses_cp.keys():
@@ -264,6 +283,8 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 print('Losses:')
                 print('\tTraining Dataset')
                 print('\t\tTotal Loss: %0.3f'% (losses['train_loss'][-1]))
+                print('\t\tOverflowed Steps: %i (%i non-finite losses)' % (loss_scaler.num_overflows,
+                                                                          loss_scaler.num_nonfinite_losses))
                 if model.module.num_mm_labels>0:
                     print('\t\tStellar Multimodal Loss: %0.3f' % (losses['train_src_mm_labels'][-1]))
                     print('\t\tChunk Multimodal Loss: %0.3f' % (losses['train_src_mm_labels_chunk'][-1]))
@@ -311,9 +332,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                             'losses': losses,
                             'optimizer' : optimizer.state_dict(),
+                            'loss_scaler': loss_scaler.state_dict(),
                             'lr_scheduler' : lr_scheduler.state_dict(),
-                            'model' : model.module.state_dict(),
-                            'classifier models': [net.state_dict() for net in model.module.label_classifiers]},
+                            'model' : model.module.state_dict()},
                             model_filename)
 
                 cp_start_time = time.time()
@@ -325,9 +346,9 @@ def train_network(model, optimizer, lr_scheduler, cur_iter):
                 torch.save({'batch_iters': cur_iter,
                             'losses': losses,
                             'optimizer' : optimizer.state_dict(),
+                            'loss_scaler': loss_scaler.state_dict(),
                             'lr_scheduler' : lr_scheduler.state_dict(),
-                            'model' : model.module.state_dict(),
-                            'classifier models': [net.state_dict() for net in model.module.label_classifiers]},
+                            'model' : model.module.state_dict()},
                             model_filename)
                 # Finish training
                 break 
@@ -2,50 +2,81 @@ import torch
 from torch import nn
 from torch import Tensor
 from typing import List
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 from torchvision.ops import StochasticDepth
 
 import os
+import sys
+import copy
+cur_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(cur_dir, '..', 'data_utils'))
+from label_grid import LabelGrid
+from layer_shapes import compute_out_size
+from fused_heads import fuse_head_states, convert_optimizer_state
+from inference_cache import trace_inference_model
+from inference_cache import inference_cache_key as weights_cache_key
 from training_utils import str2bool
 from itertools import chain
 from collections import defaultdict
 import math
 
-def compute_out_size(in_size, mod, device):
-    '''
-    Compute output size of Module `mod` given an input with size `in_size`.
-    '''
-    
-    f = mod.forward(torch.autograd.Variable(torch.Tensor(1, *in_size)).to(device))
-    return f.size()[1:]
-
 class PositionalEncoding(torch.nn.Module):
     """
     Adjusted from https://pytorch.org/tutorials/beginner/transformer_tutorial.html
     to index into the positional encoding based on location of chunk in the 
     entire spectrum.
+    
+    The encodings of a batch are gathered from the precomputed table with a
+    single index_select. With precompute=False the table is not kept and the
+    sinusoids are computed for the positions of each batch instead, which
+    saves the [spectrum_size, d_model] table for long spectra at the cost of
+    a slower forward pass on the CPU.
     """
 
-    def __init__(self, d_model, spectrum_size=43480, dropout=0.1):
+    def __init__(self, d_model, spectrum_size=43480, dropout=0.1, precompute=True):
         super().__init__()
         self.dropout = torch.nn.Dropout(p=dropout)
+        self.d_model = d_model
+        self.precompute = precompute
 
-        pe = torch.zeros(spectrum_size, d_model)
-        position = torch.arange(0, spectrum_size, dtype=torch.float).unsqueeze(1)
         div_term = torch.exp(
             torch.arange(0, d_model, 2).float()
             * (-math.log(10000.0) / d_model)
         )
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)
-        self.register_buffer("pe", pe)
+        # (Both are recreated from the arguments, so neither is saved in the state dict)
+        self.register_buffer("div_term", div_term, persistent=False)
+        if self.precompute:
+            position = torch.arange(0, spectrum_size, dtype=torch.float)
+            self.register_buffer("pe", self.encode(position), persistent=False)
+        else:
+            self.pe = None
+
+    def encode(self, position):
+        '''Sinusoidal encodings of the (float) positions, with the sines and cosines interleaved.'''
+        angle = position.unsqueeze(-1) * self.div_term
+        return torch.stack((torch.sin(angle), torch.cos(angle)), dim=-1).flatten(-2)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints saved the encoding table
+        state_dict.pop(prefix + "pe", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x, start_indx):
         
-        #x = x + self.pe[:, start_indx:start_indx+x.size()[1], :]
-        #pe_batch = torch.concat([self.pe[:, i:i+x.size()[1], :] for i in start_indx])
+        # Position of each pixel of the batch along the spectrum
+        if not torch.is_tensor(start_indx):
+            start_indx = torch.as_tensor(start_indx)
+        start_indx = start_indx.to(x.device).reshape(-1, 1)
+        position = start_indx + torch.arange(x.size()[1], device=x.device)
+        position = position.expand(x.size()[0], -1)
+        
+        if self.precompute:
+            pe_batch = self.pe.index_select(0, position.flatten()).view(x.size())
+        else:
+            pe_batch = self.encode(position.float())
         
-        x = x + torch.concat([self.pe[:, i:i+x.size()[1], :] for i in start_indx])
+        x = x + pe_batch
         return self.dropout(x)
 
 # The below ConvNext classes were adapted from https://github.com/FrancescoSaverioZuppichini/ConvNext
@@ -87,6 +118,10 @@ class BottleNeckBlock(nn.Module):
         self.layer_scaler = LayerScaler(layer_scaler_init_value, out_features)
         self.drop_path = StochasticDepth(drop_p, mode="batch")
         
+    def shape_layers(self):
+        # The residual connection keeps the size of the block output
+        return [self.block]
+        
     def forward(self, x: Tensor) -> Tensor:
         res = x
         x = self.block(x)
@@ -136,8 +171,12 @@ class ConvNextEncoder(nn.Module):
         widths: List[int],
         drop_p: float = .0,
         pool_length: int = 0,
+        checkpoint_stages: bool = False,
     ):
         super().__init__()
+        # Recompute the activations of each stage in the backward pass
+        # instead of storing them (less memory for ~1/3 more compute)
+        self.checkpoint_stages = checkpoint_stages
         self.stem = ConvNextStem(in_channels, stem_features, stem_filt_size, stem_stride)
 
         in_out_widths = list(zip(widths, widths[1:]))
@@ -163,10 +202,19 @@ class ConvNextEncoder(nn.Module):
             self.pool_layer = None
         
 
+    def shape_layers(self):
+        layers = [self.stem, self.stages]
+        if self.pool_layer is not None:
+            layers.append(self.pool_layer)
+        return layers
+
     def forward(self, x):
         x = self.stem(x)
         for stage in self.stages:
-            x = stage(x)
+            if self.checkpoint_stages and torch.is_grad_enabled():
+                x = checkpoint(stage, x, use_reentrant=False)
+            else:
+                x = stage(x)
         if self.pool_layer is not None:
             x = self.pool_layer(x)
         return x
@@ -199,6 +247,9 @@ class StarNet_convs(torch.nn.Module):
             
         self.conv_model = torch.nn.Sequential(*layers)
 
+    def shape_layers(self):
+        return [self.conv_model]
+
     def forward(self, x):
         return self.conv_model(x)
 
@@ -225,6 +276,52 @@ class StarNet_head(torch.nn.Module):
     def forward(self, x):
         return self.fc_model(x)
 
+class StarNet_multihead(torch.nn.Module):
+    '''
+    Fused Linear output layers for several labels.
+    
+    One LayerNorm and one Linear layer (with the outputs of every label
+    concatenated) are applied to the features, and the output is split into
+    a log-softmax segment for each label. The affine parameters of the
+    separate LayerNorms are folded into the Linear layer, so the LayerNorm
+    only normalizes.
+
+    The fused head computes the same functions as the separate heads, but
+    it has no per-label LayerNorm gain and bias. New runs therefore train
+    a different parameterization: the folded parameters get different
+    gradients, and weight decay applies to them.
+    '''
+    def __init__(self, in_features, out_features, logsoftmax=True):
+        super().__init__()
+        self.out_features = list(out_features)
+        self.logsoftmax = logsoftmax
+        
+        self.norm = torch.nn.LayerNorm(in_features, elementwise_affine=False)
+        self.fc = torch.nn.Linear(in_features, sum(self.out_features))
+
+    def forward(self, x):
+        x = self.fc(self.norm(x))
+        outputs = torch.split(x, self.out_features, dim=1)
+        if self.logsoftmax:
+            outputs = [torch.log_softmax(out, dim=1) for out in outputs]
+        return list(outputs)
+    
+    @staticmethod
+    def convert_head_states(states):
+        '''Convert the state dicts of separate StarNet_head modules into a fused state dict.'''
+        weights, biases = [], []
+        for state in states:
+            # Fold the LayerNorm affine parameters into the Linear layer
+            gamma, beta = state['fc_model.0.weight'], state['fc_model.0.bias']
+            weight, bias = state['fc_model.1.weight'], state['fc_model.1.bias']
+            weights.append(weight*gamma)
+            biases.append(bias + weight @ beta)
+        return fuse_head_states(weights, biases)
+
+    def convert_optimizer_state(self, optimizer, state):
+        '''Convert an optimizer state dict of the separate heads (see fused_heads.convert_optimizer_state).'''
+        return convert_optimizer_state(self, optimizer, state)
+
 class StarNet(torch.nn.Module):
     def __init__(self, architecture_config, multimodal_keys,
                  unimodal_keys, mutlimodal_vals, device):
@@ -234,6 +331,8 @@ class StarNet(torch.nn.Module):
         self.multimodal_keys = multimodal_keys
         self.unimodal_keys = unimodal_keys
         self.mutlimodal_vals = mutlimodal_vals
+        # Sorted grids used to convert between labels and classes
+        self.label_grid = LabelGrid(mutlimodal_vals if mutlimodal_vals is not None else [])
         spectrum_size = int(architecture_config['spectrum_size'])
         self.d_model = int(architecture_config['encoder_dim'])
         conv_widths_sh = eval(architecture_config['conv_widths_sh'])
@@ -272,10 +371,12 @@ class StarNet(torch.nn.Module):
                                                      out_features=self.d_model)        
 
             # Positional encoding layer that encodes the position of the chunk along the spectrum
+            # (the encodings can be computed on the fly to save memory for long spectra)
             self.pos_encoder = PositionalEncoding(
                 d_model=self.d_model,
                 dropout=0,
                 spectrum_size=spectrum_size,
+                precompute=str2bool(architecture_config.get('precompute_pos_encoding', 'True')),
             )
             in_channels = self.d_model
 
@@ -291,7 +392,9 @@ class StarNet(torch.nn.Module):
                                                   stem_stride=stem_stride, 
                                                   depths=conv_depths_sh, 
                                                   widths=conv_widths_sh,
-                                                 pool_length=pool_length).to(device)
+                                                 pool_length=pool_length,
+                                                 checkpoint_stages=str2bool(architecture_config.get('checkpoint_activations', 
+                                                                                                    'False'))).to(device)
         
         # Split convolutional layers
         if self.use_split_convs:
@@ -318,13 +421,11 @@ class StarNet(torch.nn.Module):
         in_features = feat_map_shape[0]*feat_map_shape[1]
 
         # Network head that predicts labels as linear output
-        self.label_classifiers = []
         if self.num_mm_labels>0:
-            for vals in mutlimodal_vals:
-                # Fully connected classifier
-                self.label_classifiers.append(StarNet_head(in_features=in_features, 
-                                                          out_features=len(vals), 
-                                                          logsoftmax=True).to(device))
+            # Fully connected classifiers of every label in one layer
+            self.label_classifier = StarNet_multihead(in_features=in_features, 
+                                                      out_features=[len(vals) for vals in mutlimodal_vals], 
+                                                      logsoftmax=True).to(device)
         
         # Network head that predicts unimodal labels as linear output
         if self.num_um_labels>0:
@@ -350,10 +451,7 @@ class StarNet(torch.nn.Module):
 
     def multimodal_to_class(self, labels):
         '''Convert labels into classes based on the multimodal values.'''
-        classes = []
-        for i, vals in enumerate(self.mutlimodal_vals):
-            classes.append(torch.cat([torch.where(vals==labels[j,i])[0] for j in range(len(labels))]))
-        return classes
+        return list(self.label_grid.to_class(labels).unbind(1))
     
     def class_to_label(self, classes, batch_indices, take_mode=False):
         '''Convert probabilities into labels using a weighted average and the multimodal values.'''
@@ -365,8 +463,7 @@ class StarNet(torch.nn.Module):
             
             if take_mode:
                 # Take the class with the highest probability
-                class_indices = torch.argmax(prob, dim=(1), keepdim=True)
-                labels.append(torch.cat([c_vals[i] for i in class_indices]))
+                labels.append(c_vals[torch.argmax(prob, dim=1)])
             else:
                 # Take weighted average using class values and probabilities
                 labels.append(torch.sum(prob*c_vals, axis=1))
@@ -404,8 +501,7 @@ class StarNet(torch.nn.Module):
                 self.feature_encoder_tasks.train()
 
         if self.num_mm_labels>0:
-            for classifier in self.label_classifiers:
-                classifier.train()
+            self.label_classifier.train()
                 
         if self.num_um_labels>0:
             self.unimodal_predictor.train()
@@ -428,8 +524,7 @@ class StarNet(torch.nn.Module):
                 self.feature_encoder_tasks.eval()
 
         if self.num_mm_labels>0:
-            for classifier in self.label_classifiers:
-                classifier.eval()
+            self.label_classifier.eval()
                 
         if self.num_um_labels>0:
             self.unimodal_predictor.eval()
@@ -452,8 +547,7 @@ class StarNet(torch.nn.Module):
                 self.feature_encoder_tasks.eval()
 
         if self.num_mm_labels>0:
-            for classifier in self.label_classifiers:
-                classifier.train()
+            self.label_classifier.train()
                 
         if self.num_um_labels>0:
             self.unimodal_predictor.train()
@@ -477,8 +571,7 @@ class StarNet(torch.nn.Module):
                 parameters.append(self.feature_encoder_tasks.parameters())
         
         if self.num_mm_labels>0:
-            for net in self.label_classifiers:
-                parameters.append(net.parameters())
+            parameters.append(self.label_classifier.parameters())
         
         if self.num_um_labels>0:
             parameters.append(self.unimodal_predictor.parameters())            
@@ -493,8 +586,7 @@ class StarNet(torch.nn.Module):
         parameters = []        
         
         if self.num_mm_labels>0:
-            for net in self.label_classifiers:
-                parameters.append(net.parameters())
+            parameters.append(self.label_classifier.parameters())
         
         if self.num_um_labels>0:
             parameters.append(self.unimodal_predictor.parameters())
@@ -541,7 +633,7 @@ class StarNet(torch.nn.Module):
                 
             if self.num_mm_labels>0:
                 # Predict labels from features
-                mm_labels = [classifier(x) for classifier in self.label_classifiers]
+                mm_labels = self.label_classifier(x)
                 if denorm_out:
                     # Denormalize labels
                     mm_labels = self.class_to_label(mm_labels, pixel_indx,
@@ -571,6 +663,124 @@ class StarNet(torch.nn.Module):
             return return_dict
             
 
+def strip_noops(module):
+    '''Remove the dropout and drop-path layers, which do nothing in eval mode.'''
+    for name, child in list(module.named_children()):
+        if isinstance(child, (nn.Dropout, StochasticDepth, nn.Identity)):
+            if isinstance(module, nn.Sequential):
+                del module._modules[name]
+            else:
+                setattr(module, name, nn.Identity())
+        else:
+            strip_noops(child)
+
+def optimize_for_inference(model):
+    '''
+    Return a copy of `model` for inference (eval mode only), in which
+    
+    - the BatchNorm of each ConvNextStem is folded into the stem conv,
+    - the LayerScaler gamma of each BottleNeckBlock is folded into its final
+      pointwise conv,
+    - the LayerNorm affine parameters of each StarNet_head are folded into
+      its Linear layer,
+    - the dropout and drop-path layers are removed.
+    
+    The outputs match those of the original model in eval mode.
+    '''
+    model = copy.deepcopy(model).eval()
+    
+    with torch.no_grad():
+        for mod in list(model.modules()):
+            if isinstance(mod, ConvNextStem) and isinstance(mod[-1], nn.BatchNorm1d):
+                mod[0] = fuse_conv_bn_eval(mod[0], mod[1])
+                del mod[1]
+            elif isinstance(mod, BottleNeckBlock) and isinstance(mod.layer_scaler, LayerScaler):
+                conv = mod.block[-1]
+                gamma = mod.layer_scaler.gamma
+                conv.weight.mul_(gamma[:,None,None])
+                conv.bias.mul_(gamma)
+                mod.layer_scaler = nn.Identity()
+            elif isinstance(mod, StarNet_head) and mod.fc_model[0].elementwise_affine:
+                norm, fc = mod.fc_model[0], mod.fc_model[1]
+                fc.bias.add_(fc.weight @ norm.bias)
+                fc.weight.mul_(norm.weight)
+                mod.fc_model[0] = nn.LayerNorm(norm.normalized_shape, eps=norm.eps, 
+                                               elementwise_affine=False)
+    
+    strip_noops(model)
+    return model
+
+class StarNetInference(torch.nn.Module):
+    '''
+    Label prediction with StarNet, with the forward options fixed at build
+    time so that the module only maps (spectra, pixel_indx) to a
+    [batch, num_mm_labels+num_um_labels] tensor of the denormalized
+    multimodal labels followed by the unimodal labels. With `return_feats`,
+    the flattened feature maps are also returned as a second tensor.
+    '''
+    def __init__(self, model, norm_in=True, take_mode=False, return_feats=False):
+        super().__init__()
+        self.model = model
+        self.norm_in = norm_in
+        self.take_mode = take_mode
+        self.return_feats = return_feats
+
+    def forward(self, spectra, pixel_indx):
+        outputs = self.model(spectra, pixel_indx, norm_in=self.norm_in, 
+                             denorm_out=True, take_mode=self.take_mode,
+                             return_feats=self.return_feats)
+        labels = []
+        if self.model.num_mm_labels>0:
+            labels.append(outputs['multimodal labels'].to(spectra.dtype))
+        if self.model.num_um_labels>0:
+            labels.append(outputs['unimodal labels'])
+        if self.return_feats:
+            return torch.cat(labels, dim=1), outputs['feature map']
+        return torch.cat(labels, dim=1)
+
+def inference_cache_key(model, options):
+    '''Hash of the model weights, grids of class values and build options.'''
+    return weights_cache_key(model, options, model.mutlimodal_vals)
+
+def build_inference_model(model, spectrum_size, device, norm_in=True, take_mode=False,
+                          backend='trace', cache_dir=None, fold=True, return_feats=False):
+    '''
+    Build a compiled StarNetInference module for spectra of `spectrum_size` pixels.
+    
+    The model is first folded with optimize_for_inference (if `fold`), then
+    either traced and frozen with TorchScript (backend='trace') or compiled
+    with torch.compile (backend='compile'). With a `cache_dir`, the traced
+    module is saved there under a hash of the weights and options and loaded
+    by later builds; the torch.compile artefacts are kept by the inductor
+    cache in the same directory.
+    '''
+    if isinstance(model, torch.nn.DataParallel):
+        model = model.module
+    device = torch.device(device)
+    if fold:
+        model = optimize_for_inference(model)
+    else:
+        model = copy.deepcopy(model).eval()
+    inference_model = StarNetInference(model, norm_in=norm_in, take_mode=take_mode,
+                                       return_feats=return_feats).to(device).eval()
+
+    if backend=='compile':
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+        return torch.compile(inference_model, dynamic=False)
+    elif backend!='trace':
+        raise ValueError('Unknown inference backend: %s' % backend)
+
+    options = {'spectrum_size': spectrum_size, 'norm_in': norm_in, 'take_mode': take_mode,
+               'fold': fold, 'return_feats': return_feats, 'device': device.type,
+               'torch': torch.__version__}
+    # Trace the forward pass with an example batch
+    example_inputs = [torch.ones(2, spectrum_size, device=device),
+                      torch.zeros(2, dtype=torch.long, device=device)]
+    return trace_inference_model(inference_model, example_inputs, 'starnet_inference',
+                                 cache_dir, inference_cache_key(model, options))
+
 def build_starnet(config, device, model_name, mutlimodal_vals):
     
     # Display model configuration
@@ -607,8 +817,7 @@ def build_starnet(config, device, model_name, mutlimodal_vals):
             
     if model.num_mm_labels>0:
         print('\n\nMultimodal Label Prediction Architecture:\n')
-        for mod in model.label_classifiers:
-            print(mod)
+        print(model.label_classifier)
 
     if model.num_um_labels>0:
         print('\n\nUnimodal Label Prediction Architecture:\n')
@@ -619,7 +828,7 @@ def build_starnet(config, device, model_name, mutlimodal_vals):
         
     return model
 
-def load_model_state(model, model_filename, optimizer=None, lr_scheduler=None):
+def load_model_state(model, model_filename, optimizer=None, lr_scheduler=None, loss_scaler=None):
     
     # Check for pre-trained weights
     if os.path.exists(model_filename):
@@ -632,17 +841,28 @@ def load_model_state(model, model_filename, optimizer=None, lr_scheduler=None):
         losses = dict(checkpoint['losses'])
         cur_iter = checkpoint['batch_iters']+1
 
+        model_state = checkpoint['model']
+        # Older checkpoints saved each classifier head separately
+        old_heads = len(checkpoint.get('classifier models', []))>0
+        if old_heads:
+            head_state = StarNet_multihead.convert_head_states(checkpoint['classifier models'])
+            model_state.update({'label_classifier.'+k: v for k, v in head_state.items()})
+
         # Load optimizer states
         if optimizer is not None:
-            optimizer.load_state_dict(checkpoint['optimizer'])
+            optimizer_state = checkpoint['optimizer']
+            if old_heads:
+                # The saved states of the separate heads do not match the fused parameters
+                print('Starting fresh optimizer states for the fused classifier heads.')
+                optimizer_state = model.label_classifier.convert_optimizer_state(optimizer, optimizer_state)
+            optimizer.load_state_dict(optimizer_state)
         if lr_scheduler is not None:
             lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+        if (loss_scaler is not None) and ('loss_scaler' in checkpoint):
+            loss_scaler.load_state_dict(checkpoint['loss_scaler'])
 
         # Load model weights
-        model.load_state_dict(checkpoint['model'])
-        
-        for net, state in zip(model.label_classifiers, checkpoint['classifier models']):
-            net.load_state_dict(state)
+        model.load_state_dict(model_state)
         
     else:
         print('\nStarting fresh model to train...')
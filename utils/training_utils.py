@@ -3,12 +3,15 @@ import argparse
 from torch.optim.lr_scheduler import LambdaLR
 import math
 import numpy as np
+from contextlib import contextmanager, nullcontext
 
 import sys
 import os
 cur_dir = os.path.dirname(__file__)
 sys.path.append(os.path.join(cur_dir,'utils'))
+sys.path.append(os.path.join(cur_dir, '..', 'amp_utils'))
 from data_loader import batch_to_device
+from mixed_precision import NativeScalerWithGradNormCount, to_float
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
@@ -35,6 +38,14 @@ def parseArguments():
     parser.add_argument("-dd", "--data_dir", 
                         help="Data directory if different from StarNet_SS/data/", 
                         type=str, default=None)
+    # Int8 model written by quantize_model.py (for the test scripts)
+    parser.add_argument("-q", "--quantized", 
+                        help="Evaluate the int8 checkpoint instead of the float model.", 
+                        type=str, default='False')
+    # Folded and traced model built by build_inference_model (for the test scripts)
+    parser.add_argument("-tr", "--traced", 
+                        help="Predict with the traced inference model (cached in models/inference_cache/).", 
+                        type=str, default='False')
     
     # Parse arguments
     args = parser.parse_args()
@@ -55,10 +66,67 @@ def CosineSimilarityLoss(eps=1e-6):
         return torch.mean(1 - cos(inp, tgt))
     return loss
 
+@contextmanager
+def domain_batchnorm(model, sizes):
+    '''
+    Normalize each segment (of `sizes` samples) of the batch with its own
+    BatchNorm statistics, as if the segments were passed through the model
+    separately.
+    '''
+    bn_layers = [m for m in model.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+    def split_forward(forward):
+        return lambda x: torch.cat([forward(x_seg) for x_seg in torch.split(x, sizes)])
+    for bn in bn_layers:
+        bn.forward = split_forward(bn.forward)
+    try:
+        yield
+    finally:
+        for bn in bn_layers:
+            del bn.forward
+
+def split_outputs(outputs, sizes):
+    '''Split each output (or list of outputs) of a fused forward pass into segments.'''
+    split = [{} for _ in sizes]
+    for k, v in outputs.items():
+        if isinstance(v, list):
+            v_split = list(zip(*[torch.split(v_i, sizes) for v_i in v]))
+            for i in range(len(sizes)):
+                split[i][k] = list(v_split[i])
+        else:
+            for i, v_i in enumerate(torch.split(v, sizes)):
+                split[i][k] = v_i
+    return split
+
+def fused_forward(model, spectra, pixel_indices, split_batchnorm=True, **kwargs):
+    '''
+    Run the model once on the concatenation of several batches of spectra
+    with the same length (e.g. the source and target batches) and split the
+    outputs for each batch.
+    With split_batchnorm the BatchNorm layers keep the statistics of
+    each batch separate.
+    '''
+    if ((len(set(tuple(x.shape[1:]) for x in spectra))>1) or 
+        (split_batchnorm and isinstance(model, torch.nn.DataParallel) and len(model.device_ids)>1)):
+        # The batches cannot be concatenated (or the segments would be scattered across GPUs)
+        return [model(x, indx, **kwargs) for x, indx in zip(spectra, pixel_indices)]
+    
+    sizes = [len(x) for x in spectra]
+    pixel_indices = [torch.as_tensor(indx, device=x.device).expand(len(x)) 
+                     for x, indx in zip(spectra, pixel_indices)]
+    with domain_batchnorm(model, sizes) if split_batchnorm else nullcontext():
+        outputs = model(torch.cat(spectra), torch.cat(pixel_indices), **kwargs)
+    return split_outputs(outputs, sizes)
+
 def run_iter(model, src_batch, tgt_batch, optimizer, lr_scheduler, 
              source_mm_weights, source_um_weights, source_feature_weight,
              target_feature_weight, source_task_weights, target_task_weights, 
-             feat_loss_fn, losses_cp, mode='train'):
+             feat_loss_fn, losses_cp, mode='train', fused=False, split_batchnorm=True,
+             loss_scaler=None):
+    '''
+    With a `loss_scaler` (NativeScalerWithGradNormCount) the training forward
+    passes run at its precision, the losses are computed in float32 and it takes
+    the optimizer step.
+    '''
         
     if mode=='train':
         model.module.train_mode()
@@ -69,23 +137,42 @@ def run_iter(model, src_batch, tgt_batch, optimizer, lr_scheduler,
         
     total_loss = 0.
     
-    # Compute prediction on source batch.
-    # First on the entire spectra and then on chunks from the spectra.
-    model_outputs_src = model(src_batch['spectrum'],
-                              src_batch['spectrum index'],
-                              norm_in=True, denorm_out=False, return_feats=True)
-    model_outputs_src_chunk = model(src_batch['spectrum chunk'],
-                                    src_batch['chunk index'],
-                                    norm_in=True, denorm_out=False, return_feats=True)
-    
-    # Compute prediction on target batch
-    # First on the entire spectra and then on chunks from the spectra.
-    model_outputs_tgt = model(tgt_batch['spectrum'],
-                              tgt_batch['spectrum index'],
-                              norm_in=True, denorm_out=False, return_feats=True)
-    model_outputs_tgt_chunk = model(tgt_batch['spectrum chunk'],
-                                    tgt_batch['chunk index'],
-                                    norm_in=True, denorm_out=False, return_feats=True)
+    # (validation runs in float32)
+    with loss_scaler.autocast() if (loss_scaler is not None and 'train' in mode) else nullcontext():
+        if fused:
+            # Run the source and target batches through the model together,
+            # once for the entire spectra and once for the chunks
+            model_outputs_src, model_outputs_tgt = fused_forward(model, 
+                                                                 [src_batch['spectrum'], tgt_batch['spectrum']],
+                                                                 [src_batch['spectrum index'], tgt_batch['spectrum index']],
+                                                                 split_batchnorm=split_batchnorm,
+                                                                 norm_in=True, denorm_out=False, return_feats=True)
+            model_outputs_src_chunk, model_outputs_tgt_chunk = fused_forward(model, 
+                                                                             [src_batch['spectrum chunk'], tgt_batch['spectrum chunk']],
+                                                                             [src_batch['chunk index'], tgt_batch['chunk index']],
+                                                                             split_batchnorm=split_batchnorm,
+                                                                             norm_in=True, denorm_out=False, return_feats=True)
+        else:
+            # Compute prediction on source batch.
+            # First on the entire spectra and then on chunks from the spectra.
+            model_outputs_src = model(src_batch['spectrum'],
+                                      src_batch['spectrum index'],
+                                      norm_in=True, denorm_out=False, return_feats=True)
+            model_outputs_src_chunk = model(src_batch['spectrum chunk'],
+                                            src_batch['chunk index'],
+                                            norm_in=True, denorm_out=False, return_feats=True)
+
+            # Compute prediction on target batch
+            # First on the entire spectra and then on chunks from the spectra.
+            model_outputs_tgt = model(tgt_batch['spectrum'],
+                                      tgt_batch['spectrum index'],
+                                      norm_in=True, denorm_out=False, return_feats=True)
+            model_outputs_tgt_chunk = model(tgt_batch['spectrum chunk'],
+                                            tgt_batch['chunk index'],
+                                            norm_in=True, denorm_out=False, return_feats=True)
+    (model_outputs_src, model_outputs_src_chunk,
+     model_outputs_tgt, model_outputs_tgt_chunk) = to_float([model_outputs_src, model_outputs_src_chunk,
+                                                             model_outputs_tgt, model_outputs_tgt_chunk])
         
     if model.module.num_mm_labels>0:
         # Compute the average loss on stellar class labels
@@ -173,7 +260,11 @@ def run_iter(model, src_batch, tgt_batch, optimizer, lr_scheduler,
         
     if 'train' in mode:        
         # Update the gradients
-        total_loss.backward()
+        if loss_scaler is not None:
+            # (the scaler also takes the optimizer step)
+            loss_scaler(total_loss, optimizer, parameters=model.parameters())
+        else:
+            total_loss.backward()
 
         # Save loss and metrics
         losses_cp['train_loss'].append(float(total_loss))
@@ -192,7 +283,8 @@ def run_iter(model, src_batch, tgt_batch, optimizer, lr_scheduler,
             losses_cp['train_tgt_tasks_chunk'].append(tgt_task_losses_chunk.cpu().data.numpy().tolist())
 
         # Adjust network weights
-        optimizer.step()
+        if loss_scaler is None:
+            optimizer.step()
         # Reset gradients
         optimizer.zero_grad(set_to_none=True)
         # Adjust learning rate
@@ -217,18 +309,27 @@ def run_iter(model, src_batch, tgt_batch, optimizer, lr_scheduler,
                 
     return model, optimizer, lr_scheduler, losses_cp
 
-def val_iter(model, src_batch, tgt_batch, losses_cp):
+def val_iter(model, src_batch, tgt_batch, losses_cp, fused=False):
         
     model.module.eval_mode()
         
-    # Compute prediction on source batch
-    model_outputs_src = model(src_batch['spectrum'],
-                              src_batch['spectrum index'],
-                              norm_in=True, denorm_out=True, return_feats=True)
-    # Compute prediction on target batch
-    model_outputs_tgt = model(tgt_batch['spectrum'],
-                              tgt_batch['spectrum index'],
-                              norm_in=True, denorm_out=True, return_feats=True)
+    if fused:
+        # Compute predictions on both batches at once
+        # (the BatchNorm layers use their running statistics in eval mode)
+        model_outputs_src, model_outputs_tgt = fused_forward(model, 
+                                                             [src_batch['spectrum'], tgt_batch['spectrum']],
+                                                             [src_batch['spectrum index'], tgt_batch['spectrum index']],
+                                                             split_batchnorm=False,
+                                                             norm_in=True, denorm_out=True, return_feats=True)
+    else:
+        # Compute prediction on source batch
+        model_outputs_src = model(src_batch['spectrum'],
+                                  src_batch['spectrum index'],
+                                  norm_in=True, denorm_out=True, return_feats=True)
+        # Compute prediction on target batch
+        model_outputs_tgt = model(tgt_batch['spectrum'],
+                                  tgt_batch['spectrum index'],
+                                  norm_in=True, denorm_out=True, return_feats=True)
         
     # Compute Mean Abs Error on multimodal label predictions
     src_mm_losses = []